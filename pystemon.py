@@ -11,7 +11,7 @@ To be implemented:
 - FIXME validate parsing of config file
 '''
 
-from datetime import datetime
+from datetime import datetime, date, timedelta
 import logging.handlers
 import optparse
 import os
@@ -19,17 +19,21 @@ import json
 import sys
 import signal
 import threading
-# LATER: multiprocessing to parse regex
 import time
 from io import open
 from pystemon.proxy import ProxyList
 from pystemon.ua import PystemonUA
-from pystemon.throttler import ThreadThrottler
 from pystemon.pastie import ThreadPasties
 from pystemon.pastiesite import PastieSite
+from pystemon.matcherpool import ThreadMatcherPool
+from pystemon.asyncengine import ThreadAsyncEngine
+from pystemon.workerpool import PastieWorkerPool, ThreadPoolWorker
+from pystemon.autoscaler import ThreadAutoscaler
+from pystemon.rescan import PastieRescan
 from pystemon.sendmail import PystemonSendmail
 from pystemon.storage import PastieStorage
-from pystemon.config import PystemonConfig
+from pystemon.config import PystemonConfig, SEARCH_SECTIONS
+from pystemon.component import PystemonComponent, PystemonComponents
 from pystemon.storage import StorageSync, StorageThread, StorageDispatcher
 from pystemon.exception import *
 
@@ -53,35 +57,89 @@ try:
 except Exception:
     exit('You need python version 2.7 or newer.')
 
-def load_config(config):
+def pasties_worker_factory(config, site, throttler):
+    ''' returns a function creating the n-th ThreadPasties of the site '''
+    def factory(n):
+        name = "[ThreadPasties][{}][{}]".format(site.name, n)
+        user_agent = PystemonUA(name, config.proxies_list,
+                user_agents_list = config.user_agents_list,
+                throttler=throttler, ip_addr=config.ip_addr, stats=site.stats,
+                session_pool=config.session_pool, breaker=site.breaker)
+        t = ThreadPasties(user_agent, queue_name=site.name, queue=site.queue)
+        t.setDaemon(True)
+        return t
+    return factory
+
+# sections of the configuration file the sites do not depend on, or only
+# through objects kept across reloads (proxy list, http sessions, storage)
+SITE_EXCLUDED_SECTIONS = ['site', 'storage', 'save-thread', 'save-spill', 'proxy', 'http-pool', 'logging-level', 'pid']
+
+def load_config(config, running=None):
+    '''
+    Returns the PystemonComponents of the configuration. The components of
+    the 'running' configuration unchanged by the reload are kept.
+    '''
 
     logger.debug("About to load configuration")
     config.reload()
-    threads=[]
+    components = PystemonComponents(running)
+    # the PastieSites of the running configuration kept by this one
+    kept_sites = []
     sites_loaded=0
 
     if config.proxies_list is not None:
-        threads.append(config.proxies_list.monitor())
-
-    storage = StorageDispatcher()
-    if config.storage_engines:
-        if config.save_thread:
-            logger.info("Pasties will be saved asynchronously")
-        else:
-            logger.info("Pasties will be saved synchronously")
-        for db in config.storage_engines:
-            # start the threads handling database storage if needed
+        fingerprint = config.fingerprint(['proxy'])
+        if components.keep('proxies', fingerprint) is None:
+            c = components.add('proxies', fingerprint, config.proxies_list)
+            c.threads.append(config.proxies_list.monitor())
+
+    fingerprint = config.fingerprint(['storage', 'save-thread', 'save-spill'])
+    c = components.keep('storage', fingerprint)
+    if c is not None:
+        storage = c.value
+    else:
+        storage = StorageDispatcher()
+        c = components.add('storage', fingerprint, storage)
+        if config.storage_engines:
             if config.save_thread:
-                t = StorageThread(db)
-                threads.append(t)
-                storage.add_storage(t)
-                t.setDaemon(True)
-            # save pasties synchronously
+                logger.info("Pasties will be saved asynchronously")
             else:
-                s = StorageSync(db)
-                storage.add_storage(s)
-    else:
-        logger.info("Pasties will not be saved")
+                logger.info("Pasties will be saved synchronously")
+            for db in config.storage_engines:
+                # start the threads handling database storage if needed
+                if config.save_thread:
+                    t = StorageThread(db, spill=config.save_spill)
+                    c.threads.append(t)
+                    storage.add_storage(t)
+                    t.setDaemon(True)
+                # save pasties synchronously
+                else:
+                    s = StorageSync(db)
+                    storage.add_storage(s)
+        else:
+            logger.info("Pasties will not be saved")
+        # the sites kept running save their pasties to the new storage
+        c.on_start.append(lambda: [site.set_storage(storage) for site in kept_sites])
+
+    matcher_pool = None
+    if config.matcher_pool:
+        fingerprint = config.fingerprint(['matcher-pool'] + SEARCH_SECTIONS)
+        c = components.keep('matcher-pool', fingerprint)
+        if c is not None:
+            matcher_pool = c.value
+        else:
+            # regular expressions are evaluated in separate processes
+            matcher_pool = ThreadMatcherPool(config.regex_engine.name, config.patterns,
+                    prefilter=config.prefilter is not None, **config.matcher_pool)
+            c = components.add('matcher-pool', fingerprint, matcher_pool)
+            c.threads.append(matcher_pool)
+            matcher_pool.setDaemon(True)
+
+    # what the sites depend on besides their own section
+    site_fingerprint = '{0}|{1}|{2}|{3}|{4}|{5}|{6}'.format(config.fingerprint(exclude=SITE_EXCLUDED_SECTIONS),
+            config.proxies_list is not None, config.session_pool is not None,
+            config.save_dir, config.archive_dir, config.compress,
+            hash(tuple(config.user_agents_list or [])))
 
     '''
      for each site enabled:
@@ -89,71 +147,181 @@ def load_config(config):
      - if successful, create a queue
      - create a thread to refresh the list of pasties to download (consumer)
      - create a thread to download the pasties (consumer)
-     - if needed, create a thread to throttle all the other threads (producer)
     '''
-    for site in config.sites:
-        try:
+    async_engine = None
+    async_component = None
+    if config.download_engine is not None:
+        # the coroutines of the sites cannot be replaced one by one
+        fingerprint = '{0}|{1}'.format(site_fingerprint, [site.fingerprint for site in config.sites])
+        c = components.keep('asyncio-engine', fingerprint)
+        if c is not None:
+            async_engine = c.value
+            kept_sites.extend([site for (site, concurrency) in async_engine.sites])
+            sites_loaded = len(async_engine.sites)
+        else:
+            # archive polling and downloads run as coroutines of a single thread
+            logger.info("Pasties will be downloaded by the asyncio engine")
+            async_engine = ThreadAsyncEngine(**config.download_engine)
+            async_component = components.add('asyncio-engine', fingerprint, async_engine)
+            async_component.threads.append(async_engine)
+            async_engine.setDaemon(True)
+
+    worker_pool = None
+    if async_engine is None and config.worker_pool is not None:
+        fingerprint = config.fingerprint(['download-engine', 'worker-pool'])
+        c = components.keep('worker-pool', fingerprint)
+        if c is not None:
+            worker_pool = c.value
+        else:
+            # a single pool of download threads shared by all the sites
+            logger.info("Pasties will be downloaded by a pool of {0} threads".format(config.worker_pool['threads']))
+            worker_pool = PastieWorkerPool()
+            c = components.add('worker-pool', fingerprint, worker_pool)
+            for i in range(config.worker_pool['threads']):
+                t = ThreadPoolWorker(worker_pool, i+1)
+                c.threads.append(t)
+                t.setDaemon(True)
 
-            throttler = None
-            if site.throttling > 0:
-                logger.debug("enabling throttling on site {site}".format(site=site.name))
-                throttler = ThreadThrottler(site.name, site.throttling)
-                threads.append(throttler)
-                throttler.setDaemon(True)
+    autoscaler = None
+    if async_engine is None and worker_pool is None and config.autoscale is not None:
+        fingerprint = config.fingerprint(['download-engine', 'worker-pool', 'autoscale'])
+        c = components.keep('autoscaler', fingerprint)
+        if c is not None:
+            autoscaler = c.value
+        else:
+            # the download threads of each site are added and retired on demand
+            autoscaler = ThreadAutoscaler(**config.autoscale)
+            c = components.add('autoscaler', fingerprint, autoscaler)
+            c.threads.append(autoscaler)
+            autoscaler.setDaemon(True)
 
-            for i in range(config.threads):
-                name = "[ThreadPasties][{}][{}]".format(site.name, i+1)
-                user_agent = PystemonUA(name, config.proxies_list,
+    for site in config.sites:
+        if async_engine is not None and async_component is None:
+            break
+        try:
+            name = 'site:{0}'.format(site.name)
+            fingerprint = '{0}|{1}'.format(site.fingerprint, site_fingerprint)
+            if async_engine is None:
+                c = components.keep(name, fingerprint)
+                if c is not None:
+                    kept_sites.append(c.value)
+                    sites_loaded = sites_loaded + 1
+                    continue
+                c = PystemonComponent(name, fingerprint)
+
+            if async_engine is not None:
+                name = "[PastieSite][{}]".format(site.name)
+                site_ua = async_engine.user_agent(name, config.proxies_list,
                         user_agents_list = config.user_agents_list,
-                        throttler=throttler, ip_addr=config.ip_addr)
-                t = ThreadPasties(user_agent, queue_name=site.name, queue=site.queue)
-                threads.append(t)
-                t.setDaemon(True)
-
-            # Compressed is used to guess the filename, so it's mandatory to pass it along
-            name = "[PastieSite][{}]".format(site.name)
-            site_ua=PystemonUA(name, config.proxies_list,
-                user_agents_list = config.user_agents_list,
-                throttler = throttler, ip_addr = config.ip_addr)
+                        throttler = site.throttler, breaker = site.breaker)
+            else:
+                throttler = site.throttler
+                if throttler is not None:
+                    logger.debug("enabling throttling on site {site}".format(site=site.name))
+
+                if worker_pool is not None:
+                    name = "[ThreadPoolWorker][{}]".format(site.name)
+                    user_agent = PystemonUA(name, config.proxies_list,
+                            user_agents_list = config.user_agents_list,
+                            throttler=throttler, ip_addr=config.ip_addr, stats=site.stats,
+                            session_pool=config.session_pool, breaker=site.breaker)
+                    c.on_start.append(add_pool_site(c, worker_pool, site, user_agent))
+                elif autoscaler is not None:
+                    c.on_start.append(add_scaled_site(c, autoscaler, site,
+                            pasties_worker_factory(config, site, throttler), config.threads))
+                else:
+                    factory = pasties_worker_factory(config, site, throttler)
+                    for i in range(config.threads):
+                        c.threads.append(factory(i+1))
+
+                # Compressed is used to guess the filename, so it's mandatory to pass it along
+                name = "[PastieSite][{}]".format(site.name)
+                site_ua=PystemonUA(name, config.proxies_list,
+                    user_agents_list = config.user_agents_list,
+                    throttler = throttler, ip_addr = config.ip_addr, stats = site.stats,
+                    session_pool = config.session_pool, breaker = site.breaker)
             t = PastieSite(site.name, site.download_url, site.archive_url, site.archive_regex,
                     site_public_url = site.public_url,
                     site_metadata_url = site.metadata_url,
+                    site_archive_next_url = site.archive_next_url,
+                    site_archive_backfill = site.archive_backfill,
                     site_update_min = site.update_min,
                     site_update_max = site.update_max,
+                    scheduler = site.scheduler,
                     site_pastie_classname = site.pastie_classname,
                     site_save_dir = config.save_dir,
                     site_archive_dir = config.archive_dir,
                     archive_compress = config.compress,
                     site_ua=site_ua,
                     site_queue=site.queue,
+                    archive_cache=site.archive_cache,
+                    stats=site.stats,
                     patterns=config.patterns,
+                    prefilter=config.prefilter,
+                    stream_search=config.stream_search,
+                    matcher_pool=matcher_pool,
+                    match_cache=config.match_cache,
+                    seen_index=config.seen_index,
                     sendmail=config.sendmail,
                     re=config.re_module)
             t.set_storage(storage)
-            threads.append(t)
-            t.setDaemon(True)
+            if async_engine is not None:
+                async_engine.add_site(t, site.concurrency or config.threads)
+            else:
+                c.value = t
+                c.threads.append(t)
+                t.setDaemon(True)
+                components.append(c)
             sites_loaded = sites_loaded + 1
         except Exception as e:
             logger.error('Unable to initialize pastie site {0}: {1}'.format(site.name, e))
 
-    logger.debug("Finished loading configuration, {} thread(s) to start".format(len(threads)))
+    logger.debug("Finished loading configuration, {} thread(s) to start".format(
+        len([t for c in components.started() for t in c.threads])))
     if not sites_loaded > 0:
         raise PystemonConfigEmpty("Resulting configuration ends up monitoring no site")
-    return threads
+    return components
 
-def start_threads(threads):
-    count = len(threads)
-    logger.debug("starting {0} thread(s) ...".format(count))
-    for t in threads:
-        t.start()
-
-def stop_threads(threads):
-    count = len(threads)
-    if not count > 0:
-        return
-    logger.debug("stopping {0} thread(s) ...".format(count))
-    for t in threads:
-        t.stop()
+def close_queues(previous, sites):
+    '''
+    Closes the queues of the previous sites not used anymore, once their
+    threads are stopped. The pasties still waiting are moved to the new
+    queue of the same site.
+    '''
+    queues = dict([(site.name, site.queue) for site in sites])
+    for site in previous:
+        q = site.queue
+        new_q = queues.get(site.name)
+        if new_q is q:
+            continue
+        try:
+            if new_q is not None:
+                pasties = q.drain()
+                if pasties:
+                    logger.info("{0}: moving {1} pasties to the new queue".format(site.name, len(pasties)))
+                new_q.refill(pasties)
+            q.close()
+        except Exception as e:
+            logger.error("{0}: unable to close the previous queue: {1}".format(site.name, e))
+
+def add_pool_site(component, worker_pool, site, user_agent):
+    ''' serves the site with the worker pool while the component runs '''
+    def start():
+        pool_site = worker_pool.add_site(site.name, site.queue, user_agent,
+                weight=site.weight, concurrency=site.concurrency or 0,
+                throttler=site.throttler, breaker=site.breaker)
+        component.on_stop.append(lambda: worker_pool.remove_site(pool_site))
+    return start
+
+def add_scaled_site(component, autoscaler, site, factory, threads):
+    ''' scales the workers of the site while the component runs '''
+    def start():
+        # keep the number of workers of the running configuration
+        scaled_site = autoscaler.add_site(site.name, site.queue, site.stats, factory,
+                site.threads_min, max(site.threads_min, site.threads_max or threads),
+                site.stats.get('workers') or threads)
+        component.on_stop.append(lambda: autoscaler.remove_site(scaled_site))
+    return start
 
 def join_threads(threads, timeout=None, stop_requested=False):
     count = len(threads)
@@ -191,7 +359,7 @@ def main(config):
 
     reload_requested = True
     stop_requested = False
-    threads = []
+    components = None
 
     def request_stop(signal, frame):
         raise PystemonStopRequested("stop requested")
@@ -205,23 +373,45 @@ def main(config):
         raise PystemonQueueStatRequested("queues stats requested")
     signal.signal(signal.SIGUSR1, request_queue_stats)
 
+    def request_pattern_stats(signal, frame):
+        raise PystemonPatternStatRequested("patterns stats requested")
+    signal.signal(signal.SIGUSR2, request_pattern_stats)
+
 
     # wait while all the threads are running and someone sends CTRL+C
     while True:
         try:
-            if not len(threads) > 0:
+            if components is None:
                 raise PystemonReloadRequested("Starting up ...")
-            join_threads(threads, timeout=1)
+            # do not join the running threads here: a signal interrupting
+            # Thread.join() marks the joined thread as stopped (python < 3.13)
+            # and the reload would not keep its component
+            time.sleep(1)
         except PystemonReloadRequested as e:
             logger.info("Pystemon[{}]: {}".format(os.getpid(), e))
             try:
-                new_threads = load_config(config)
-                stop_threads(threads)
-                join_threads(threads, stop_requested=True)
-                threads = new_threads
-                start_threads(threads)
+                previous_sites = config.sites
+                try:
+                    new_components = load_config(config, components)
+                except Exception:
+                    # the running components keep the running configuration
+                    config.rollback()
+                    raise
+                if components is not None:
+                    logger.info("Pystemon[{}]: reload {}".format(os.getpid(), new_components.changes_to_text()))
+                # only the components changed by the reload are restarted
+                stopped = new_components.stopped()
+                for c in stopped:
+                    c.stop()
+                join_threads([t for c in stopped for t in c.threads], stop_requested=True)
+                # the objects of the running configuration are changed once its threads are stopped
+                config.commit()
+                close_queues(previous_sites or [], config.sites)
+                components = new_components
+                for c in components.started():
+                    c.start()
             except PystemonConfigException as e:
-                if not len(threads) > 0:
+                if components is None:
                     raise
                 logger.error('Pystemon[{}]: {}'.format(os.getpid(), e))
                 logger.info('Pystemon[{}]: continuing with previous configuration'.format(os.getpid()))
@@ -232,14 +422,43 @@ def main(config):
             else:
                 print('')
                 print("Ctrl-c received! Sending kill to threads...")
-            stop_threads(threads)
-            join_threads(threads, timeout=max(1, config.max_throttling / 1000), stop_requested=stop_threads)
+            threads = []
+            if components is not None:
+                for c in components.components:
+                    c.stop()
+                threads = components.threads()
+            join_threads(threads, timeout=max(1, config.max_throttling / 1000), stop_requested=True)
+            if config.match_cache is not None:
+                config.match_cache.save()
+            if config.seen_index is not None:
+                config.seen_index.close()
+            if config.session_pool is not None:
+                config.session_pool.close()
+            for site in config.sites:
+                site.queue.close()
             break
         except PystemonQueueStatRequested as e:
             logger.debug("{}".format(e))
             for site in config.sites:
                 try:
                     logger.info("{}: queue size={}".format(repr(site), site.queue.qsize()))
+                    logger.info(site.stats.to_text())
+                except:
+                    pass
+            if config.match_cache is not None:
+                logger.info(config.match_cache.stats_to_text())
+            if config.seen_index is not None:
+                logger.info(config.seen_index.stats_to_text())
+            if config.session_pool is not None:
+                logger.info(config.session_pool.stats_to_text())
+            if config.proxies_list is not None:
+                logger.info(config.proxies_list.stats_to_text())
+        except PystemonPatternStatRequested as e:
+            logger.debug("{}".format(e))
+            # most expensive patterns first
+            for ps in sorted(config.patterns, key=lambda ps: ps.total_time, reverse=True):
+                try:
+                    logger.info(ps.stats_to_text())
                 except:
                     pass
         except PystemonConfigException as e:
@@ -253,6 +472,32 @@ def main(config):
     logger.info('exiting')
     exit(res)
 
+def rescan(config, options):
+    config.reload_search()
+    if config.archive_dir is None:
+        logger.error("no archive directory (dir-all) configured, nothing to rescan")
+        return 1
+    start = end = None
+    try:
+        if options.rescan_days:
+            start = date.today() - timedelta(days=options.rescan_days - 1)
+        if options.rescan_from:
+            start = datetime.strptime(options.rescan_from, '%Y-%m-%d').date()
+        if options.rescan_to:
+            end = datetime.strptime(options.rescan_to, '%Y-%m-%d').date()
+    except ValueError as e:
+        logger.error("invalid rescan date: {}".format(e))
+        return 1
+    stream_search = config.stream_search or {}
+    r = PastieRescan(config.archive_dir, config.regex_engine.name, config.patterns,
+            prefilter=config.prefilter is not None,
+            sites=options.rescan_sites, start=start, end=end,
+            processes=options.rescan_jobs,
+            chunk_size=stream_search.get('chunk_size', 64*1024),
+            overlap=stream_search.get('overlap', 4096))
+    r.run()
+    return 0
+
 def main_as_daemon(config):
     try:
         # Store the Fork PID
@@ -285,6 +530,18 @@ if __name__ == "__main__":
     parser.add_option("-v", action="store_true", dest="verbose",
                       help="outputs more information")
     parser.add_option("--debug", action="store_true", dest="debug", help="enable debugging output")
+    parser.add_option("--rescan", action="store_true", dest="rescan",
+                      help="match the archived pasties against the search patterns, print the hits as JSON lines and exit")
+    parser.add_option("--rescan-site", action="append", dest="rescan_sites", metavar="SITE",
+                      help="only rescan this site (can be repeated)")
+    parser.add_option("--rescan-days", type="int", dest="rescan_days", metavar="N",
+                      help="only rescan the pasties of the last N days")
+    parser.add_option("--rescan-from", dest="rescan_from", metavar="YYYY-MM-DD",
+                      help="only rescan the pasties archived since this date")
+    parser.add_option("--rescan-to", dest="rescan_to", metavar="YYYY-MM-DD",
+                      help="only rescan the pasties archived until this date")
+    parser.add_option("--rescan-jobs", type="int", dest="rescan_jobs", default=0, metavar="N",
+                      help="number of rescan processes (default: one per CPU)")
 
     (options, args) = parser.parse_args()
 
@@ -315,7 +572,8 @@ if __name__ == "__main__":
 
     if not options.daemon:
         formatter = logging.Formatter('[%(asctime)s] %(message)s')
-        hdlr = logging.StreamHandler(sys.stdout)
+        # keep stdout for the JSON lines when rescanning
+        hdlr = logging.StreamHandler(sys.stderr if options.rescan else sys.stdout)
         hdlr.setFormatter(formatter)
         logger.addHandler(hdlr)
 
@@ -348,6 +606,15 @@ if __name__ == "__main__":
             print("PID file not found. Nothing to do.")
             os._exit(0)
 
+    # rescan the archive
+    if options.rescan:
+        try:
+            res = rescan(config, options)
+        except Exception as e:
+            logger.error("rescan failed: {}".format(e))
+            res = 1
+        exit(res)
+
     # run the software
     if options.daemon:
         main_as_daemon(config)
@@ -0,0 +1,384 @@
+import logging.handlers
+import asyncio
+import importlib
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from queue import Empty, Full
+except ImportError:
+    from Queue import Empty, Full
+
+from pystemon.pastie import Pastie
+from pystemon.ua import slow_down_requested
+
+logger = logging.getLogger('pystemon')
+
+class AsyncResponse():
+    ''' The parts of a requests.Response used by the sites and pasties '''
+
+    def __init__(self, url, status_code, headers, content, encoding=None):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.encoding = encoding or 'utf-8'
+
+    def __bool__(self):
+        return self.ok
+
+    __nonzero__ = __bool__
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding, 'replace')
+
+
+class AsyncUA():
+    '''
+    User agent of a site in the asyncio engine. fetch() is the coroutine
+    used by the engine, download_url() is the blocking interface of
+    PystemonUA for the code running in the executor (archive polling and
+    the Pastie classes with their own fetch_pastie).
+    '''
+
+    def __init__(self, engine, name, proxies_list, user_agents_list=[], throttler=None,
+            retries=5, connection_timeout=3.05, read_timeout=10, breaker=None):
+        self.engine = engine
+        self.name = "user-agent" + name
+        self.proxies_list = proxies_list
+        self.user_agents_list = user_agents_list
+        self.throttler = throttler
+        self.breaker = breaker
+        self.retries = retries
+        self.connection_timeout = connection_timeout
+        self.read_timeout = read_timeout
+
+    def stop(self):
+        pass
+
+    def get_random_user_agent(self):
+        if self.user_agents_list:
+            return random.choice(self.user_agents_list)
+        return 'Python-urllib/2.7'
+
+    async def throttle(self):
+        if self.throttler is None:
+            return
+        delay = self.throttler.reserve()
+        if delay > 0:
+            await self.engine.sleep(delay)
+
+    async def wait_breaker(self):
+        if self.breaker is None:
+            return True
+        delay = self.breaker.acquire()
+        while delay > 0:
+            if self.engine.kill_received:
+                return False
+            await self.engine.sleep(delay)
+            delay = self.breaker.acquire()
+        return True
+
+    def report(self, status, wait, throttled):
+        ''' tells the breaker of the site the outcome of a request '''
+        if self.breaker is None:
+            return
+        if status is not None and status < 400:
+            self.breaker.success()
+        elif throttled:
+            self.breaker.failure(wait, 'slow down requested')
+        elif status in [500, 502, 503, 504]:
+            self.breaker.error()
+        else:
+            self.breaker.release()
+
+    async def fetch(self, url, data=None, cookie=None, validators=None):
+        aiohttp = self.engine.aiohttp
+        timeout = aiohttp.ClientTimeout(sock_connect=self.connection_timeout, sock_read=self.read_timeout)
+        for attempt in range(self.retries):
+            if self.engine.kill_received or not await self.wait_breaker():
+                return None
+            await self.throttle()
+            headers = {'User-Agent': self.get_random_user_agent(), 'Accept-Charset': 'utf-8'}
+            if cookie:
+                headers['Cookie'] = cookie
+            if isinstance(data, dict):
+                headers.update(data)
+            if validators:
+                if validators.get('etag'):
+                    headers['If-None-Match'] = validators['etag']
+                if validators.get('last-modified'):
+                    headers['If-Modified-Since'] = validators['last-modified']
+            proxy = None
+            if self.proxies_list:
+                proxy = self.proxies_list.get_random_proxy()
+            logger.debug('{0}: Downloading url: {1} with proxy: {2}'.format(self.name, url, proxy))
+            wait = 60
+            status = None
+            advised = None
+            throttled = False
+            start = time.time()
+            try:
+                async with self.engine.session.get(url, headers=headers, proxy=proxy, timeout=timeout) as r:
+                    content = await r.read()
+                    status = r.status
+                    if r.status < 400:
+                        if proxy:
+                            self.proxies_list.succeeded_proxy(proxy, time.time() - start)
+                        if validators is not None and r.status == 200:
+                            validators['etag'] = r.headers.get('ETag')
+                            validators['last-modified'] = r.headers.get('Last-Modified')
+                        return AsyncResponse(url, r.status, r.headers, content, r.charset)
+                    # as PystemonUA, a 403 may ask to slow down
+                    throttled = r.status == 429 or (r.status == 403 and
+                            slow_down_requested(content.decode(r.charset or 'utf-8', 'replace')))
+                    if r.status not in [500, 502, 503, 504] and not throttled:
+                        logger.warning("{0}: {1} received for {2}, aborting".format(self.name, r.status, url))
+                        return None
+                    retry_after = r.headers.get('Retry-After', '')
+                    if retry_after.isdigit():
+                        wait = advised = int(retry_after)
+                    if r.status == 403:
+                        logger.warning("{0}: Slow down message received for {1}".format(self.name, url))
+                    else:
+                        logger.warning("{0}: {1} received for {2}".format(self.name, r.status, url))
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if proxy:
+                    self.proxies_list.failed_proxy(proxy)
+                logger.warning("{0}: Failed to download {1}: {2!r}".format(self.name, url, e))
+            finally:
+                self.report(status, advised, throttled)
+            if self.breaker is not None and throttled:
+                # the breaker pauses the whole site instead
+                wait = 0
+            logger.warning("{0}: Retry {1}/{2} in {3}s for {4}".format(self.name, attempt + 1, self.retries, wait, url))
+            await self.engine.sleep(wait)
+        logger.error("{0}: ERROR: too many errors, giving up on {1}".format(self.name, url))
+        return None
+
+    def download_url(self, url, data=None, cookie=None, wait=0, validators=None):
+        if self.engine.kill_received:
+            return None
+        future = asyncio.run_coroutine_threadsafe(
+                self.fetch(url, data=data, cookie=cookie, validators=validators), self.engine.loop)
+        return future.result()
+
+
+class ThreadAsyncEngine(threading.Thread):
+    '''
+    Polls the archive pages and downloads the pasties of all the sites
+    as coroutines of a single event loop, instead of a PastieSite thread,
+    ThreadPasties threads and a ThreadThrottler per site.
+
+    The blocking parts (archive parsing and seen lookups, matching,
+    storage, alerts and the Pastie classes with their own fetch_pastie)
+    run in a pool of 'executor_threads' threads.
+    '''
+
+    def __init__(self, executor_threads=4):
+        threading.Thread.__init__(self)
+        self.name = 'ThreadAsyncEngine'
+        self.aiohttp = importlib.import_module('aiohttp')
+        self.executor_threads = executor_threads
+        self.sites = []
+        self.loop = None
+        self.session = None
+        self.executor = None
+        self.stopping = None
+        self.tasks = set()
+        self.jobs = 0
+        self.condition = threading.Condition()
+        self.kill_received = False
+
+    def __repr__(self):
+        return '{0}[{1}]'.format(self.name, len(self.sites))
+
+    def user_agent(self, name, proxies_list, user_agents_list=[], throttler=None, breaker=None):
+        return AsyncUA(self, name, proxies_list, user_agents_list, throttler, breaker=breaker)
+
+    def add_site(self, site, concurrency):
+        self.sites.append((site, concurrency))
+
+    def stop(self):
+        with self.condition:
+            logger.info('{0}: exiting'.format(self.name))
+            self.kill_received = True
+            if self.loop is not None and self.stopping is not None:
+                self.loop.call_soon_threadsafe(self.stopping.set)
+            self.condition.notify_all()
+
+    def run(self):
+        logger.info('{0}: started'.format(self.name))
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self.main(loop))
+        except Exception as e:
+            logger.error('{0} crashed: {1}'.format(self.name, e))
+        finally:
+            loop.close()
+        logger.info('{0}: exited'.format(self.name))
+
+    async def main(self, loop):
+        self.executor = ThreadPoolExecutor(self.executor_threads)
+        self.session = self.aiohttp.ClientSession()
+        with self.condition:
+            self.loop = loop
+            self.stopping = asyncio.Event()
+            if self.kill_received:
+                self.stopping.set()
+        try:
+            for (site, concurrency) in self.sites:
+                self.spawn(self.poll(site))
+                self.spawn(self.dispatch(site, concurrency))
+            await self.stopping.wait()
+        finally:
+            for task in list(self.tasks):
+                task.cancel()
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+            # the jobs still running may need the loop to finish their downloads
+            while self.jobs:
+                await asyncio.sleep(0.05)
+            self.executor.shutdown(True)
+            await self.session.close()
+
+    def spawn(self, coroutine):
+        task = self.loop.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def sleep(self, delay):
+        ''' returns False if the engine was stopped while sleeping '''
+        try:
+            await asyncio.wait_for(self.stopping.wait(), delay)
+            return False
+        except asyncio.TimeoutError:
+            return True
+
+    def in_executor(self, func, *args):
+        return self.loop.run_in_executor(self.executor, self.job, func, args)
+
+    def job(self, func, args):
+        ''' runs in the executor, the jobs queued after stop() are skipped '''
+        with self.condition:
+            if self.kill_received:
+                return None
+            self.jobs = self.jobs + 1
+        try:
+            return func(*args)
+        finally:
+            with self.condition:
+                self.jobs = self.jobs - 1
+
+    async def poll(self, site):
+        ''' the loop of PastieSite.run '''
+        recovered = await self.in_executor(site.queue.recover, site.new_pastie)
+        if recovered:
+            logger.info('{0}: {1} pasties recovered from the download queue'.format(site.name, recovered))
+        while not self.kill_received:
+            logger.info('{0}: Downloading list of new pastes'.format(site.name))
+            try:
+                last_pasties = await self.in_executor(site.get_last_pasties)
+            except Exception as e:
+                logger.error('{0}: unable to get the list of new pastes: {1}'.format(site.name, e))
+                last_pasties = False
+            sleep_time = site.next_update(last_pasties)
+            logger.info('{0}: will check again in {1} seconds'.format(site.name, sleep_time))
+            if last_pasties:
+                amount = len(last_pasties)
+                while last_pasties and not self.kill_received:
+                    pastie = last_pasties.pop()
+                    await self.enqueue(site, pastie)
+                logger.info("Found {amount} new pasties for site {site}. There are now {qsize} pasties to be downloaded.".format(
+                    amount=amount, site=site.name, qsize=site.queue.qsize()))
+            await self.sleep(sleep_time)
+
+    async def enqueue(self, site, pastie):
+        blocked = False
+        while not self.kill_received:
+            try:
+                site.queue.put(pastie, block=False)
+                return True
+            except Full:
+                if not blocked:
+                    site.stats.incr('queue_blocked')
+                    blocked = True
+                await self.sleep(1)
+        return False
+
+    async def dispatch(self, site, concurrency):
+        ''' downloads up to 'concurrency' pasties of the site at once '''
+        slots = asyncio.Semaphore(concurrency)
+        while not self.kill_received:
+            await slots.acquire()
+            pastie = None
+            while pastie is None and not self.kill_received:
+                try:
+                    pastie = site.queue.get(block=False)
+                except Empty:
+                    await self.sleep(0.5)
+            if pastie is None:
+                slots.release()
+                break
+            self.spawn(self.process(site, pastie, slots))
+
+    @staticmethod
+    def ran(func, *args):
+        ''' runs func in a job, which returns None instead if it was skipped '''
+        func(*args)
+        return True
+
+    async def process(self, site, pastie, slots):
+        processed = False
+        try:
+            if type(pastie).fetch_pastie is Pastie.fetch_pastie:
+                pastie.user_agent = site.user_agent
+                await self.fetch(site, pastie)
+                processed = await self.in_executor(self.ran, pastie.process_pastie)
+            else:
+                # custom download of the pastie, through the blocking interface
+                processed = await self.in_executor(self.ran, pastie.fetch_and_process_pastie, site.user_agent)
+        except asyncio.CancelledError:
+            # not done, the pastie stays in the queue to be recovered
+            raise
+        except Exception as e:
+            logger.error("{0}: unable to process pastie {1}: {2}".format(site.name, pastie.id, e))
+            processed = True
+        finally:
+            slots.release()
+        if not processed:
+            # skipped on stop: released here, and recovered from the queue by the next run
+            logger.debug("{0}: pastie {1} not processed, left in the queue".format(site.name, pastie.id))
+            pastie.release()
+            return
+        site.queue.done(pastie)
+
+    async def fetch(self, site, pastie):
+        ''' the equivalent of Pastie.fetch_pastie '''
+        logger.debug('fetching pastie {0}'.format(pastie.id))
+        start = time.time()
+        if pastie.metadata_url is not None:
+            response = await site.user_agent.fetch(pastie.metadata_url)
+            if response is not None:
+                pastie.pastie_metadata = response.content
+                site.stats.incr('pastie_bytes', len(response.content))
+        response = await site.user_agent.fetch(pastie.url)
+        site.stats.incr('fetches')
+        site.stats.incr('fetch_seconds', time.time() - start)
+        if response is None:
+            logger.debug('failed to fetch pastie {id}'.format(id=pastie.id))
+            return
+        site.stats.incr('pasties')
+        site.stats.incr('pastie_bytes', len(response.content))
+        if len(response.content) == 0:
+            logger.error('ERROR: Pastie size is 0B, ignoring {site} {id}'.format(site=site.name, id=pastie.id))
+            return
+        pastie.pastie_content = response.content
+        logger.debug('fetched pastie {id}: {s}s, {b}B'.format(id=pastie.id, s=time.time() - start, b=len(response.content)))
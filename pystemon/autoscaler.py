@@ -0,0 +1,179 @@
+import logging.handlers
+import math
+import threading
+import time
+
+logger = logging.getLogger('pystemon')
+
+class ScaledSite():
+    ''' The ThreadPasties workers of a site and the state of its autoscaling '''
+
+    def __init__(self, name, queue, stats, factory, minimum, maximum, workers):
+        self.name = name
+        self.queue = queue
+        self.stats = stats
+        self.factory = factory
+        self.minimum = minimum
+        self.maximum = maximum
+        self.initial = max(minimum, min(maximum, workers))
+        self.workers = []
+        self.started = 0
+        # consecutive intervals asking for more or less workers
+        self.up = 0
+        self.down = 0
+        # intervals left without scaling up after rate limiting
+        self.hold = 0
+        self.last = None
+
+    def __repr__(self):
+        return 'ScaledSite[{0}][{1}]'.format(self.name, len(self.workers))
+
+    def snapshot(self):
+        return (time.time(), self.stats.get('fetches'), self.stats.get('fetch_seconds'),
+                self.stats.get('rate_limited'))
+
+
+class ThreadAutoscaler(threading.Thread):
+    '''
+    Adds or retires the ThreadPasties workers of each site every 'interval'
+    seconds, between the 'threads-min' and 'threads-max' of the site.
+
+    The workers needed are estimated from the time spent downloading
+    during the last interval (the average number of busy workers) plus
+    the workers needed to drain the queue within one interval at the
+    current latency. Scaling up needs UP_AFTER intervals in a row asking
+    for more workers, scaling down retires one worker after DOWN_AFTER
+    idle intervals with the queue empty and less than LOW_WATER of the
+    remaining workers busy. Rate limited responses (429, 403) retire a
+    worker and hold off scaling up for HOLD intervals.
+    '''
+
+    UP_AFTER = 2
+    DOWN_AFTER = 3
+    LOW_WATER = 0.7
+    HOLD = 3
+
+    def __init__(self, interval=30):
+        threading.Thread.__init__(self)
+        self.name = 'ThreadAutoscaler'
+        self.interval = interval
+        self.sites = []
+        self.running = False
+        self.condition = threading.Condition()
+        self.kill_received = False
+
+    def __repr__(self):
+        return '{0}[{1}]'.format(self.name, self.interval)
+
+    def add_site(self, name, queue, stats, factory, minimum, maximum, workers):
+        site = ScaledSite(name, queue, stats, factory, minimum, maximum, workers)
+        with self.condition:
+            self.sites.append(site)
+            if self.running:
+                # added by a reload
+                self.scale(site, site.initial, 'initial')
+                site.last = site.snapshot()
+        return site
+
+    def remove_site(self, site):
+        ''' stops the workers of the site '''
+        with self.condition:
+            if site in self.sites:
+                self.sites.remove(site)
+            for worker in site.workers:
+                worker.stop()
+
+    def stop(self):
+        with self.condition:
+            logger.info('{0}: exiting'.format(self.name))
+            self.kill_received = True
+            self.condition.notify_all()
+            for site in self.sites:
+                for worker in site.workers:
+                    worker.stop()
+
+    def run(self):
+        logger.info('{0}: started'.format(self.name))
+        with self.condition:
+            self.running = True
+            for site in self.sites:
+                self.scale(site, site.initial, 'initial')
+                site.last = site.snapshot()
+            while not self.kill_received:
+                self.condition.wait(self.interval)
+                if self.kill_received:
+                    break
+                for site in self.sites:
+                    try:
+                        self.evaluate(site)
+                    except Exception as e:
+                        logger.error('{0}: unable to scale site {1}: {2}'.format(self.name, site.name, e))
+        logger.info('{0}: exited'.format(self.name))
+
+    def evaluate(self, site):
+        now = site.snapshot()
+        (elapsed, fetches, seconds, rate_limited) = [b - a for (a, b) in zip(site.last, now)]
+        site.last = now
+        depth = site.queue.qsize()
+        (target, reason) = self.decide(site, depth, fetches, seconds, rate_limited, elapsed)
+        if target > len(site.workers):
+            site.stats.incr('autoscale_up')
+        elif target < len(site.workers):
+            site.stats.incr('autoscale_down')
+        else:
+            logger.debug('{0}: keeping {1} worker(s) for site {2}: {3}'.format(
+                self.name, target, site.name, reason))
+            return
+        self.scale(site, target, reason)
+
+    def decide(self, site, depth, fetches, seconds, rate_limited, elapsed):
+        ''' returns the number of workers the site should have and why '''
+        n = len(site.workers)
+        if rate_limited:
+            site.up = site.down = 0
+            site.hold = self.HOLD
+            site.stats.incr('autoscale_backoff')
+            return (max(site.minimum, n - 1), '{0} rate limited response(s)'.format(rate_limited))
+        if site.hold:
+            site.hold = site.hold - 1
+        busy = seconds / elapsed if elapsed > 0 else 0
+        if fetches:
+            latency = seconds / fetches
+            needed = int(math.ceil(busy + depth * latency / elapsed))
+        else:
+            # nothing was downloaded, one more worker if pasties are waiting
+            latency = 0
+            needed = n + 1 if depth else 0
+        needed = max(site.minimum, min(site.maximum, needed))
+        reason = 'queue depth {0}, latency {1:.2f}s, {2:.1f} busy'.format(depth, latency, busy)
+        if needed > n and depth and not site.hold:
+            site.down = 0
+            site.up = site.up + 1
+            if site.up >= self.UP_AFTER:
+                site.up = 0
+                return (needed, reason)
+        elif n > site.minimum and not depth and busy < (n - 1) * self.LOW_WATER:
+            site.up = 0
+            site.down = site.down + 1
+            if site.down >= self.DOWN_AFTER:
+                site.down = 0
+                return (n - 1, reason)
+        else:
+            site.up = site.down = 0
+        return (n, reason)
+
+    def scale(self, site, target, reason):
+        n = len(site.workers)
+        if target > n:
+            for i in range(target - n):
+                site.started = site.started + 1
+                worker = site.factory(site.started)
+                site.workers.append(worker)
+                worker.start()
+        elif target < n:
+            for worker in site.workers[target:]:
+                worker.retire()
+            site.workers = site.workers[:target]
+        site.stats.set('workers', target)
+        logger.info('{0}: {1} worker(s) instead of {2} for site {3}: {4}'.format(
+            self.name, target, n, site.name, reason))
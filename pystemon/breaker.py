@@ -0,0 +1,151 @@
+import logging.handlers
+import threading
+import time
+
+logger = logging.getLogger('pystemon')
+
+class SiteCircuitBreaker():
+    '''
+    Circuit breaker of a site, shared by all its user agents and kept
+    across configuration reloads.
+
+    A 429, a "slow down" 403 or 'errors' 5xx responses in a row open the
+    breaker: no request is sent to the site for the advised Retry-After,
+    or else for 'cooldown' seconds, doubled at each trip in a row up to
+    'max_cooldown'. Then the breaker is half-open: a single probe is
+    sent. When the probe succeeds the site ramps up, with one more
+    request allowed at once per success, and is closed again after
+    'ramp' successes. A failure while half-open or ramping opens the
+    breaker again.
+    '''
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+    RAMP = 'ramp-up'
+
+    # seconds between two checks of the waiting requests
+    POLL = 1
+    # seconds after which a probe without outcome is considered lost
+    PROBE_TIMEOUT = 60
+
+    def __init__(self, site, cooldown=60, max_cooldown=3600, errors=5, ramp=8, stats=None):
+        self.site = site
+        self.stats = stats
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.open_until = 0
+        self.trips = 0
+        self.errors_in_row = 0
+        self.in_flight = 0
+        self.probe_started = 0
+        self.successes = 0
+        if stats is not None:
+            stats.set('breaker', self.state)
+        self.configure(cooldown, max_cooldown, errors, ramp)
+
+    def __repr__(self):
+        return 'SiteCircuitBreaker[{0}][{1}]'.format(self.site, self.state)
+
+    def configure(self, cooldown=60, max_cooldown=3600, errors=5, ramp=8):
+        with self.lock:
+            self.cooldown = cooldown
+            self.max_cooldown = max(cooldown, max_cooldown)
+            self.errors = errors
+            self.ramp = ramp
+
+    def _set_state(self, state, reason):
+        if state == self.state:
+            return
+        logger.info('{0}: circuit breaker {1} -> {2}: {3}'.format(self.site, self.state, state, reason))
+        self.state = state
+        if self.stats is not None:
+            self.stats.set('breaker', state)
+
+    def _wait(self, now):
+        if self.state == self.OPEN:
+            return max(0, self.open_until - now)
+        if self.state == self.HALF_OPEN:
+            # a lost probe does not block the site forever
+            if self.in_flight and now - self.probe_started < self.PROBE_TIMEOUT:
+                return self.POLL
+        elif self.state == self.RAMP and self.in_flight > self.successes:
+            return self.POLL
+        return 0
+
+    def delay(self):
+        ''' seconds until a request may be sent, without taking the slot '''
+        with self.lock:
+            return self._wait(time.time())
+
+    def acquire(self):
+        '''
+        Returns 0 when a request may be sent, then success(), failure(),
+        error() or release() must be called with its outcome. Otherwise
+        returns the seconds to wait before asking again.
+        '''
+        now = time.time()
+        with self.lock:
+            wait = self._wait(now)
+            if wait > 0:
+                return wait
+            if self.state == self.OPEN:
+                self._set_state(self.HALF_OPEN, 'sending a probe')
+            if self.state == self.HALF_OPEN:
+                self.in_flight = 1
+                self.probe_started = now
+                return 0
+            self.in_flight = self.in_flight + 1
+            return 0
+
+    def _done(self):
+        self.in_flight = max(0, self.in_flight - 1)
+
+    def release(self):
+        ''' the request ended with no signal about the health of the site '''
+        with self.lock:
+            self._done()
+
+    def success(self):
+        with self.lock:
+            self._done()
+            self.errors_in_row = 0
+            if self.state == self.HALF_OPEN:
+                self.successes = 1
+                self._set_state(self.RAMP, 'probe succeeded')
+            elif self.state == self.RAMP:
+                self.successes = self.successes + 1
+                if self.successes >= self.ramp:
+                    self.trips = 0
+                    self._set_state(self.CLOSED, '{0} successful requests'.format(self.successes))
+
+    def error(self):
+        ''' a 5xx response, the breaker opens after 'errors' in a row '''
+        with self.lock:
+            self._done()
+            self.errors_in_row = self.errors_in_row + 1
+            if self.errors_in_row >= self.errors or self.state in [self.HALF_OPEN, self.RAMP]:
+                self._trip(None, '{0} server error(s) in a row'.format(self.errors_in_row))
+
+    def failure(self, wait=None, reason='rate limited'):
+        ''' the site asked to slow down, for 'wait' seconds if known '''
+        with self.lock:
+            self._done()
+            self._trip(wait, reason)
+
+    def _trip(self, wait, reason):
+        now = time.time()
+        if self.state == self.OPEN and now < self.open_until:
+            # the other requests sent before the breaker opened
+            if wait:
+                self.open_until = max(self.open_until, now + wait)
+            return
+        if not wait:
+            wait = min(self.max_cooldown, self.cooldown * 2 ** self.trips)
+        self.trips = self.trips + 1
+        self.errors_in_row = 0
+        self.open_until = now + wait
+        if self.stats is not None:
+            self.stats.incr('breaker_trips')
+            self.stats.incr('breaker_open_seconds', wait)
+        self._set_state(self.OPEN, '{0}, pausing the site for {1}s'.format(reason, wait))
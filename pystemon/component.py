@@ -0,0 +1,108 @@
+import logging.handlers
+
+logger = logging.getLogger('pystemon')
+
+class PystemonComponent():
+    '''
+    Threads started and stopped together, built from the parts of the
+    configuration identified by 'fingerprint'. 'value' is the object the
+    rest of the configuration uses (a PastieSite, a StorageDispatcher,
+    ...), 'on_start' and 'on_stop' the functions called when it is started
+    and stopped.
+    '''
+
+    def __init__(self, name, fingerprint, value=None):
+        self.name = name
+        self.fingerprint = fingerprint
+        self.value = value
+        self.threads = []
+        self.on_start = []
+        self.on_stop = []
+
+    def __repr__(self):
+        return 'PystemonComponent[{0}]'.format(self.name)
+
+    def alive(self):
+        for t in self.threads:
+            if not t.is_alive():
+                return False
+        return True
+
+    def start(self):
+        for f in self.on_start:
+            f()
+        for t in self.threads:
+            t.start()
+
+    def stop(self):
+        for f in self.on_stop:
+            try:
+                f()
+            except Exception as e:
+                logger.error("{0}: unable to stop: {1}".format(self, e))
+        for t in self.threads:
+            t.stop()
+
+
+class PystemonComponents():
+    '''
+    The components of a configuration. On reload, a running component
+    whose fingerprint did not change and whose threads are all alive is
+    kept, instead of being stopped and built again.
+    '''
+
+    def __init__(self, running=None):
+        self.running = running
+        self.components = []
+        self.kept = []
+
+    def __repr__(self):
+        return 'PystemonComponents[{0}]'.format(len(self.components))
+
+    def keep(self, name, fingerprint):
+        ''' returns the running component if unchanged, else None '''
+        if self.running is None:
+            return None
+        component = self.running.get(name)
+        if component is None or component.fingerprint != fingerprint or not component.alive():
+            return None
+        self.components.append(component)
+        self.kept.append(component)
+        return component
+
+    def add(self, name, fingerprint, value=None):
+        return self.append(PystemonComponent(name, fingerprint, value))
+
+    def append(self, component):
+        self.components.append(component)
+        return component
+
+    def get(self, name):
+        for component in self.components:
+            if component.name == name:
+                return component
+        return None
+
+    def threads(self):
+        threads = []
+        for component in self.components:
+            threads.extend(component.threads)
+        return threads
+
+    def started(self):
+        ''' the components to start, built by this configuration '''
+        return [c for c in self.components if c not in self.kept]
+
+    def stopped(self):
+        ''' the components of the running configuration to stop '''
+        if self.running is None:
+            return []
+        return [c for c in self.running.components if c not in self.kept]
+
+    def changes_to_text(self):
+        started = [c.name for c in self.started()]
+        stopped = [c.name for c in self.stopped()]
+        return "kept {0} component(s) [{1}], started {2} [{3}], stopped {4} [{5}]".format(
+                len(self.kept), ', '.join([c.name for c in self.kept]),
+                len(started), ', '.join(started),
+                len(stopped), ', '.join(stopped))
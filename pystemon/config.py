@@ -1,47 +1,131 @@
 import logging.handlers
-import yaml
+import copy
+import json
+import os
 import importlib
+import yaml
 import threading
-
-try:
-    from queue import Queue
-except ImportError:
-    from Queue import Queue
+import time
 
 from pystemon.sendmail import PystemonSendmail
 from pystemon.storage import PastieStorage
 from pystemon.proxy import ProxyList
-from pystemon.pastiesearch import PastieSearch
+from pystemon.ua import PystemonSessionPool
+from pystemon.pastiesearch import PastieSearch, PastieSearchCache, load_patterns
+from pystemon.prefilter import PastiePrefilter
+from pystemon.engine import ENGINES, load_engine
+from pystemon.matchcache import PastieMatchCache
+from pystemon.seenindex import PastieSeenIndex
+from pystemon.stats import PystemonStats
+from pystemon.scheduler import PastieScheduler
+from pystemon.throttler import TokenBucketThrottler
+from pystemon.breaker import SiteCircuitBreaker
+from pystemon.sitequeue import PastieSiteQueue, PastieDiskQueue, POLICIES
 from pystemon.exception import PystemonConfigException
 
 logger = logging.getLogger('pystemon')
 
 class SiteConfig():
-    def __init__(self, name, config):
+    def __init__(self, name, config, queue_journal=None):
         self.name = name
+        self.fingerprint = yaml_fingerprint(config)
         self._queue = None
+        self.queue_journal = queue_journal
+        self.archive_cache = {}
+        self.stats = PystemonStats(name)
         self.download_url = config['download-url']
         self.archive_url = config['archive-url']
         self.archive_regex = config['archive-regex']
+        self.archive_next_url = config.get('archive-next-url')
+        self.archive_backfill = int(config.get('archive-backfill-pages', 5))
         self.throttling = config.get('throttling', 0)
+        try:
+            self.throttling_burst = int(config.get('throttling-burst', 1))
+            if self.throttling_burst < 1:
+                raise Exception("minimum acceptable value is 1")
+        except Exception as e:
+            raise PystemonConfigException("invalid throttling-burst for site {0}: {1}".format(name, e))
+        self.throttler = None
+        if self.throttling > 0:
+            self.throttler = TokenBucketThrottler(name, self.throttling, self.throttling_burst, self.stats)
+        # pauses the whole site when it asks to slow down
+        self.breaker = None
+        if config.get('breaker', True):
+            try:
+                self.breaker_config = {
+                        'cooldown': int(config.get('breaker-cooldown', 60)),
+                        'max_cooldown': int(config.get('breaker-max-cooldown', 3600)),
+                        'errors': int(config.get('breaker-errors', 5)),
+                        'ramp': int(config.get('breaker-ramp', 8))}
+                if min(self.breaker_config.values()) < 1:
+                    raise Exception("expecting a positive value")
+            except Exception as e:
+                raise PystemonConfigException("invalid breaker configuration for site {0}: {1}".format(name, e))
+            self.breaker = SiteCircuitBreaker(name, stats=self.stats, **self.breaker_config)
+        self.queue_size = int(config.get('queue-size', 0))
+        self.queue_policy = config.get('queue-policy', 'block')
+        if self.queue_policy not in POLICIES:
+            raise PystemonConfigException("invalid queue-policy '{0}', expecting one of {1}".format(
+                self.queue_policy, ', '.join(POLICIES)))
+        self.queue_newest_first = config.get('queue-order', 'fifo') == 'newest-first'
         self.public_url= config.get('public-url')
         self.metadata_url = config.get('metadata-url')
         self.update_min = config.get('update-min', 10)
         self.update_max = config.get('update-max', 30)
+        self.scheduler = None
+        if config.get('update-adaptive', False):
+            self.scheduler = PastieScheduler(name,
+                    config.get('update-floor', self.update_min),
+                    config.get('update-ceiling', self.update_max),
+                    self.throttling)
         self.pastie_classname = config.get('pastie-classname')
+        # simultaneous downloads with the worker pool or the asyncio engine,
+        # default is 'threads'
+        self.concurrency = config.get('concurrency')
+        # bounds of the download threads of the site with the autoscaler,
+        # threads-max defaults to 'threads'
+        try:
+            self.threads_min = int(config.get('threads-min', 1))
+            self.threads_max = int(config.get('threads-max', 0))
+            if self.threads_min < 1 or self.threads_max < 0:
+                raise Exception("expecting a positive value")
+        except Exception as e:
+            raise PystemonConfigException("invalid threads-min or threads-max for site {0}: {1}".format(name, e))
+        try:
+            self.weight = float(config.get('weight', 1))
+            if self.weight <= 0:
+                raise Exception("expecting a positive value")
+        except Exception as e:
+            raise PystemonConfigException("invalid weight for site {0}: {1}".format(name, e))
 
     @property
     def queue(self):
         if self._queue is None:
             logger.debug("{}: initializing with empty Queue".format(repr(self)))
-            self._queue = Queue()
+            if self.queue_journal is not None:
+                self._queue = PastieDiskQueue(os.path.join(self.queue_journal['dir'], self.name + '.sqlite3'),
+                        self.queue_size, self.queue_policy, self.queue_newest_first, self.stats,
+                        commit_interval=self.queue_journal['commit_interval'],
+                        commit_batch=self.queue_journal['commit_batch'])
+            else:
+                self._queue = PastieSiteQueue(self.queue_size, self.queue_policy,
+                        self.queue_newest_first, self.stats)
         return self._queue
 
-    @queue.setter
-    def queue(self, q):
+    def inherit_queue(self, q):
+        ''' the queue is configured by configure_queue(), once the reload is committed '''
         logger.debug("{}: inheriting queue of size={}".format(repr(self), q.qsize()))
         self._queue = q
 
+    def configure_queue(self):
+        self._queue.configure(self.queue_size, self.queue_policy, self.queue_newest_first)
+        if self.queue_journal is not None:
+            self._queue.configure_journal(self.queue_journal['commit_interval'], self.queue_journal['commit_batch'])
+
+    def same_queue(self, other):
+        ''' whether the queue of other can be inherited, both journaled in the same directory or not '''
+        return (self.queue_journal or {}).get('dir') == (other.queue_journal or {}).get('dir')
+
     def __str__(self):
         return '''SiteConfig[{}]:
         download url: {}
@@ -75,6 +159,49 @@ class SiteConfig():
     def __hash(self):
         return self.name.__hash__()
 
+# sections of the configuration file the search patterns are built from
+SEARCH_SECTIONS = ['engine', 'strict_regex', 'search-time-budget', 'search-quarantine', 'prefilter', 'search']
+
+def yaml_fingerprint(yamlconfig, sections=None, exclude=[]):
+    '''
+    Returns a string identifying the content of the given top-level
+    sections of a yaml configuration (all but 'exclude' by default), to
+    find the parts of the configuration unchanged by a reload.
+    '''
+    if sections is None:
+        sections = [section for section in yamlconfig if section not in exclude]
+    return json.dumps(dict([(section, yamlconfig.get(section)) for section in sections]),
+            sort_keys=True, default=str)
+
+class PystemonReload():
+    '''
+    A reload of the configuration not committed yet. The loaders only
+    build new objects: the changes to the objects of the running
+    configuration are made by the 'on_commit' functions, once the new
+    configuration replaced it. On failure, the 'on_rollback' functions
+    release the objects built for the new configuration, and 'previous'
+    holds the attributes of the running one.
+    '''
+
+    def __init__(self, previous):
+        self.previous = previous
+        self.on_commit = []
+        self.on_rollback = []
+
+    def run(self, functions, what):
+        for f in functions:
+            try:
+                f()
+            except Exception as e:
+                logger.error("unable to {0} the configuration reload: {1}".format(what, e))
+
+# attributes of PystemonConfig set by reload()
+RELOADED_ATTRIBUTES = ['_yamlconfig', '_yamlcopy', '_pidfile', '_ip_addr', '_sendmail', '_save_thread',
+        '_save_spill', '_user_agents_list', '_storage_engines', '_save_dir', '_archive_dir', '_compress',
+        '_proxies_list', '_re_module', '_regex_engine', '_patterns', '_prefilter', '_stream_search',
+        '_matcher_pool', '_match_cache', '_seen_index', '_session_pool', '_sites', '_threads',
+        '_download_engine', '_worker_pool', '_autoscale', '_max_throttling']
+
 # TODO verify validity of all config parameters
 class PystemonConfig():
     def __init__(self, configfile, debug):
@@ -82,6 +209,8 @@ class PystemonConfig():
         self.lock = threading.Lock()
         self._configfile = configfile
         self._yamlconfig = None
+        # the yaml configuration in use, as loaded from the file
+        self._yamlcopy = None
         self._pidfile = None
         self._ip_addr = None
         self._sendmail = None
@@ -89,15 +218,29 @@ class PystemonConfig():
         self._storage_engines = None
         self._proxies_list = None
         self._re_module = None
+        self._regex_engine = None
         self._save_thread = False
+        self._save_spill = 0
         self._patterns = []
+        self._regex_cache = PastieSearchCache()
+        self._prefilter = None
+        self._stream_search = None
+        self._matcher_pool = None
+        self._match_cache = None
+        self._seen_index = None
+        self._session_pool = None
         self._threads = 1
+        self._download_engine = None
+        self._worker_pool = None
+        self._autoscale = None
         self._sites = []
         self._save_dir = None
         self._archive_dir = None
         self._compress = False
         self._reload_count = 0
         self._max_throttling = 0
+        # the reload to commit or roll back
+        self._pending = None
         self._preload()
 
     def is_same_as(self, other):
@@ -119,6 +262,11 @@ class PystemonConfig():
         with self.lock:
             return self._save_thread
 
+    @property
+    def save_spill(self):
+        with self.lock:
+            return self._save_spill
+
     @property
     def save_dir(self):
         with self.lock:
@@ -174,11 +322,61 @@ class PystemonConfig():
         with self.lock:
             return self._re_module
 
+    @property
+    def regex_engine(self):
+        with self.lock:
+            return self._regex_engine
+
     @property
     def patterns(self):
         with self.lock:
             return self._patterns
 
+    @property
+    def prefilter(self):
+        with self.lock:
+            return self._prefilter
+
+    @property
+    def stream_search(self):
+        with self.lock:
+            return self._stream_search
+
+    @property
+    def matcher_pool(self):
+        with self.lock:
+            return self._matcher_pool
+
+    @property
+    def match_cache(self):
+        with self.lock:
+            return self._match_cache
+
+    @property
+    def seen_index(self):
+        with self.lock:
+            return self._seen_index
+
+    @property
+    def session_pool(self):
+        with self.lock:
+            return self._session_pool
+
+    @property
+    def download_engine(self):
+        with self.lock:
+            return self._download_engine
+
+    @property
+    def worker_pool(self):
+        with self.lock:
+            return self._worker_pool
+
+    @property
+    def autoscale(self):
+        with self.lock:
+            return self._autoscale
+
     @property
     def sites(self):
         with self.lock:
@@ -190,8 +388,17 @@ class PystemonConfig():
             return self._max_throttling
 
     def reload(self):
+        '''
+        Loads the configuration file, the running configuration is replaced
+        but its objects are left alone until commit(), or restored by
+        rollback() if the new configuration cannot be used.
+        '''
+        start = time.time()
+        # a reload not rolled back is in use
+        self.commit()
         try:
             with self.lock:
+                self._pending = PystemonReload(dict([(name, getattr(self, name)) for name in RELOADED_ATTRIBUTES]))
                 if self._reload_count:
                     logger.debug("reloading configuration file '{0}'".format(self._configfile))
                     self._yamlconfig = None
@@ -199,10 +406,18 @@ class PystemonConfig():
                     logger.debug("loading configuration file '{0}'".format(self._configfile))
                 self._reload_count = self._reload_count + 1
                 self._preload()
-                config = self._reload()
+                # the loaders may alter the yaml configuration
+                yamlcopy = copy.deepcopy(self._yamlconfig)
+                try:
+                    config = self._reload(yamlcopy)
+                except Exception:
+                    self._rollback()
+                    raise
+                self._yamlcopy = yamlcopy
                 self._ip_addr = config.get('ip_addr')
                 self._sendmail = config.get('sendmail')
                 self._save_thread = config.get('save_thread')
+                self._save_spill = config.get('save_spill')
                 self._user_agents_list = config.get('user_agents_list')
                 self._storage_engines = config.get('storage_engines')
                 self._save_dir = config.get('save_dir')
@@ -210,9 +425,23 @@ class PystemonConfig():
                 self._compress = config.get('compress')
                 self._proxies_list = config.get('proxies_list')
                 self._re_module = config.get('re_module')
+                self._regex_engine = config.get('regex_engine')
+                if config.get('patterns') is self._patterns:
+                    # inherited patterns are quarantined until the next reload only
+                    for ps in self._patterns:
+                        self._pending.on_commit.append(ps.release)
                 self._patterns = config.get('patterns')
+                self._prefilter = config.get('prefilter')
+                self._stream_search = config.get('stream_search')
+                self._matcher_pool = config.get('matcher_pool')
+                self._match_cache = config.get('match_cache')
+                self._seen_index = config.get('seen_index')
+                self._session_pool = config.get('session_pool')
                 self._sites = config.get('sites')
                 self._threads = config.get('threads')
+                self._download_engine = config.get('download_engine')
+                self._worker_pool = config.get('worker_pool')
+                self._autoscale = config.get('autoscale')
                 self._pidfile = config.get('pidfile')
                 self._max_throttling = 0
                 for site in self._sites:
@@ -222,9 +451,31 @@ class PystemonConfig():
             raise
         except Exception as e:
             raise PystemonConfigException('Unable to parse configuration: {}'.format(e))
-        logger.debug("configuration loaded")
+        logger.info("configuration loaded in {0:.3f}s".format(time.time() - start))
         return True
 
+    def commit(self):
+        ''' the reloaded configuration is in use, apply its changes to the running objects '''
+        with self.lock:
+            pending = self._pending
+            self._pending = None
+        if pending is not None:
+            pending.run(pending.on_commit, 'commit')
+
+    def rollback(self):
+        ''' the reloaded configuration cannot be used, restore the running one '''
+        with self.lock:
+            self._rollback()
+
+    def _rollback(self):
+        pending = self._pending
+        self._pending = None
+        if pending is None:
+            return
+        for (name, value) in pending.previous.items():
+            setattr(self, name, value)
+        pending.run(pending.on_rollback, 'roll back')
+
     def _preload(self):
         if self._yamlconfig is None:
             logger.debug("pre-loading config file '{}'".format(self._configfile))
@@ -234,17 +485,22 @@ class PystemonConfig():
             except KeyError:
                 pass
 
-    def _reload(self):
+    def fingerprint(self, sections=None, exclude=[]):
+        ''' see yaml_fingerprint(), for the configuration in use '''
+        with self.lock:
+            return yaml_fingerprint(self._yamlcopy or {}, sections, exclude)
+
+    def _reload(self, yamlcopy):
         logger.debug("parsing yaml configuration from file '{}'".format(self._configfile))
         config = {}
         yamlconfig = self._yamlconfig
-        try:
-            if yamlconfig['proxy']['random']:
-                config['proxies_list'] = ProxyList(yamlconfig['proxy']['file'])
-        except KeyError:
-            pass
+        config['proxies_list'] = self._load_proxies(yamlconfig)
 
         config['save_thread'] = yamlconfig.get('save-thread', False)
+        try:
+            config['save_spill'] = int(yamlconfig.get('save-spill', 0))
+        except Exception as e:
+            raise PystemonConfigException("invalid save-spill value: {0}".format(e))
 
         uaconfig = yamlconfig.get('user-agent', {})
         if uaconfig.get('random', False):
@@ -260,13 +516,41 @@ class PystemonConfig():
             pass
 
         config['sendmail'] = self._load_email(yamlconfig)
-        res = self._load_storage_engines(yamlconfig)
-        config['storage_engines'] = res['engines']
-        config['save_dir'] = res['save_dir']
-        config['archive_dir'] = res['archive_dir']
-        config['compress'] = res['compress']
-        config['re_module'] = self._load_regex_engine(yamlconfig)
-        config['patterns'] = self._compile_regex(yamlconfig, config['re_module'])
+        if (self._storage_engines is not None and self._yamlcopy is not None and
+                yaml_fingerprint(self._yamlcopy, ['storage']) == yaml_fingerprint(yamlcopy, ['storage'])):
+            # keep the storage backends of the running configuration, and their connections
+            logger.debug("storage unchanged, inheriting {0} storage engine(s)".format(len(self._storage_engines)))
+            config['storage_engines'] = self._storage_engines
+            config['save_dir'] = self._save_dir
+            config['archive_dir'] = self._archive_dir
+            config['compress'] = self._compress
+        else:
+            res = self._load_storage_engines(yamlconfig)
+            config['storage_engines'] = res['engines']
+            config['save_dir'] = res['save_dir']
+            config['archive_dir'] = res['archive_dir']
+            config['compress'] = res['compress']
+        if (self._regex_engine is not None and self._yamlcopy is not None and
+                yaml_fingerprint(self._yamlcopy, SEARCH_SECTIONS) == yaml_fingerprint(yamlcopy, SEARCH_SECTIONS)):
+            # keep the patterns of the running configuration, and their statistics
+            logger.debug("search patterns unchanged, inheriting {0} patterns".format(len(self._patterns)))
+            config['regex_engine'] = self._regex_engine
+            config['patterns'] = self._patterns
+            config['prefilter'] = self._prefilter
+        else:
+            config['regex_engine'] = self._load_regex_engine(yamlconfig)
+            config['patterns'] = self._compile_regex(yamlconfig, config['regex_engine'])
+            config['prefilter'] = self._load_prefilter(yamlconfig, config['patterns'])
+        config['re_module'] = config['regex_engine'].module
+        config['stream_search'] = self._load_stream_search(yamlconfig)
+        config['matcher_pool'] = self._load_matcher_pool(yamlconfig)
+        if config['stream_search'] is not None and config['matcher_pool'] is not None:
+            # the streamed pasties are already matched by the download threads
+            logger.warning("stream-search and matcher-pool are mutually exclusive, matcher-pool disabled")
+            config['matcher_pool'] = None
+        config['match_cache'] = self._load_match_cache(yamlconfig, config['regex_engine'], config['patterns'])
+        config['seen_index'] = self._load_seen_index(yamlconfig)
+        config['session_pool'] = self._load_session_pool(yamlconfig)
         try:
             config['threads'] = int(yamlconfig.get('threads', 1))
             if config['threads'] < 1:
@@ -276,17 +560,52 @@ class PystemonConfig():
             config['threads'] = 1
             pass
 
-        config['sites'] = self._load_sites(yamlconfig)
+        config['download_engine'] = self._load_download_engine(yamlconfig)
+        config['worker_pool'] = self._load_worker_pool(yamlconfig)
+        config['autoscale'] = self._load_autoscale(yamlconfig)
+        config['sites'] = self._load_sites(yamlconfig, self._load_queue_journal(yamlconfig))
 
+        self._pending.on_commit.append(lambda: self._load_logging_level(yamlconfig))
+
+        logger.debug("yaml configuration parsed")
+        return config
+
+    def reload_search(self):
+        '''
+        Loads only what --rescan needs: the search patterns and the
+        archive directory. The storage backends, seen index, proxies and
+        sites are left alone.
+        '''
+        start = time.time()
+        try:
+            with self.lock:
+                logger.debug("loading search configuration from file '{0}'".format(self._configfile))
+                self._preload()
+                yamlconfig = self._yamlconfig
+                self._load_logging_level(yamlconfig)
+                self._regex_engine = self._load_regex_engine(yamlconfig)
+                self._re_module = self._regex_engine.module
+                self._patterns = self._compile_regex(yamlconfig, self._regex_engine)
+                self._prefilter = self._load_prefilter(yamlconfig, self._patterns)
+                self._stream_search = self._load_stream_search(yamlconfig)
+                archive = yamlconfig.get('storage', {}).get('archive', {})
+                # as _load_storage_engines(), without initializing the storage
+                if archive.get('save') or archive.get('save-all'):
+                    self._archive_dir = archive.get('dir-all')
+        except PystemonConfigException:
+            raise
+        except Exception as e:
+            raise PystemonConfigException('Unable to parse configuration: {}'.format(e))
+        logger.info("search configuration loaded in {0:.3f}s".format(time.time() - start))
+        return True
+
+    def _load_logging_level(self, yamlconfig):
         if not self.debug and 'logging-level' in yamlconfig:
             if yamlconfig['logging-level'] in ['NOTSET', 'DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']:
                 logger.setLevel(logging.getLevelName(yamlconfig['logging-level']))
             else:
                 logger.error("logging level \"%s\" is invalid" % (yamlconfig['logging-level']))
 
-        logger.debug("yaml configuration parsed")
-        return config
-
     def _recent_pyyaml(self):
         res = False
         try:
@@ -378,29 +697,31 @@ class PystemonConfig():
     def _load_regex_engine(self, yamlconfig):
         # load the regular expression engine
         engine = yamlconfig.get('engine', 're')
-        re_module = None
-        if not engine in ['re', 'regex']:
-            raise PystemonConfigException("only 're' or 'regex' supported, not '{0}'".format(engine))
+        if not engine in ENGINES:
+            raise PystemonConfigException("only {0} supported, not '{1}'".format(
+                ', '.join(["'{0}'".format(name) for name in sorted(ENGINES)]), engine))
         try:
             logger.debug("Loading regular expression engine '{0}'".format(engine))
-            re_module=importlib.import_module(engine)
-            if engine == 'regex':
-                logger.debug("Setting regex DEFAULT_VERSION to VERSION1")
-                re_module.DEFAULT_VERSION = re_module.VERSION1
+            regex_engine = load_engine(engine)
         except ImportError as e:
-            raise PystemonConfigException("unable to import module '{0}'".format(engine))
-        return re_module
+            raise PystemonConfigException("unable to import module '{0}'".format(ENGINES[engine].modname))
+        return regex_engine
 
-    def _compile_regex(self, yamlconfig, re_module):
+    def _compile_regex(self, yamlconfig, regex_engine):
         patterns = []
         # compile all search patterns
         strict = yamlconfig.get('strict_regex', False)
+        time_budget = yamlconfig.get('search-time-budget', 0)
+        quarantine = yamlconfig.get('search-quarantine', 3)
         regexes = yamlconfig['search']
         logger.debug("compiling {} regexes ...".format(len(regexes)))
+        start = time.time()
+        self._regex_cache.start()
         for regex in regexes:
             try:
                 search = regex['search']
-                ps = PastieSearch(re_module, regex)
+                ps = PastieSearch(regex_engine, regex, time_budget=time_budget, quarantine=quarantine,
+                        cache=self._regex_cache)
                 patterns.append(ps)
             except KeyError:
                 if strict:
@@ -413,9 +734,237 @@ class PystemonConfig():
                 else:
                     logger.error("Error: Unable to parse regex '%s': %s" % (search, e))
         logger.debug("successfully compiled {0}/{1} regexes".format(len(patterns), len(regexes)))
+        dropped = self._regex_cache.finish()
+        logger.info("regexes loaded in {0:.3f}s: {1} reused, {2} compiled, {3} dropped".format(
+            time.time() - start, self._regex_cache.reused, self._regex_cache.compiled, dropped))
+        fallbacks = [ps for ps in patterns if ps.fallback is not None]
+        logger.info("regular expression engine '{0}': {1} pattern(s), {2} falling back to 're'".format(
+            regex_engine.name, len(patterns) - len(fallbacks), len(fallbacks)))
+        for ps in fallbacks:
+            logger.info("[{0}]: using 're': {1}".format(ps.search, ps.fallback))
+        load_patterns(regex_engine, patterns)
         return patterns
 
-    def _load_sites(self, yamlconfig):
+    def _load_prefilter(self, yamlconfig, patterns):
+        if not yamlconfig.get('prefilter', True):
+            logger.debug("prefilter disabled")
+            return None
+        return PastiePrefilter(patterns, previous=self._prefilter)
+
+    def _load_stream_search(self, yamlconfig):
+        stream = yamlconfig.get('stream-search', {})
+        if not stream.get('enable', False):
+            return None
+        try:
+            chunk_size = int(stream.get('chunk-size', 64*1024))
+            overlap = int(stream.get('overlap', 4096))
+            if chunk_size < 1 or overlap < 0:
+                raise Exception("chunk-size must be positive and overlap not negative")
+        except Exception as e:
+            raise PystemonConfigException("invalid stream-search configuration: {0}".format(e))
+        logger.debug("pasties will be searched in chunks of {0}B with an overlap of {1}B".format(chunk_size, overlap))
+        return {'chunk_size': chunk_size, 'overlap': overlap}
+
+    def _load_matcher_pool(self, yamlconfig):
+        pool = yamlconfig.get('matcher-pool', {})
+        if not pool.get('enable', False):
+            return None
+        try:
+            processes = int(pool.get('processes', 0))
+            max_inflight = int(pool.get('max-inflight', 64*1024*1024))
+            timeout = int(pool.get('timeout', 60))
+            if processes < 0 or max_inflight < 1 or timeout < 1:
+                raise Exception("processes must not be negative, max-inflight and timeout must be positive")
+        except Exception as e:
+            raise PystemonConfigException("invalid matcher-pool configuration: {0}".format(e))
+        return {'processes': processes, 'max_inflight': max_inflight, 'timeout': timeout}
+
+    def _load_match_cache(self, yamlconfig, regex_engine, patterns):
+        cache = yamlconfig.get('match-cache', {})
+        if not cache.get('enable', False):
+            if self._match_cache is not None:
+                self._pending.on_commit.append(self._match_cache.save)
+            return None
+        try:
+            size = int(cache.get('size', 10000))
+            if size < 1:
+                raise Exception("size must be positive")
+        except Exception as e:
+            raise PystemonConfigException("invalid match-cache configuration: {0}".format(e))
+        match_cache = PastieMatchCache(size, filename=cache.get('file'),
+                suppress_alerts=cache.get('suppress-duplicate-alerts', False))
+        if match_cache.is_same_as(self._match_cache):
+            # keep the results of the running configuration
+            logger.debug("inheriting {0}".format(repr(self._match_cache)))
+            suppress_alerts = match_cache.suppress_alerts
+            match_cache = self._match_cache
+            def configure():
+                match_cache.suppress_alerts = suppress_alerts
+                match_cache.set_patterns(regex_engine.name, patterns)
+            self._pending.on_commit.append(configure)
+            return match_cache
+        if self._match_cache is not None:
+            self._pending.on_commit.append(self._match_cache.save)
+        match_cache.set_patterns(regex_engine.name, patterns)
+        return match_cache
+
+    def _load_seen_index(self, yamlconfig):
+        index = yamlconfig.get('seen-index', {})
+        try:
+            size = int(index.get('size', 100000))
+            max_age = int(index.get('max-age', 0))
+            bloom = int(index.get('bloom', 0))
+            bloom_error = float(index.get('bloom-error', 0.001))
+            if size < 1 or max_age < 0 or bloom < 0 or not 0 < bloom_error < 1:
+                raise Exception("size must be positive, max-age and bloom not negative and bloom-error between 0 and 1")
+        except Exception as e:
+            raise PystemonConfigException("invalid seen-index configuration: {0}".format(e))
+        filename = index.get('file') or None
+        if bloom and filename is None:
+            # an empty filter would tell every pastie was never seen
+            raise PystemonConfigException("invalid seen-index configuration: bloom needs a file")
+        previous = self._seen_index
+        if previous is not None and previous.filename == filename:
+            if (previous.bloom is None and not bloom) or (previous.bloom is not None
+                    and (previous.bloom.capacity, previous.bloom.error) == (bloom, bloom_error)):
+                # keep the pasties seen by the running configuration
+                logger.debug("inheriting {0}".format(repr(previous)))
+                def configure():
+                    with previous.lock:
+                        previous.size = size
+                        previous.max_age = max_age
+                self._pending.on_commit.append(configure)
+                return previous
+        # the log is only opened once the running index closed it
+        same_log = previous is not None and filename is not None and previous.filename == filename
+        seen_index = PastieSeenIndex(size, max_age=max_age, filename=filename,
+                bloom=bloom, bloom_error=bloom_error, lazy=same_log)
+        if previous is not None:
+            self._pending.on_commit.append(previous.close)
+        if same_log:
+            self._pending.on_commit.append(seen_index.load)
+        else:
+            self._pending.on_rollback.append(seen_index.close)
+        return seen_index
+
+    def _load_proxies(self, yamlconfig):
+        try:
+            if not yamlconfig['proxy']['random']:
+                return None
+            filename = yamlconfig['proxy']['file']
+        except KeyError:
+            return None
+        proxy = yamlconfig['proxy']
+        try:
+            cooldown = int(proxy.get('cooldown', 60))
+            max_cooldown = int(proxy.get('max-cooldown', 3600))
+            failures = int(proxy.get('failures', 2))
+            if cooldown < 1 or max_cooldown < 1 or failures < 1:
+                raise Exception("expecting positive values")
+            probe = None
+            if proxy.get('probe', {}).get('enable', False):
+                probe = {
+                        'url': proxy['probe']['url'],
+                        'interval': float(proxy['probe'].get('interval', 300)),
+                        'concurrency': int(proxy['probe'].get('concurrency', 10)),
+                        'timeout': float(proxy['probe'].get('timeout', 5))}
+                if probe['interval'] <= 0 or probe['concurrency'] < 1 or probe['timeout'] <= 0:
+                    raise Exception("expecting positive probe values")
+        except Exception as e:
+            raise PystemonConfigException("invalid proxy configuration: {0}".format(e))
+        if self._proxies_list is not None:
+            # keep the scores of the running configuration
+            logger.debug("inheriting {0}".format(repr(self._proxies_list)))
+            proxies_list = self._proxies_list
+            self._pending.on_commit.append(
+                    lambda: proxies_list.configure(filename, cooldown, max_cooldown, failures, probe))
+            return proxies_list
+        return ProxyList(filename, cooldown, max_cooldown, failures, probe)
+
+    def _load_session_pool(self, yamlconfig):
+        pool = yamlconfig.get('http-pool', {})
+        if not pool.get('enable', True):
+            if self._session_pool is not None:
+                self._pending.on_commit.append(self._session_pool.close)
+            return None
+        try:
+            connections = int(pool.get('connections', 10))
+            maxsize = int(pool.get('maxsize', 10))
+            idle_timeout = float(pool.get('idle-timeout', 60))
+            if connections < 1 or maxsize < 1 or idle_timeout <= 0:
+                raise Exception("expecting positive values")
+        except Exception as e:
+            raise PystemonConfigException("invalid http-pool configuration: {0}".format(e))
+        if self._session_pool is not None:
+            # keep the connections of the running configuration
+            logger.debug("inheriting {0}".format(repr(self._session_pool)))
+            session_pool = self._session_pool
+            self._pending.on_commit.append(lambda: session_pool.configure(connections, maxsize, idle_timeout))
+            return session_pool
+        session_pool = PystemonSessionPool(connections, maxsize, idle_timeout)
+        self._pending.on_rollback.append(session_pool.close)
+        return session_pool
+
+    def _load_download_engine(self, yamlconfig):
+        engine = yamlconfig.get('download-engine', 'threads')
+        if engine == 'threads':
+            return None
+        if engine != 'asyncio':
+            raise PystemonConfigException("invalid download-engine '{0}', expecting threads or asyncio".format(engine))
+        try:
+            importlib.import_module('aiohttp')
+        except ImportError as e:
+            raise PystemonConfigException("download-engine asyncio requires aiohttp: {0}".format(e))
+        try:
+            executor_threads = int(yamlconfig.get('executor-threads', 4))
+            if executor_threads < 1:
+                raise Exception("minimum acceptable value is 1")
+        except Exception as e:
+            raise PystemonConfigException("invalid executor-threads value: {0}".format(e))
+        return {'executor_threads': executor_threads}
+
+    def _load_worker_pool(self, yamlconfig):
+        pool = yamlconfig.get('worker-pool', {})
+        if not pool.get('enable', False):
+            return None
+        try:
+            threads = int(pool.get('threads', 8))
+            if threads < 1:
+                raise Exception("minimum acceptable value is 1")
+        except Exception as e:
+            raise PystemonConfigException("invalid worker-pool threads value: {0}".format(e))
+        return {'threads': threads}
+
+    def _load_autoscale(self, yamlconfig):
+        autoscale = yamlconfig.get('autoscale', {})
+        if not autoscale.get('enable', False):
+            return None
+        try:
+            interval = float(autoscale.get('interval', 30))
+            if interval <= 0:
+                raise Exception("expecting a positive value")
+        except Exception as e:
+            raise PystemonConfigException("invalid autoscale interval value: {0}".format(e))
+        return {'interval': interval}
+
+    def _load_queue_journal(self, yamlconfig):
+        journal = yamlconfig.get('queue-journal', {})
+        if not journal.get('enable', False):
+            return None
+        try:
+            directory = journal['dir']
+            commit_interval = float(journal.get('commit-interval', 1))
+            commit_batch = int(journal.get('commit-batch', 1000))
+            if commit_interval < 0 or commit_batch < 1:
+                raise Exception("commit-interval must not be negative and commit-batch must be positive")
+            if not os.path.isdir(directory):
+                logger.debug("creating queue journal directory '{0}'".format(directory))
+                os.makedirs(directory)
+        except Exception as e:
+            raise PystemonConfigException("invalid queue-journal configuration: {0}".format(e))
+        return {'dir': directory, 'commit_interval': commit_interval, 'commit_batch': commit_batch}
+
+    def _load_sites(self, yamlconfig, queue_journal=None):
         # Build array of enabled sites.
         sites_enabled = []
         count_enabled = 0
@@ -427,15 +976,51 @@ class PystemonConfig():
                 new_site = None
                 try:
                     count_enabled = count_enabled + 1
-                    new_site = SiteConfig(site, yamlconfig['site'][site])
+                    new_site = SiteConfig(site, yamlconfig['site'][site], queue_journal)
                     if new_site in self._sites:
                         i = self._sites.index(new_site)
                         logger.debug("found {} in running configuration".format(repr(new_site)))
                         current_site = self._sites[i]
                         logger.debug("matching running site: {}".format(current_site))
-                        q = current_site.queue
-                        logger.debug("running queue size: {}".format(q.qsize()))
-                        new_site.queue = q
+                        new_site.archive_cache = current_site.archive_cache
+                        new_site.stats = current_site.stats
+                        if new_site.throttler is not None:
+                            if current_site.throttler is not None:
+                                # keep the tokens of the running configuration
+                                self._pending.on_commit.append(lambda t=current_site.throttler, s=new_site:
+                                        t.configure(s.throttling, s.throttling_burst))
+                                new_site.throttler = current_site.throttler
+                            else:
+                                new_site.throttler.stats = new_site.stats
+                        if new_site.breaker is not None:
+                            if current_site.breaker is not None:
+                                # a site paused stays paused
+                                self._pending.on_commit.append(lambda b=current_site.breaker, s=new_site:
+                                        b.configure(**s.breaker_config))
+                                new_site.breaker = current_site.breaker
+                            else:
+                                new_site.breaker.stats = new_site.stats
+                                self._pending.on_commit.append(lambda s=new_site:
+                                        s.stats.set('breaker', s.breaker.state))
+                        elif current_site.breaker is not None:
+                            self._pending.on_commit.append(lambda s=new_site: s.stats.set('breaker', 'disabled'))
+                        if new_site.same_queue(current_site):
+                            q = current_site.queue
+                            logger.debug("running queue size: {}".format(q.qsize()))
+                            new_site.inherit_queue(q)
+                            self._pending.on_commit.append(new_site.configure_queue)
+                        else:
+                            # the pasties of the running queue are moved once its site is stopped
+                            logger.info("{0}: queue-journal changed, using a new queue".format(repr(new_site)))
+                        if new_site.scheduler is not None and current_site.scheduler is not None:
+                            if new_site.fingerprint == current_site.fingerprint:
+                                # the PastieSite may be kept running with it
+                                new_site.scheduler = current_site.scheduler
+                            else:
+                                new_site.scheduler.inherit(current_site.scheduler)
+                    if new_site._queue is None:
+                        # a new queue, opened when the site is built
+                        self._pending.on_rollback.append(lambda s=new_site: s._queue is not None and s._queue.close())
                     sites_enabled.append(new_site)
                 except Exception as e:
                     logger.error("Unable to add site '{0}': {1}".format(site, e))
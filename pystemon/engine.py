@@ -0,0 +1,222 @@
+import logging.handlers
+import importlib
+import re
+import threading
+
+logger = logging.getLogger('pystemon')
+
+class RegexEngine():
+    '''
+    Regular expression engine used by PastieSearch.
+
+    Patterns are compiled from bytes with the flags of the 're' module, and
+    the compiled objects behave like the ones of 're' for findall, search
+    and finditer, including their pos argument. 'module' is the python
+    module used for everything else, such as parsing the archive pages.
+    '''
+    name = 're'
+    modname = 're'
+    # whether the pattern syntax can be parsed by the 're' module (prefilter)
+    prefilter = True
+
+    IGNORECASE = re.IGNORECASE
+    MULTILINE = re.MULTILINE
+    DOTALL = re.DOTALL
+    VERBOSE = re.VERBOSE
+
+    def __init__(self):
+        self.engine = importlib.import_module(self.modname)
+        self.module = self.engine
+
+    def __repr__(self):
+        return "RegexEngine[{0}]".format(self.name)
+
+    def compile(self, pattern, flags):
+        return self.engine.compile(pattern, flags)
+
+    def count(self, compiled, data):
+        return len(compiled.findall(data))
+
+    def search(self, compiled, data, pos=0):
+        return compiled.search(data, pos) is not None
+
+    def finditer(self, compiled, data, pos=0):
+        return compiled.finditer(data, pos)
+
+    def load(self, compiled):
+        '''
+        Called with the compiled patterns of a configuration, for engines
+        searching all of them at once.
+        '''
+        pass
+
+
+class RegexModuleEngine(RegexEngine):
+    name = 'regex'
+    modname = 'regex'
+    prefilter = False
+
+    def __init__(self):
+        RegexEngine.__init__(self)
+        logger.debug("Setting regex DEFAULT_VERSION to VERSION1")
+        self.engine.DEFAULT_VERSION = self.engine.VERSION1
+
+
+class Re2Engine(RegexEngine):
+    '''
+    Linear time engine, using google-re2. The flags are given inline as
+    RE2 does not know the flags of the 're' module.
+    '''
+    name = 're2'
+    modname = 're2'
+    prefilter = False
+    inline_flags = [(re.IGNORECASE, b'i'), (re.MULTILINE, b'm'), (re.DOTALL, b's')]
+
+    def __init__(self):
+        RegexEngine.__init__(self)
+        self.module = re
+
+    def compile(self, pattern, flags):
+        inline = b''
+        for (flag, letter) in self.inline_flags:
+            if flags & flag:
+                inline = inline + letter
+                flags = flags & ~flag
+        if flags:
+            raise ValueError("unsupported flags {0}".format(flags))
+        if inline:
+            pattern = b'(?' + inline + b')' + pattern
+        return self.engine.compile(pattern)
+
+
+class HyperscanPattern():
+    '''
+    Pattern of the Hyperscan engine. The engine scans a paste once with a
+    database of all its patterns, which only tells which patterns match:
+    counting and iterating over the matches, or searching from a position,
+    is delegated to 're' once Hyperscan found at least one match. These
+    are not immune to catastrophic backtracking, unlike the plain search.
+    '''
+
+    def __init__(self, pattern, flags, hs_flags):
+        self.pattern = pattern
+        self.flags = flags
+        self.hs_flags = hs_flags
+        self.key = (pattern, hs_flags)
+        self.fallback = None
+
+    def __repr__(self):
+        return "HyperscanPattern[{0}]".format(self.pattern)
+
+    def _re(self):
+        if self.fallback is None:
+            self.fallback = re.compile(self.pattern, self.flags)
+        return self.fallback
+
+
+class HyperscanEngine(RegexEngine):
+    '''
+    Hyperscan engine, all the patterns searched with it are compiled into a
+    single database, rebuilt when a new pattern is searched for the first
+    time. Each thread scans a paste once with it and remembers the patterns
+    found in its last paste, with a scratch space of its own.
+    '''
+    name = 'hyperscan'
+    modname = 'hyperscan'
+    prefilter = False
+
+    def __init__(self):
+        RegexEngine.__init__(self)
+        self.module = re
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.ids = {}
+        self.expressions = []
+        self.db = None
+
+    def compile(self, pattern, flags):
+        hs = self.engine
+        hs_flags = hs.HS_FLAG_SINGLEMATCH | hs.HS_FLAG_ALLOWEMPTY
+        re_flags = flags
+        for (flag, hs_flag) in [(re.IGNORECASE, hs.HS_FLAG_CASELESS),
+                (re.MULTILINE, hs.HS_FLAG_MULTILINE), (re.DOTALL, hs.HS_FLAG_DOTALL)]:
+            if flags & flag:
+                hs_flags = hs_flags | hs_flag
+                flags = flags & ~flag
+        if flags:
+            raise ValueError("unsupported flags {0}".format(flags))
+        # make sure Hyperscan supports the pattern before adding it to the shared database
+        db = hs.Database()
+        db.compile(expressions=[pattern], ids=[0], elements=1, flags=[hs_flags])
+        return HyperscanPattern(pattern, re_flags, hs_flags)
+
+    def _build(self, expressions):
+        db = self.engine.Database()
+        db.compile(expressions=[pattern for (pattern, hs_flags) in expressions],
+                ids=list(range(len(expressions))), elements=len(expressions),
+                flags=[hs_flags for (pattern, hs_flags) in expressions])
+        logger.debug("{0}: compiled {1} pattern(s)".format(self, len(expressions)))
+        self.expressions = expressions
+        self.ids = dict([(key, i) for (i, key) in enumerate(expressions)])
+        self.db = db
+
+    def load(self, compiled):
+        expressions = []
+        for c in compiled:
+            if c.key not in expressions:
+                expressions.append(c.key)
+        with self.lock:
+            if expressions:
+                self._build(expressions)
+
+    def _database(self, compiled):
+        ''' returns the database and the id of compiled in it '''
+        with self.lock:
+            if compiled.key not in self.ids:
+                # not given to load(), rebuild the database with it
+                self._build(self.expressions + [compiled.key])
+            return (self.db, self.ids[compiled.key])
+
+    def scan(self, compiled, data):
+        (db, i) = self._database(compiled)
+        local = self.local
+        if getattr(local, 'db', None) is not db:
+            local.db = db
+            local.scratch = self.engine.Scratch(db)
+            local.data = None
+        if local.data is not data:
+            # first pattern searched in this paste, find all of them at once
+            found = set()
+            def on_match(id, start, end, flags, context):
+                found.add(id)
+            db.scan(data, match_event_handler=on_match, scratch=local.scratch)
+            local.data = data
+            local.found = found
+        return i in local.found
+
+    def count(self, compiled, data):
+        if not self.scan(compiled, data):
+            return 0
+        return len(compiled._re().findall(data))
+
+    def search(self, compiled, data, pos=0):
+        if pos:
+            return compiled._re().search(data, pos) is not None
+        return self.scan(compiled, data)
+
+    def finditer(self, compiled, data, pos=0):
+        if not self.scan(compiled, data):
+            return iter([])
+        return compiled._re().finditer(data, pos)
+
+
+ENGINES = dict([(engine.name, engine) for engine in
+    [RegexEngine, RegexModuleEngine, Re2Engine, HyperscanEngine]])
+
+def load_engine(name):
+    '''
+    Returns an instance of the regular expression engine 'name', raises
+    KeyError if the engine is unknown and ImportError if its python module
+    is not installed.
+    '''
+    return ENGINES[name]()
@@ -19,3 +19,6 @@ class PystemonReloadRequested(PystemonException):
 
 class PystemonQueueStatRequested(PystemonException):
     pass
+
+class PystemonPatternStatRequested(PystemonException):
+    pass
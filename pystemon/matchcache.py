@@ -0,0 +1,116 @@
+import logging.handlers
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger('pystemon')
+
+class PastieMatchCache():
+    '''
+    Bounded LRU cache of the match results, keyed by the md5 of the pastie
+    content, so identical pasties are only searched once. The cache is
+    emptied when the set of patterns changes, and can be persisted to a
+    file between restarts.
+    '''
+
+    def __init__(self, size=10000, filename=None, suppress_alerts=False):
+        self.size = size
+        self.filename = filename
+        self.suppress_alerts = suppress_alerts
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.patterns = []
+        self.indexes = {}
+        self.fingerprint = None
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    def __repr__(self):
+        return 'PastieMatchCache[{0}]'.format(self.size)
+
+    def is_same_as(self, other):
+        return (isinstance(other, PastieMatchCache)
+                and (self.size == other.size)
+                and (self.filename == other.filename))
+
+    def set_patterns(self, engine, patterns):
+        fingerprint = hashlib.md5(json.dumps([engine, [ps.to_dict() for ps in patterns]],
+            sort_keys=True, default=str).encode()).hexdigest()
+        with self.lock:
+            self.patterns = patterns
+            self.indexes = dict([(id(ps), i) for (i, ps) in enumerate(patterns)])
+            if fingerprint != self.fingerprint:
+                if self.entries:
+                    logger.info("{0}: patterns changed, dropping {1} cached result(s)".format(self, len(self.entries)))
+                self.entries.clear()
+                self.fingerprint = fingerprint
+
+    def get(self, md5):
+        ''' returns the cached list of matching patterns, or None '''
+        with self.lock:
+            try:
+                indexes = self.entries.pop(md5)
+            except KeyError:
+                self.misses = self.misses + 1
+                return None
+            if [i for i in indexes if i >= len(self.patterns)]:
+                # does not fit the patterns, e.g. a corrupted cache file
+                self.misses = self.misses + 1
+                return None
+            self.entries[md5] = indexes
+            self.hits = self.hits + 1
+            return [self.patterns[i] for i in indexes]
+
+    def put(self, md5, matches, patterns):
+        '''
+        caches the matches of the pastie searched with patterns, unless
+        the patterns were replaced by set_patterns() in the meantime
+        '''
+        with self.lock:
+            self.entries.pop(md5, None)
+            if patterns is not self.patterns or [ps for ps in matches if id(ps) not in self.indexes]:
+                logger.debug("{0}: not caching a result of replaced patterns".format(self))
+                return
+            self.entries[md5] = [self.indexes[id(ps)] for ps in matches]
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def stats_to_text(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            rate = 0
+            if lookups:
+                rate = 100.0 * self.hits / lookups
+            return "{0}: entries={1} hits={2} misses={3} hit rate={4:.1f}%".format(
+                self, len(self.entries), self.hits, self.misses, rate)
+
+    def load(self):
+        if not self.filename or not os.path.exists(self.filename):
+            return
+        try:
+            with open(self.filename) as f:
+                data = json.load(f)
+            with self.lock:
+                self.fingerprint = data['fingerprint']
+                for (md5, indexes) in data['entries'][-self.size:]:
+                    self.entries[md5] = indexes
+            logger.debug("{0}: loaded {1} result(s) from '{2}'".format(self, len(self.entries), self.filename))
+        except Exception as e:
+            logger.error("{0}: unable to load '{1}': {2}".format(self, self.filename, e))
+
+    def save(self):
+        if not self.filename:
+            return
+        try:
+            with self.lock:
+                data = {'fingerprint': self.fingerprint, 'entries': list(self.entries.items())}
+            tmp = self.filename + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(data, f)
+            os.rename(tmp, self.filename)
+            logger.debug("{0}: saved {1} result(s) to '{2}'".format(self, len(data['entries']), self.filename))
+        except Exception as e:
+            logger.error("{0}: unable to save '{1}': {2}".format(self, self.filename, e))
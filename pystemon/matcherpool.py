@@ -0,0 +1,157 @@
+import logging.handlers
+import multiprocessing
+import threading
+import time
+from pystemon.engine import load_engine
+from pystemon.pastiesearch import PastieSearch, load_patterns, cpu_time
+from pystemon.prefilter import PastiePrefilter
+
+logger = logging.getLogger('pystemon')
+
+# state of the matcher processes, set once by _init_worker
+_patterns = []
+_indexes = {}
+_prefilter = None
+
+def _init_worker(engine, regexes, prefilter):
+    global _patterns, _indexes, _prefilter
+    regex_engine = load_engine(engine)
+    _patterns = [PastieSearch(regex_engine, regex) for regex in regexes]
+    load_patterns(regex_engine, _patterns)
+    _indexes = dict([(id(ps), i) for (i, ps) in enumerate(_patterns)])
+    _prefilter = None
+    if prefilter:
+        _prefilter = PastiePrefilter(_patterns)
+
+def _match(content, quarantined):
+    patterns = _patterns
+    if _prefilter is not None:
+        patterns = _prefilter.candidates(content)
+    # the statistics and quarantine of the patterns are kept by the parent
+    evaluations = []
+    for ps in patterns:
+        i = _indexes[id(ps)]
+        if i in quarantined:
+            continue
+        start = cpu_time()
+        matched = ps.evaluate(content)
+        evaluations.append((i, cpu_time() - start, matched))
+    return evaluations
+
+
+class ThreadMatcherPool(threading.Thread):
+    '''
+    Evaluates the search patterns in a pool of processes, so regex matching
+    is not serialized by the GIL nor competing with the download threads.
+    The patterns are sent once to each process when the pool starts, a new
+    pool is started on every configuration reload, and whenever a pastie is
+    not matched within timeout seconds (e.g. a worker process died).
+    '''
+
+    def __init__(self, engine, patterns, processes=0, max_inflight=64*1024*1024, prefilter=False, timeout=60):
+        threading.Thread.__init__(self)
+        self.name = 'ThreadMatcherPool'
+        self.engine = engine
+        self.patterns = patterns
+        self.processes = processes or multiprocessing.cpu_count()
+        self.max_inflight = max_inflight
+        self.prefilter = prefilter
+        self.timeout = timeout
+        self.inflight = 0
+        self.pool = None
+        self.condition = threading.Condition()
+        self.kill_received = False
+
+    def __repr__(self):
+        return '{0}[{1}]'.format(self.name, self.processes)
+
+    def stop(self):
+        with self.condition:
+            logger.info('{0}: exiting'.format(self.name))
+            self.kill_received = True
+            self.condition.notify_all()
+
+    def _start_pool(self):
+        regexes = [ps.to_dict() for ps in self.patterns]
+        try:
+            # do not fork a process running many threads
+            context = multiprocessing.get_context('spawn')
+        except AttributeError:
+            context = multiprocessing
+        return context.Pool(self.processes, _init_worker,
+                (self.engine, regexes, self.prefilter))
+
+    def _stop_pool(self, pool):
+        pool.terminate()
+        pool.join()
+
+    def run(self):
+        logger.info('{0}: starting {1} process(es) ...'.format(self.name, self.processes))
+        try:
+            with self.condition:
+                self.pool = self._start_pool()
+                logger.info('{0}: started'.format(self.name))
+                self.condition.notify_all()
+                while not self.kill_received:
+                    if self.pool is None:
+                        # a pastie timed out, the pool was dropped by match()
+                        logger.info('{0}: restarting {1} process(es) ...'.format(self.name, self.processes))
+                        self.pool = self._start_pool()
+                        self.condition.notify_all()
+                    self.condition.wait(1)
+        except Exception as e:
+            logger.error('{0} crashed: {1}'.format(self.name, e))
+        with self.condition:
+            self.kill_received = True
+            if self.pool is not None:
+                self._stop_pool(self.pool)
+            self.condition.notify_all()
+        logger.info('{0}: exited'.format(self.name))
+
+    def match(self, content):
+        '''
+        Returns the list of patterns matching content, or None if the pool
+        is not available and the caller should do the matching itself.
+        '''
+        size = len(content)
+        with self.condition:
+            # bound the amount of content waiting to be matched
+            while not self.kill_received and (self.pool is None or
+                    (self.inflight > 0 and self.inflight + size > self.max_inflight)):
+                self.condition.wait(1)
+            if self.kill_received:
+                return None
+            self.inflight = self.inflight + size
+            quarantined = set([i for (i, ps) in enumerate(self.patterns) if ps.quarantined])
+            pool = self.pool
+            result = pool.apply_async(_match, (content, quarantined))
+        deadline = time.time() + self.timeout
+        try:
+            while True:
+                try:
+                    evaluations = result.get(1)
+                    break
+                except multiprocessing.TimeoutError:
+                    stale = None
+                    with self.condition:
+                        if self.kill_received or self.pool is not pool:
+                            # stopping, or the pool was replaced: its results are lost
+                            return None
+                        if time.time() > deadline:
+                            logger.error('{0}: no result after {1}s, restarting the pool'.format(self.name, self.timeout))
+                            stale = self.pool
+                            self.pool = None
+                            self.condition.notify_all()
+                    if stale is not None:
+                        self._stop_pool(stale)
+                        return None
+        finally:
+            with self.condition:
+                self.inflight = self.inflight - size
+                self.condition.notify_all()
+        matches = []
+        for (i, elapsed, matched) in evaluations:
+            self.patterns[i].record(elapsed, size, matched)
+            if matched:
+                matches.append(self.patterns[i])
+        return matches
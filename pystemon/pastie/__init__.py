@@ -1,7 +1,14 @@
 import logging.handlers
+import atexit
 import hashlib
+import io
+import os
+import shutil
+import tempfile
 import time
 import threading
+import traceback
+from pystemon.pastiesearch import PastieSearchStream
 
 try:
     from queue import Queue
@@ -14,6 +21,18 @@ except ImportError:
 
 logger = logging.getLogger('pystemon')
 
+# protects the content, holders and spill file of all the pasties
+content_lock = threading.Lock()
+# directory of the spilled contents, removed on exit
+spill_dir = None
+
+def get_spill_dir():
+    global spill_dir
+    if spill_dir is None:
+        spill_dir = tempfile.mkdtemp(prefix='pystemon-')
+        atexit.register(shutil.rmtree, spill_dir, True)
+    return spill_dir
+
 class ThreadPasties(threading.Thread):
     '''
     Instances of these threads are responsible for downloading the pastes
@@ -35,6 +54,13 @@ class ThreadPasties(threading.Thread):
             self.user_agent.stop()
             self.condition.notify_all()
 
+    def retire(self):
+        ''' exits once the current download is done '''
+        with self.condition:
+            logger.info('{}: retiring'.format(self.name))
+            self.kill_received = True
+            self.condition.notify_all()
+
     def run(self):
         logger.info('{}: started'.format(self.name))
         while True:
@@ -56,28 +82,110 @@ class ThreadPasties(threading.Thread):
                 logger.debug("{}: Queue size: {}".format(self.name, self.queue.qsize()))
                 # just to be on the safe side of the gc
                 if pastie is not None:
-                    del(pastie)
                     # signals to queue job is done
-                    self.queue.task_done()
+                    self.queue.done(pastie)
+                    del(pastie)
         logger.info('{}: exited'.format(self.name))
 
-class Pastie():
+class Pastie(object):
+    '''
+    A pastie of a site. The urls and the filename are derived from the site
+    and the id when used, so the pasties waiting to be downloaded are small.
+
+    The content is released once the last of its consumers is done: the
+    download thread holds the pastie until process_pastie() is done, and
+    each storage thread saving it asynchronously calls hold() and
+    release(). Meanwhile the content may be spilled to a temporary file.
+    '''
+
+    __slots__ = ['site', 'id', '_content', '_spill', 'holders', 'pastie_metadata',
+            'matches', 'matched', 'stream_matches', 'duplicate', 'md5', 'user_agent',
+            'fetch_start_time', 'fetch_end_time']
 
     def __init__(self, site, pastie_id):
         self.site = site
         self.id = pastie_id
-        self.pastie_content = None
+        self._content = None
+        self._spill = None
+        self.holders = 1
         self.pastie_metadata = None
-        self.matches = []
+        self.matches = ()
         self.matched = False
+        self.stream_matches = None
+        self.duplicate = False
         self.md5 = None
-        self.url = self.site.download_url.format(id=self.id)
-        self.public_url = self.site.public_url.format(id=self.id)
-        self.metadata_url = None
-        if self.site.metadata_url is not None:
-            self.metadata_url = self.site.metadata_url.format(id=self.id)
-        self.filename = self.site.pastie_id_to_filename(self.id)
         self.user_agent = None
+        self.fetch_start_time = None
+        self.fetch_end_time = None
+
+    @property
+    def url(self):
+        return self.site.download_url.format(id=self.id)
+
+    @property
+    def public_url(self):
+        return self.site.public_url.format(id=self.id)
+
+    @property
+    def metadata_url(self):
+        if self.site.metadata_url is None:
+            return None
+        return self.site.metadata_url.format(id=self.id)
+
+    @property
+    def filename(self):
+        return self.site.pastie_id_to_filename(self.id)
+
+    @property
+    def pastie_content(self):
+        content = self._content
+        if content is None and self._spill is not None:
+            with content_lock:
+                if self._spill is not None:
+                    with open(self._spill, 'rb') as f:
+                        content = f.read()
+        return content
+
+    @pastie_content.setter
+    def pastie_content(self, content):
+        self._content = content
+
+    def hold(self):
+        ''' one more consumer of the content, see release() '''
+        with content_lock:
+            self.holders = self.holders + 1
+
+    def release(self):
+        ''' a consumer is done with the pastie, the last one releases the content '''
+        with content_lock:
+            self.holders = self.holders - 1
+            if self.holders > 0:
+                return
+            self._content = None
+            self.pastie_metadata = None
+            spill = self._spill
+            self._spill = None
+        if spill is not None:
+            try:
+                os.remove(spill)
+            except OSError as e:
+                logger.error('Pastie {site} {id}: unable to remove {f}: {e}'.format(
+                    site=self.site.name, id=self.id, f=spill, e=e))
+
+    def spill(self, size=0):
+        ''' keeps the content in a temporary file if bigger than size bytes '''
+        with content_lock:
+            content = self._content
+            if not isinstance(content, bytes) or len(content) <= size or self._spill is not None:
+                return False
+            (fd, filename) = tempfile.mkstemp(dir=get_spill_dir())
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            self._spill = filename
+            self._content = None
+        logger.debug('Pastie {site} {id}: {b}B spilled to {f}'.format(
+            site=self.site.name, id=self.id, b=len(content), f=filename))
+        return True
 
     def hash_pastie(self):
         if self.pastie_content:
@@ -96,18 +204,53 @@ class Pastie():
             if response is not None:
                 response = response.content
                 self.pastie_metadata = response
+                self.site.stats.incr('pastie_bytes', len(response))
         response = self.download_url(self.url)
         if response is not None:
-            response = response.content
+            if self.site.stream_chunk_size:
+                response = self.stream_pastie(response)
+            else:
+                response = response.content
             self.pastie_content = response
+            self.site.stats.incr('pasties')
+            self.site.stats.incr('pastie_bytes', len(response))
         return response
 
+    def stream_pastie(self, response):
+        '''
+        Consume the body chunk by chunk, matching the search patterns
+        while the download is still running.
+        '''
+        stream = PastieSearchStream(self.site.patterns,
+                overlap=self.site.stream_overlap,
+                prefilter=self.site.prefilter)
+        # BytesIO grows a single buffer and getvalue() does not copy it,
+        # joining the chunks would need twice the size of the body
+        content = io.BytesIO()
+        chunks = 0
+        decided = None
+        for chunk in response.iter_content(self.site.stream_chunk_size):
+            # once all the patterns are decided, the rest of the body is
+            # only downloaded for the storage
+            if decided is None:
+                stream.feed(chunk)
+                if stream.done:
+                    decided = stream.size
+            content.write(chunk)
+            chunks = chunks + 1
+        self.stream_matches = stream.close()
+        logger.debug('streamed pastie {id}: {n} chunk(s), {b}B, matched on the first {d}B'.format(
+            id=self.id, n=chunks, b=content.tell(), d=stream.size))
+        return content.getvalue()
+
     def __fetch_pastie__(self):
         logger.debug('fetching pastie {0}'.format(self.id))
         try:
             self.fetch_start_time = time.time()
             content = self.fetch_pastie()
             delta = self.fetch_end_time = time.time()
+            self.site.stats.incr('fetches')
+            self.site.stats.incr('fetch_seconds', self.fetch_end_time - self.fetch_start_time)
             if content is None:
                 logger.debug('failed to fetch pastie {id}'.format(id=self.id))
             elif len(content) == 0:
@@ -137,25 +280,54 @@ class Pastie():
         self.user_agent = user_agent
         # download pastie
         self.__fetch_pastie__()
+        self.process_pastie()
+
+    def process_pastie(self):
+        ''' search, save and alert on the downloaded pastie, then release it '''
+        try:
+            if self.__process_pastie__():
+                # remembered across restarts only once processed
+                self.site.seen_index.persist(self.site.site, self.id)
+        finally:
+            self.release()
+
+    def __process_pastie__(self):
+        ''' returns True if the pastie was searched and handed to the storage '''
         # check pastie
         if self.pastie_content is None:
-            return
+            return False
+        # take checksum
+        self.hash_pastie()
+        # search for data in pastie, unless the same content was seen before
         try:
-            # take checksum
-            self.hash_pastie()
-            # search for data in pastie
-            self.search_content()
+            cached = self.search_cache()
         except Exception as e:
-            logger.error('ERROR: unable to process pastie {0} for site {1}: {2}'.format(
+            logger.error('ERROR: match cache lookup failed for pastie {0} for site {1}: {2}'.format(
                 self.id, self.site.name, e))
-            return
+            cached = False
+        if not cached:
+            try:
+                self.search_content()
+            except Exception as e:
+                logger.error('ERROR: unable to process pastie {0} for site {1}: {2}'.format(
+                    self.id, self.site.name, e))
+                return False
+            try:
+                if self.site.match_cache is not None and self.md5:
+                    self.site.match_cache.put(self.md5, self.matches, self.site.patterns)
+            except Exception as e:
+                logger.error('ERROR: unable to cache the matches of pastie {0} for site {1}: {2}'.format(
+                    self.id, self.site.name, e))
         try:
             self.save_pastie()
         except Exception as e:
             logger.error('ERROR: unable to save pastie {0} for site {1}: {2}'.format(
                 self.id, self.site.name, e))
         try:
-            if self.matches:
+            if self.matches and self.duplicate and self.site.match_cache.suppress_alerts:
+                logger.info('Duplicate hit for {matches} in pastie {url}, alert suppressed'.format(
+                    matches=self.matches_to_text(), url=self.public_url))
+            elif self.matches:
                 # alerting
                 self.action_on_match()
             else:
@@ -163,17 +335,49 @@ class Pastie():
                 self.action_on_miss()
         except Exception as e:
             logger.error("ERROR: on post-action for pastie {0}: {1}".format(self.id, e))
+        return True
+
+    def search_cache(self):
+        ''' reuse the result of a previous pastie with the same content '''
+        if self.site.match_cache is None or not self.md5:
+            return False
+        matches = self.site.match_cache.get(self.md5)
+        if matches is None:
+            return False
+        logger.debug('Pastie {site} {id} has known content, reusing previous result'.format(site=self.site.name, id=self.id))
+        self.duplicate = True
+        self.matches = matches
+        self.matched = len(self.matches) > 0
+        return True
 
     def search_content(self):
         if not self.pastie_content:
             raise SystemExit('BUG: Content not set, cannot search')
         logger.debug('Looking for matches in pastie {url}'.format(url=self.public_url))
+        if self.stream_matches is not None:
+            # already matched while downloading
+            self.matches = list(self.stream_matches)
+            self.matched = len(self.matches) > 0
+            return
+        if self.site.matcher_pool is not None:
+            matches = self.site.matcher_pool.match(self.pastie_content)
+            if matches is not None:
+                self.matches = matches
+                self.matched = len(self.matches) > 0
+                return
+        content = self.pastie_content
+        patterns = self.site.patterns
+        if self.site.prefilter is not None:
+            # only keep the patterns whose literals are present
+            patterns = self.site.prefilter.candidates(content)
         # search for the regexes in the htmlPage
-        for regex in self.site.patterns:
-            if regex.match(self.pastie_content):
+        matches = []
+        for regex in patterns:
+            if regex.match(content):
                 # we have a match, add to match list
-                self.matches.append(regex)
+                matches.append(regex)
                 self.matched = True
+        self.matches = matches
 
     def action_on_match(self):
         msg = 'Found hit for {matches} in pastie {url}'.format(
@@ -1,28 +1,80 @@
 import logging.handlers
+import re
+import threading
+import time
+from pystemon.engine import load_engine
 logger = logging.getLogger('pystemon')
 
+# CPU time of the calling thread, when available
+try:
+    cpu_time = time.thread_time
+except AttributeError:
+    cpu_time = time.time
+
+class PastieSearchCache():
+    '''
+    Compiled regexes kept across configuration reloads, keyed by
+    (engine, search, exclude, flags), so only new or changed patterns
+    are compiled again.
+    '''
+
+    def __init__(self):
+        self.entries = {}
+        self.start()
+
+    def start(self):
+        self.used = set()
+        self.reused = 0
+        self.compiled = 0
+
+    def get(self, key, compile):
+        if key in self.entries:
+            self.reused = self.reused + 1
+        else:
+            self.entries[key] = compile()
+            self.compiled = self.compiled + 1
+        self.used.add(key)
+        return self.entries[key]
+
+    def finish(self):
+        ''' drop the entries unused since start(), returns how many '''
+        dropped = [key for key in self.entries if key not in self.used]
+        for key in dropped:
+            del self.entries[key]
+        return len(dropped)
+
+def load_patterns(engine, patterns):
+    '''
+    Gives the engine the compiled regexes of all the patterns using it,
+    to be called once the patterns of a configuration are compiled.
+    '''
+    compiled = []
+    for ps in patterns:
+        if ps.engine is engine:
+            compiled.extend([c for c in [ps.re_search, ps.re_exclude] if c is not None])
+    engine.load(compiled)
+
 class PastieSearch():
-    def __init__(self, engine, regex):
+    def __init__(self, engine, regex, time_budget=0, quarantine=3, cache=None):
         # set the re.FLAGS
         if 'regex-flags' in regex:
             self.regex_flags = regex['regex-flags']
-            self.flags = eval(self.regex_flags)
+            self.flags = eval(self.regex_flags, {'re': re, engine.module.__name__: engine.module})
         else:
             self.regex_flags = None
             self.flags = engine.IGNORECASE
-        # compile the search regex
         self.search = regex['search']
-        try:
-            self.re_search = engine.compile(self.search.encode(), self.flags)
-        except Exception as e:
-            raise ValueError("invalid search regex: %s" % e)
-        # compile the exclude regex
         self.exclude = regex.get('exclude')
-        if self.exclude is not None:
-            try:
-                self.re_exclude = engine.compile(self.exclude.encode(), self.flags)
-            except Exception as e:
-                raise ValueError("invalid exclude regex: %s" % e)
+        # compile the regexes, falling back to 're' if the engine cannot
+        if cache is not None:
+            compiled = cache.get((engine.name, self.search, self.exclude, self.flags),
+                    lambda: self._compile(engine))
+        else:
+            compiled = self._compile(engine)
+        (self.engine, self.fallback, self.re_search, self.re_exclude) = compiled
+        if self.engine.name == engine.name:
+            # cached by a previous instance of the engine
+            self.engine = engine
         # get the description
         self.description = regex.get('description')
         # get the count and convert it to integer
@@ -43,8 +95,48 @@ class PastieSearch():
                 continue
             self.extra[k] = v
         self.h = None
+        # time budget in ms of a single evaluation, the pattern is
+        # quarantined after exceeding it 'quarantine' times
+        self.time_budget = float(regex.get('time-budget', time_budget)) / 1000
+        self.quarantine = quarantine
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.hits = 0
+        self.total_time = 0
+        self.worst_time = 0
+        self.worst_size = 0
+        self.strikes = 0
+        self.quarantined = False
         logger.debug("[{0}]: compiled into: {1}".format(self.search, self.re_search))
 
+    def _compile(self, engine):
+        fallback = None
+        try:
+            (re_search, re_exclude) = self._compile_with(engine)
+        except ValueError as e:
+            if engine.name == 're':
+                raise
+            fallback = str(e)
+            engine = load_engine('re')
+            logger.debug("[{0}]: falling back to 're': {1}".format(self.search, e))
+            (re_search, re_exclude) = self._compile_with(engine)
+        return (engine, fallback, re_search, re_exclude)
+
+    def _compile_with(self, engine):
+        # compile the search regex
+        try:
+            re_search = engine.compile(self.search.encode(), self.flags)
+        except Exception as e:
+            raise ValueError("invalid search regex: %s" % e)
+        # compile the exclude regex
+        re_exclude = None
+        if self.exclude is not None:
+            try:
+                re_exclude = engine.compile(self.exclude.encode(), self.flags)
+            except Exception as e:
+                raise ValueError("invalid exclude regex: %s" % e)
+        return (re_search, re_exclude)
+
     def __str__(self):
         return self.to_text()
 
@@ -52,20 +144,70 @@ class PastieSearch():
         return self.to_regex()
 
     def match(self, string):
-        m = self.re_search.findall(string)
-        if not m:
+        if self.quarantined:
             return False
-        # the regex matches the text
-        # ignore if not enough counts
-        if (self.count > 0) and (len(m) < self.count):
+        start = cpu_time()
+        res = self.evaluate(string)
+        self.record(cpu_time() - start, len(string), res)
+        return res
+
+    def record(self, elapsed, size, matched):
+        ''' account for one evaluation of the pattern over size bytes '''
+        with self.lock:
+            self.calls = self.calls + 1
+            if matched:
+                self.hits = self.hits + 1
+            self.total_time = self.total_time + elapsed
+            if elapsed > self.worst_time:
+                self.worst_time = elapsed
+                self.worst_size = size
+            if not self.time_budget or elapsed <= self.time_budget or self.quarantined:
+                return
+            self.strikes = self.strikes + 1
+            logger.warning("[{0}]: {1:.3f}s spent on {2}B, exceeding the time budget of {3}s ({4}/{5})".format(
+                self.search, elapsed, size, self.time_budget, self.strikes, self.quarantine))
+            if self.strikes >= self.quarantine:
+                self.quarantined = True
+                logger.error("[{0}]: pattern quarantined, it will not be evaluated anymore".format(self.search))
+
+    def release(self):
+        ''' gives a quarantined pattern another chance, on configuration reload '''
+        with self.lock:
+            if self.quarantined:
+                logger.info("[{0}]: pattern released from quarantine".format(self.search))
+            self.strikes = 0
+            self.quarantined = False
+
+    def stats_to_text(self):
+        with self.lock:
+            return "[{0}]: calls={1} hits={2} cpu={3:.3f}s worst={4:.3f}s on {5}B strikes={6}{7}".format(
+                self.search, self.calls, self.hits, self.total_time,
+                self.worst_time, self.worst_size, self.strikes,
+                " QUARANTINED" if self.quarantined else "")
+
+    def evaluate(self, string):
+        if self.count > 0:
+            # ignore if not enough counts
+            if self.engine.count(self.re_search, string) < self.count:
+                return False
+        elif not self.engine.search(self.re_search, string):
             return False
+        # the regex matches the text
         # ignore if exclude
         if self.exclude is not None:
-            if self.re_exclude.search(string):
+            if self.engine.search(self.re_exclude, string):
                 return False
         # we have a match
         return True
 
+    def finditer(self, string, pos=0):
+        ''' the matches of the search regex in string, from pos '''
+        return self.engine.finditer(self.re_search, string, pos)
+
+    def excluded(self, string, pos=0):
+        ''' whether the exclude regex matches string, from pos '''
+        return self.exclude is not None and self.engine.search(self.re_exclude, string, pos)
+
     def to_text(self):
         if self.description is None:
             return self.search
@@ -91,5 +233,109 @@ class PastieSearch():
                 self.h[k] = v
         return self.h
 
+class PastieSearchState():
+    ''' Matching state of one PastieSearch over a stream of chunks '''
 
+    def __init__(self, search):
+        self.search = search
+        self.pos = 0
+        self.count = 0
+        self.excluded = False
+        self.decided = search.quarantined
+        self.elapsed = 0
+
+    @property
+    def matched(self):
+        if self.excluded or not self.count:
+            return False
+        return (self.search.count <= 0) or (self.count >= self.search.count)
+
+class PastieSearchStream():
+    '''
+    Matches the search patterns on a pastie while it is being downloaded.
+
+    The body is consumed chunk by chunk and only the last 'overlap' bytes
+    are kept between chunks, so matches shorter than the overlap window are
+    found even when they cross a chunk boundary. Up to 'overlap' bytes
+    scanned before are also kept in front of the buffer and the search
+    starts after them, so ^, \\b and lookbehinds see the actual bytes
+    preceding the unscanned part instead of a start of string. Count
+    thresholds and exclude regexes apply to the whole stream. A pattern is
+    decided as soon as its count is reached (and it has no exclude) or its
+    exclude matched, and the stream is done once all the patterns are
+    decided.
+    '''
+
+    def __init__(self, patterns, overlap=4096, prefilter=None):
+        self.overlap = overlap
+        self.prefilter = prefilter
+        self.states = [PastieSearchState(ps) for ps in patterns]
+        self.buf = b''
+        # bytes of buf already scanned and only kept as context
+        self.context = 0
+        self.size = 0
+
+    @property
+    def done(self):
+        for state in self.states:
+            if not state.decided:
+                return False
+        return True
+
+    def feed(self, chunk):
+        self.size += len(chunk)
+        if self.done:
+            return
+        self.buf = self.buf + chunk
+        self._scan(final=False)
+
+    def close(self):
+        ''' returns the list of the patterns that matched the whole stream '''
+        if not self.done:
+            self._scan(final=True)
+        self.buf = b''
+        for state in self.states:
+            if state.elapsed:
+                state.search.record(state.elapsed, self.size, state.matched)
+        return [state.search for state in self.states if state.matched]
+
+    def _scan(self, final):
+        buf = self.buf
+        cut = len(buf) if final else max(len(buf) - self.overlap, self.context)
+        candidates = None
+        if self.prefilter is not None:
+            candidates = set([id(ps) for ps in self.prefilter.candidates(buf)])
+        for state in self.states:
+            if state.decided:
+                continue
+            start = cpu_time()
+            self._scan_state(state, buf, cut, candidates)
+            state.elapsed = state.elapsed + cpu_time() - start
+        # keep the bytes after the cut, and up to 'overlap' bytes before
+        # it as context
+        keep = max(cut - self.overlap, 0)
+        self.buf = buf[keep:]
+        self.context = cut - keep
+        for state in self.states:
+            state.pos = max(state.pos, cut) - keep
 
+    def _scan_state(self, state, buf, cut, candidates):
+        ps = state.search
+        if ps.quarantined:
+            # quarantined while streaming, as for match()
+            state.count = 0
+            state.decided = True
+            return
+        if ps.excluded(buf, self.context):
+            state.excluded = state.decided = True
+            return
+        if candidates is None or id(ps) in candidates:
+            # only count the matches starting before the cut, the
+            # others will be seen again with the next chunk
+            for m in ps.finditer(buf, max(state.pos, self.context)):
+                if m.start() >= cut:
+                    break
+                state.count += 1
+                state.pos = max(m.end(), m.start() + 1)
+            if state.matched and ps.exclude is None:
+                state.decided = True
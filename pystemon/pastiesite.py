@@ -1,13 +1,20 @@
 
 import logging.handlers
 import threading
+import hashlib
 import time
 import random
 import os
-from collections import deque
+from collections import OrderedDict
 import importlib
+try:
+    from queue import Full
+except ImportError:
+    from Queue import Full
 from pystemon.ua import PystemonUA
 from pystemon.pastie import Pastie
+from pystemon.seenindex import PastieSeenIndex
+from pystemon.stats import PystemonStats
 
 logger = logging.getLogger('pystemon')
 
@@ -29,6 +36,8 @@ class PastieSite(threading.Thread):
         self.public_url = download_url
         self.archive_url = archive_url
         self.archive_regex = archive_regex
+        self.archive_next_url = kwargs.get('site_archive_next_url', None)
+        self.archive_backfill = kwargs.get('site_archive_backfill', 5)
         self.metadata_url = None
         self.condition = threading.Condition()
 
@@ -62,12 +71,29 @@ class PastieSite(threading.Thread):
         self.archive_compress = kwargs.get('archive_compress', False)
         self.update_min = kwargs['site_update_min']
         self.update_max = kwargs['site_update_max']
+        self.scheduler = kwargs.get('scheduler', None)
+        self.last_page_size = 0
         self.queue = kwargs['site_queue']
         self.user_agent = kwargs['site_ua']
         self.patterns = kwargs.get('patterns', [])
+        self.prefilter = kwargs.get('prefilter', None)
+        self.matcher_pool = kwargs.get('matcher_pool', None)
+        self.match_cache = kwargs.get('match_cache', None)
+        stream_search = kwargs.get('stream_search') or {}
+        self.stream_chunk_size = stream_search.get('chunk_size', 0)
+        self.stream_overlap = stream_search.get('overlap', 0)
         self.sendmail = kwargs.get('sendmail', None)
         self.re = kwargs['re']
-        self.seen_pasties = deque('', 1000)  # max number of pasties ids in memory
+        self.seen_index = kwargs.get('seen_index')
+        if self.seen_index is None:
+            self.seen_index = PastieSeenIndex(1000)
+        # validators and checksum of the last archive page, kept across reloads
+        self.archive_cache = kwargs.get('archive_cache')
+        if self.archive_cache is None:
+            self.archive_cache = {}
+        self.stats = kwargs.get('stats')
+        if self.stats is None:
+            self.stats = PystemonStats(name)
         self.storage = None
         pastie_classname = kwargs['site_pastie_classname']
         if pastie_classname:
@@ -114,25 +140,30 @@ class PastieSite(threading.Thread):
         logger.info('{}: Thread started'.format(self.name))
         try:
             with self.condition:
+                # pasties left in the queue by a previous run
+                recovered = self.queue.recover(self.new_pastie)
+                if recovered:
+                    logger.info('{}: {} pasties recovered from the download queue'.format(self.name, recovered))
                 while not self.kill_received:
-                    sleep_time = random.randint(self.update_min, self.update_max)
                     # grabs site from queue
-                    logger.info('{}: Downloading list of new pastes, will check again in {} seconds'.format(
-                                self.name, sleep_time))
+                    logger.info('{}: Downloading list of new pastes'.format(self.name))
                     # get the list of last pasties, but reverse it
                     # so we first have the old entries and then the new ones
                     last_pasties = self.get_last_pasties()
+                    sleep_time = self.next_update(last_pasties)
+                    logger.info('{}: will check again in {} seconds'.format(self.name, sleep_time))
                     if last_pasties:
                         amount = len(last_pasties)
-                        while last_pasties:
+                        while last_pasties and not self.kill_received:
                             pastie = last_pasties.pop()
-                            self.queue.put(pastie)  # add pastie to queue
+                            self.enqueue(pastie)  # add pastie to queue
                             del(pastie)
                         logger.info("Found {amount} new pasties for site {site}. There are now {qsize} pasties to be downloaded.".format(
                             amount=amount,
                             site=self.name,
                             qsize=self.queue.qsize()))
-                    self.condition.wait(sleep_time)
+                    if not self.kill_received:
+                        self.condition.wait(sleep_time)
         # catch unknown errors
         except Exception as e:
             msg = 'Thread for {name} crashed unexpectectly, '\
@@ -141,6 +172,38 @@ class PastieSite(threading.Thread):
             logger.error(traceback.format_exc())
         logger.info('{}: Thread exited'.format(self.name))
 
+    def enqueue(self, pastie):
+        '''
+        Add the pastie to the download queue, waiting for room if the queue
+        is bounded, without preventing the thread from being stopped.
+        '''
+        blocked = False
+        while not self.kill_received:
+            try:
+                self.queue.put(pastie, block=False)
+                return True
+            except Full:
+                if not blocked:
+                    logger.debug('{0}: download queue is full, waiting ...'.format(self.name))
+                    self.stats.incr('queue_blocked')
+                    blocked = True
+                # releases the condition, so stop() can be called
+                self.condition.wait(1)
+        return False
+
+    def next_update(self, last_pasties):
+        ''' number of seconds to wait before downloading the list of pasties again '''
+        if self.scheduler is None:
+            return random.randint(self.update_min, self.update_max)
+        new = None
+        if last_pasties is not False:
+            new = len(last_pasties)
+        (interval, reason) = self.scheduler.next_interval(new, self.last_page_size)
+        interval = round(interval, 1)
+        self.stats.set('update_interval', interval)
+        self.stats.set('update_reason', reason)
+        return interval
+
     def send_email_alert(self, pastie):
         if self.sendmail is not None:
             try:
@@ -166,64 +229,138 @@ class PastieSite(threading.Thread):
     def get_last_pasties(self):
         # reset the pasties list
         pasties = []
+        self.last_page_size = 0
         # populate queue with data
-        response = self.user_agent.download_url(self.archive_url)
+        response = self.user_agent.download_url(self.archive_url, validators=self.archive_cache)
         if not response:
             logger.warning("Failed to download page {url}".format(url=self.archive_url))
             return False
+        self.stats.incr('archive_polls')
+        if response.status_code == 304:
+            logger.debug("{0}: page {1} not modified".format(self.name, self.archive_url))
+            self.stats.incr('archive_not_modified')
+            return pasties
+        content = response.content
+        self.stats.incr('archive_bytes', len(content))
+        # servers without validators: skip the page if it did not change
+        # (the regex is part of the checksum, as it may change on reload)
+        md5 = hashlib.md5(self.archive_regex.encode('utf-8') + content).hexdigest()
+        if md5 == self.archive_cache.get('md5'):
+            logger.debug("{0}: page {1} unchanged".format(self.name, self.archive_url))
+            self.stats.incr('archive_unchanged')
+            return pasties
         htmlPage = response.text
         if not htmlPage:
             logger.warning("No HTML content for page {url}".format(url=self.archive_url))
             return False
         pasties_ids = self.re.findall(self.archive_regex, htmlPage)
         if pasties_ids:
-            for pastie_id in pasties_ids:
-                # check if the pastie was already downloaded
-                # and remember that we've seen it
-                if self.seen_pastie_and_remember(pastie_id):
-                    # do not append the seen things again in the queue
-                    continue
+            self.last_page_size = len(set(pasties_ids))
+            # check which pasties were already downloaded
+            # and remember that we've seen them
+            unseen = self.unseen_pasties_and_remember(pasties_ids)
+            if len(unseen) == self.last_page_size and self.archive_cache.get('md5') is not None:
+                # no overlap with the previous poll, pasties were probably missed
+                logger.warning("{0}: all the {1} pasties of {2} are new, coverage gap".format(
+                    self.name, len(unseen), self.archive_url))
+                self.stats.incr('coverage_gaps')
+                if self.archive_next_url:
+                    unseen = unseen + self.backfill(pasties_ids[-1])
+            for pastie_id in unseen:
                 # pastie was not downloaded yet. Add it to the queue
-                if self.pastie_class:
-                    pastie = self.pastie_class(self, pastie_id)
-                else:
-                    pastie = Pastie(self, pastie_id)
-                pasties.append(pastie)
+                pasties.append(self.new_pastie(pastie_id))
+            self.seen_index.flush()
+            self.archive_cache['md5'] = md5
             return pasties
         logger.error("No last pasties matches for regular expression site:{site} regex:{regex}. Error in your regex? Dumping htmlPage \n {html}".format(site=self.name, regex=self.archive_regex, html=htmlPage))
         return False
 
-    def seen_pastie(self, pastie_id, **kwargs):
-        ''' check if the pastie was already downloaded. '''
-        logger.debug('Site[{0}]: Checking if pastie[{1}] was aldready seen'.format(self.name, pastie_id))
-        # first look in memory if we have already seen this pastie
-        if self.seen_pasties.count(pastie_id):
-            logger.debug('Site[{0}]: Pastie[{1}] already in memory'.format(self.name, pastie_id))
-            return True
-        if self.storage is not None:
-            if self.storage.seen_pastie(pastie_id, **kwargs):
-                logger.debug('Site[{s}]: Pastie[{id}] found in storage'.format(s=self.name, id=pastie_id))
-                return True
-        logger.debug('Site[{0}]: Pastie[{1}] is unknown'.format(self.name, pastie_id))
-        return False
+    def new_pastie(self, pastie_id):
+        if self.pastie_class:
+            return self.pastie_class(self, pastie_id)
+        return Pastie(self, pastie_id)
+
+    def backfill(self, last_id):
+        '''
+        Download the older archive pages until one of them lists a pastie
+        already seen, or the page budget is exhausted, and returns the
+        pasties not seen yet.
+        '''
+        unseen = []
+        for page in range(2, self.archive_backfill + 2):
+            url = self.archive_next_url.format(page=page, id=last_id)
+            logger.info("{0}: backfilling from {1}".format(self.name, url))
+            response = self.user_agent.download_url(url)
+            if not response:
+                logger.warning("Failed to download page {url}".format(url=url))
+                break
+            self.stats.incr('backfill_pages')
+            self.stats.incr('archive_bytes', len(response.content))
+            pasties_ids = self.re.findall(self.archive_regex, response.text)
+            if not pasties_ids:
+                logger.warning("{0}: no pasties found in {1}".format(self.name, url))
+                break
+            page_unseen = self.unseen_pasties_and_remember(pasties_ids)
+            unseen.extend(page_unseen)
+            self.stats.incr('backfill_pasties', len(page_unseen))
+            if len(page_unseen) < len(set(pasties_ids)):
+                logger.info("{0}: coverage gap closed, {1} pasties recovered".format(self.name, len(unseen)))
+                return unseen
+            last_id = pasties_ids[-1]
+        logger.warning("{0}: coverage gap not closed, {1} pasties recovered".format(self.name, len(unseen)))
+        self.stats.incr('coverage_gaps_unrecovered')
+        return unseen
+
+    def unseen_pasties(self, pasties_ids):
+        ''' returns the pasties not downloaded yet. '''
+        logger.debug('Site[{0}]: Checking if {1} pasties were already seen'.format(self.name, len(pasties_ids)))
+        unseen = []
+        unknown = []
+        for pastie_id in pasties_ids:
+            # first look in the index if we have already seen this pastie
+            seen = self.seen_index.lookup(self.site, pastie_id)
+            if seen:
+                logger.debug('Site[{0}]: Pastie[{1}] already in memory'.format(self.name, pastie_id))
+            elif seen is None and self.storage is not None:
+                unknown.append(pastie_id)
+            else:
+                # the storage does not need to be asked for pasties never seen
+                unseen.append(pastie_id)
+        if unknown:
+            # a single lookup in the storage for all the pasties of the page
+            not_stored = set(self.storage.seen_pasties(unknown,
+                urls=dict([(pastie_id, self.public_url.format(id=pastie_id)) for pastie_id in unknown]),
+                sitename=self.name,
+                site=self.site,
+                filenames=dict([(pastie_id, self.pastie_id_to_filename(pastie_id)) for pastie_id in unknown])))
+            for pastie_id in unknown:
+                if pastie_id in not_stored:
+                    unseen.append(pastie_id)
+                else:
+                    logger.debug('Site[{s}]: Pastie[{id}] found in storage'.format(s=self.name, id=pastie_id))
+                    self.seen_index.remember(self.site, pastie_id)
+                    self.seen_index.persist(self.site, pastie_id)
+        # keep the order of the page
+        unseen = set(unseen)
+        res = [pastie_id for pastie_id in pasties_ids if pastie_id in unseen]
+        logger.debug('Site[{0}]: {1}/{2} pasties are unknown'.format(self.name, len(res), len(pasties_ids)))
+        return res
 
-    def seen_pastie_and_remember(self, pastie_id):
+    def unseen_pasties_and_remember(self, pasties_ids):
         '''
-        Check if the pastie was already downloaded
-        and remember that we've seen it
+        Returns the pasties not downloaded yet
+        and remember that we've seen them
         '''
-        if self.seen_pastie(pastie_id,
-                            url=self.public_url.format(id=pastie_id),
-                            sitename=self.name,
-                            site=self.site,
-                            filename=self.pastie_id_to_filename(pastie_id)):
-            return True
-        # We have not yet seen the pastie.
-        # Keep in memory that we've seen it using
-        # appendleft for performance reasons.
-        # (faster later when we iterate over the deque)
-        logger.debug('Site[{0}]: Marking pastie[{1}] as seen'.format(self.name, pastie_id))
-        return self.seen_pasties.appendleft(pastie_id)
+        # the same pastie may be listed more than once
+        pasties_ids = list(OrderedDict.fromkeys(pasties_ids))
+        unseen = self.unseen_pasties(pasties_ids)
+        # We have not yet seen these pasties.
+        # Keep in the index that we've seen them, they are only
+        # logged once processed.
+        for pastie_id in unseen:
+            logger.debug('Site[{0}]: Marking pastie[{1}] as seen'.format(self.name, pastie_id))
+            self.seen_index.remember(self.site, pastie_id)
+        return unseen
 
     def pastie_id_to_filename(self, pastie_id):
         filename = pastie_id.replace('/', '_')
@@ -0,0 +1,273 @@
+import logging.handlers
+import re
+from collections import deque
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+# optional C implementations of Aho-Corasick
+try:
+    import ahocorasick_rs
+except ImportError:
+    ahocorasick_rs = None
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+logger = logging.getLogger('pystemon')
+
+# literals shorter than this are too common to be worth prefiltering on
+MIN_LITERAL_LENGTH = 3
+# above this many literals, the pure python automaton scans faster than
+# one substring search per literal
+SUBSTRING_SCAN_MAX_LITERALS = 50
+
+_REPEATS = [getattr(sre_parse, op) for op in ['MAX_REPEAT', 'MIN_REPEAT', 'POSSESSIVE_REPEAT']
+            if hasattr(sre_parse, op)]
+_ATOMIC_GROUP = getattr(sre_parse, 'ATOMIC_GROUP', None)
+
+
+def _score(requirement):
+    # a requirement is a tuple of alternative literals, one of which
+    # must be present: the longer the shortest one, the more selective
+    return (min([len(literal) for literal in requirement]), -len(requirement))
+
+
+def _better(best, requirement):
+    if not requirement:
+        return best
+    if best is None or _score(requirement) > _score(best):
+        return requirement
+    return best
+
+
+def _literal_run(run):
+    if not run or max(run) > 255:
+        return None
+    return (bytes(bytearray(run)).lower(),)
+
+
+def _required_literals(parsed):
+    '''
+    Walk a parsed regular expression and return the most selective tuple of
+    literals of which at least one has to appear in any matching text, or
+    None if no such literal could be found.
+    '''
+    best = None
+    run = []
+    for op, av in parsed:
+        if op is sre_parse.LITERAL:
+            run.append(av)
+            continue
+        if op is sre_parse.IN and len(av) == 1 and av[0][0] is sre_parse.LITERAL:
+            run.append(av[0][1])
+            continue
+        best = _better(best, _literal_run(run))
+        run = []
+        if op is sre_parse.SUBPATTERN:
+            best = _better(best, _required_literals(av[-1]))
+        elif op in _REPEATS:
+            if av[0] >= 1:
+                best = _better(best, _required_literals(av[2]))
+        elif _ATOMIC_GROUP is not None and op is _ATOMIC_GROUP:
+            best = _better(best, _required_literals(av))
+        elif op is sre_parse.BRANCH:
+            alternatives = []
+            for branch in av[1]:
+                requirement = _required_literals(branch)
+                if requirement is None:
+                    alternatives = None
+                    break
+                alternatives.extend(requirement)
+            if alternatives:
+                best = _better(best, tuple(set(alternatives)))
+    return _better(best, _literal_run(run))
+
+
+def extract_literals(search, flags):
+    '''
+    Returns the literals (lowercased bytes) of which at least one must be
+    found in a pastie for the search regex to have a chance to match, or
+    None if the regex has no usable literal.
+    '''
+    if flags & sre_parse.SRE_FLAG_LOCALE:
+        # case folding depends on the locale, do not guess
+        return None
+    try:
+        requirement = _required_literals(sre_parse.parse(search.encode(), flags))
+    except Exception as e:
+        logger.debug("[{0}]: unable to extract literals: {1}".format(search, e))
+        return None
+    if requirement is None or _score(requirement)[0] < MIN_LITERAL_LENGTH:
+        return None
+    return requirement
+
+
+class AhoCorasick():
+    '''
+    Case-insensitive (ASCII) Aho-Corasick automaton over bytes, compiled
+    into a full transition table so a scan costs one lookup per byte.
+    Pure python, only used when no faster scanner can be built, see
+    load_scanner().
+    '''
+
+    def __init__(self, literals):
+        self.literals = list(literals)
+        goto = [{}]
+        out = [set()]
+        for i, literal in enumerate(self.literals):
+            state = 0
+            for c in bytearray(literal.lower()):
+                if c not in goto[state]:
+                    goto.append({})
+                    out.append(set())
+                    goto[state][c] = len(goto) - 1
+                state = goto[state][c]
+            out[state].add(i)
+        # breadth first construction of the failure links and transitions
+        fail = [0] * len(goto)
+        delta = [None] * len(goto)
+        delta[0] = [goto[0].get(c, 0) for c in range(256)]
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            row = list(delta[fail[state]])
+            for c, child in goto[state].items():
+                fail[child] = delta[fail[state]][c]
+                out[child] |= out[fail[child]]
+                row[c] = child
+                queue.append(child)
+            delta[state] = row
+        for row in delta:
+            row[ord('A'):ord('Z') + 1] = row[ord('a'):ord('z') + 1]
+        self.delta = delta
+        self.out = [tuple(o) if o else None for o in out]
+
+    def scan(self, data):
+        ''' returns the set of indexes of the literals found in data '''
+        delta = self.delta
+        out = self.out
+        found = set()
+        state = 0
+        for c in bytearray(data):
+            state = delta[state][c]
+            if out[state] is not None:
+                found.update(out[state])
+        return found
+
+
+class RustAhoCorasick():
+    ''' Aho-Corasick automaton of the ahocorasick_rs module '''
+
+    def __init__(self, literals):
+        self.literals = list(literals)
+        self.automaton = ahocorasick_rs.BytesAhoCorasick([literal.lower() for literal in self.literals])
+
+    def scan(self, data):
+        return set([i for (i, start, end) in
+            self.automaton.find_matches_as_indexes(data.lower(), overlapping=True)])
+
+
+class PyAhoCorasick():
+    ''' Aho-Corasick automaton of the pyahocorasick module, over latin-1 text '''
+
+    def __init__(self, literals):
+        self.literals = list(literals)
+        self.automaton = ahocorasick.Automaton()
+        for i, literal in enumerate(self.literals):
+            self.automaton.add_word(literal.lower().decode('latin-1'), i)
+        self.automaton.make_automaton()
+
+    def scan(self, data):
+        return set([i for (end, i) in self.automaton.iter(data.lower().decode('latin-1'))])
+
+
+class SubstringScanner():
+    '''
+    Looks for each literal with the substring search of bytes, written in
+    C. Its cost grows with the number of literals, so it is only faster
+    than the pure python automaton for a few of them.
+    '''
+
+    def __init__(self, literals):
+        self.literals = list(literals)
+        self.lowered = [literal.lower() for literal in self.literals]
+
+    def scan(self, data):
+        data = data.lower()
+        return set([i for (i, literal) in enumerate(self.lowered) if literal in data])
+
+
+def load_scanner(literals):
+    '''
+    returns the fastest scanner available for the literals: a C
+    automaton if installed, else the substring search for a few literals
+    and the pure python automaton for more
+    '''
+    for (module, scanner) in [(ahocorasick_rs, RustAhoCorasick), (ahocorasick, PyAhoCorasick)]:
+        if module is None or not literals:
+            continue
+        try:
+            return scanner(literals)
+        except Exception as e:
+            logger.debug("prefilter: unable to build {0}: {1}".format(scanner.__name__, e))
+    if len(literals) <= SUBSTRING_SCAN_MAX_LITERALS:
+        return SubstringScanner(literals)
+    return AhoCorasick(literals)
+
+
+class PastiePrefilter():
+    '''
+    Single pass multi-pattern prefilter: the required literals of all the
+    search patterns are scanned at once, and only the patterns whose
+    literals were found are evaluated with their full regex.
+    '''
+
+    def __init__(self, patterns, previous=None):
+        self.patterns = patterns
+        self.always = []
+        # literals extracted per (search, flags, engine syntax), kept across reloads
+        self.requirements = {}
+        extracted = 0
+        literals = {}
+        for i, ps in enumerate(patterns):
+            key = (ps.search, ps.flags, ps.engine.prefilter)
+            if previous is not None and key in previous.requirements:
+                requirement = previous.requirements[key]
+            else:
+                requirement = None
+                # literals are extracted with the parser of the 're' module,
+                # which does not understand the syntax of all the engines
+                if ps.engine.prefilter:
+                    requirement = extract_literals(ps.search, ps.flags)
+                extracted = extracted + 1
+            self.requirements[key] = requirement
+            if requirement is None:
+                logger.debug("[{0}]: no usable literal, always evaluated".format(ps.search))
+                self.always.append(i)
+                continue
+            logger.debug("[{0}]: prefiltered on {1}".format(ps.search, requirement))
+            for literal in requirement:
+                literals.setdefault(literal, []).append(i)
+        if previous is not None and set(previous.literals) == set(literals.keys()):
+            # same literals, the automaton can be reused as is
+            self.literals = previous.literals
+            self.automaton = previous.automaton
+        else:
+            self.literals = list(literals.keys())
+            self.automaton = load_scanner(self.literals)
+        self.literal_patterns = [literals[literal] for literal in self.literals]
+        logger.debug("prefilter: {0}/{1} patterns prefiltered on {2} literals, {3} extracted".format(
+            len(patterns) - len(self.always), len(patterns), len(self.literals), extracted))
+
+    def candidates(self, content):
+        ''' returns, in configuration order, the patterns that may match content '''
+        if not isinstance(content, bytes):
+            return self.patterns
+        indexes = set(self.always)
+        for literal in self.automaton.scan(content):
+            indexes.update(self.literal_patterns[literal])
+        return [self.patterns[i] for i in sorted(indexes)]
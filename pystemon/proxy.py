@@ -1,21 +1,25 @@
 import logging.handlers
+import heapq
 import threading
 import time
 import random
 import os
+import requests
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures
 
 logger = logging.getLogger('pystemon')
 
 class ThreadProxyList(threading.Thread):
     '''
     Threaded file listener for proxy list file. Modification to the file results
-    in updating the proxy list.
+    in updating the proxy list. The prober of the list, if any, runs along.
     '''
-    def __init__(self, proxies_list, wait=1):
+    def __init__(self, proxies_list, wait=1, prober=None):
         threading.Thread.__init__(self)
         self.list = proxies_list
         self.last_mtime = proxies_list.last_mtime
         self.wait = wait
+        self.prober = prober
         self.condition = threading.Condition()
         self.kill_received = False
 
@@ -26,16 +30,14 @@ class ThreadProxyList(threading.Thread):
         with self.condition:
             logger.info('ThreadProxyList exiting')
             self.kill_received = True
+            if self.prober is not None:
+                self.prober.stop()
             self.condition.notify_all()
 
-    def reset(self, wait=1):
-        with self.condition:
-            self.last_mtime = 0
-            self.filename = filename
-            self.wait = wait
-
     def run(self):
         logger.info('ThreadProxyList started')
+        if self.prober is not None:
+            self.prober.start()
         try:
             with self.condition:
                 while not self.kill_received:
@@ -44,30 +46,184 @@ class ThreadProxyList(threading.Thread):
                         logger.debug('Proxy configuration file changed. Reloading proxy list.')
                         self.list.load_proxies_from_file()
                         self.last_mtime = mtime
+                        if self.prober is not None:
+                            # check the new proxies now
+                            self.prober.wake()
                     self.condition.wait(1)
         except Exception as e:
             logger.error('ThreadProxyList crashed: {0}'.format(e))
         logger.info('ThreadProxyList exited')
 
+class ThreadProxyProber(threading.Thread):
+    '''
+    Downloads 'url' through every proxy of the list each 'interval'
+    seconds, 'concurrency' proxies at once, so the proxies are known to be
+    up or down before a download goes through them. A proxy down is set
+    aside until a later round finds it up again.
+    '''
+    def __init__(self, proxies_list, url, interval=300, concurrency=10, timeout=5):
+        threading.Thread.__init__(self)
+        self.list = proxies_list
+        self.url = url
+        self.interval = interval
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.name = 'ThreadProxyProber'
+        self.condition = threading.Condition()
+        self.kill_received = False
+        self.woken = False
+        self.setDaemon(True)
+
+    def __repr__(self):
+        return 'ThreadProxyProber[{0}]'.format(self.url)
+
+    def stop(self):
+        with self.condition:
+            logger.info('{0}: exiting'.format(self.name))
+            self.kill_received = True
+            self.condition.notify_all()
+
+    def wake(self):
+        ''' starts a round now '''
+        with self.condition:
+            self.woken = True
+            self.condition.notify_all()
+
+    def probe(self, proxy):
+        with self.condition:
+            if self.kill_received:
+                return None
+        start = time.time()
+        try:
+            response = requests.get(self.url, proxies={'http': proxy, 'https': proxy},
+                    timeout=self.timeout, stream=True)
+            response.close()
+            up = response.status_code < 400
+            if not up:
+                logger.debug('{0}: {1} from proxy {2}'.format(self.name, response.status_code, proxy))
+        except requests.RequestException as e:
+            logger.debug('{0}: proxy {1} failed: {2}'.format(self.name, proxy, e))
+            up = False
+        # a proxy down stays down until a later round finds it up
+        self.list.probed_proxy(proxy, up, time.time() - start, 2 * self.interval)
+        return up
+
+    def run(self):
+        logger.info('{0}: started'.format(self.name))
+        executor = ThreadPoolExecutor(self.concurrency)
+        try:
+            while True:
+                with self.condition:
+                    if self.kill_received:
+                        break
+                    self.woken = False
+                start = time.time()
+                proxies = self.list.get_proxies()
+                futures = [executor.submit(self.probe, proxy) for proxy in proxies]
+                wait_futures(futures)
+                up = len([f for f in futures if f.result()])
+                logger.info('{0}: {1}/{2} proxies up, checked in {3:.1f}s'.format(
+                    self.name, up, len(proxies), time.time() - start))
+                with self.condition:
+                    if not self.kill_received and not self.woken:
+                        self.condition.wait(max(0, self.interval - (time.time() - start)))
+        except Exception as e:
+            logger.error('{0} crashed: {1}'.format(self.name, e))
+        finally:
+            executor.shutdown(False)
+        logger.info('{0}: exited'.format(self.name))
+
+class ProxyScore():
+    '''
+    Latency and success rate of a proxy, as exponentially weighted moving
+    averages of the downloads going through it.
+    '''
+
+    __slots__ = ['proxy', 'latency', 'success', 'failures', 'down_until', 'index']
+
+    def __init__(self, proxy):
+        self.proxy = proxy
+        self.latency = None
+        self.success = 1.0
+        # failures in a row
+        self.failures = 0
+        self.down_until = 0
+        # position in ProxyList.available, -1 while cooling down
+        self.index = -1
+
+    def __repr__(self):
+        return 'ProxyScore[{0}][{1}][{2}]'.format(self.proxy, self.latency, self.success)
+
+    def cost(self):
+        ''' expected seconds per successful download, lower is better '''
+        latency = self.latency
+        if latency is None:
+            latency = 1.0
+        return latency / max(self.success, 0.01)
+
+
 class ProxyList():
+    '''
+    The proxies of a file, with the score of each proxy fed by the user
+    agents through succeeded_proxy() and failed_proxy().
+
+    get_random_proxy() draws two available proxies at random and returns
+    the one with the lowest cost (power of two choices), which spreads
+    the downloads while avoiding the slow and failing proxies, in O(1)
+    whatever the number of proxies.
+
+    After 'failures' errors in a row a proxy cools down for 'cooldown'
+    seconds, doubled at each failure in a row up to 'max_cooldown', then
+    it is available again.
+    '''
 
-    def __init__(self, filename):
-        self.proxies_failed = []
+    # weight of the latest download in the averages
+    ALPHA = 0.2
+
+    def __init__(self, filename, cooldown=60, max_cooldown=3600, failures=2, probe=None):
         self.proxies_list = []
+        # proxy -> ProxyScore
+        self.scores = {}
+        # scores of the proxies not cooling down
+        self.available = []
+        # heap of (down_until, proxy)
+        self.cooling = []
         self.proxies_lock = threading.Lock()
         self.thread_proxy_list = None
         self.filename = filename
         self.last_mtime = 0
+        self.cooldown = cooldown
+        self.max_cooldown = max(cooldown, max_cooldown)
+        self.failures = failures
+        # arguments of the ThreadProxyProber, None disables it
+        self.probe = probe
+        self.selections = 0
+        self.cooldowns = 0
         self.load_proxies_from_file()
 
+    def __repr__(self):
+        return 'ProxyList[{0}]'.format(self.filename)
+
+    def configure(self, filename, cooldown=60, max_cooldown=3600, failures=2, probe=None):
+        with self.proxies_lock:
+            self.cooldown = cooldown
+            self.max_cooldown = max(cooldown, max_cooldown)
+            self.failures = failures
+            self.probe = probe
+            reload = filename != self.filename
+            self.filename = filename
+        if reload:
+            self.load_proxies_from_file()
+
     def monitor(self, wait=1):
-        if self.thread_proxy_list:
-            self.thread_proxy_list.reset(self, wait)
-        else:
-            t = ThreadProxyList(self, wait)
-            t.setDaemon(True)
-            self.thread_proxy_list = t
-        return self.thread_proxy_list
+        ''' returns a new ThreadProxyList, the previous one is stopped by the reload '''
+        prober = None
+        if self.probe is not None:
+            prober = ThreadProxyProber(self, **self.probe)
+        t = ThreadProxyList(self, wait, prober)
+        t.setDaemon(True)
+        self.thread_proxy_list = t
+        return t
 
     def load_proxies_from_file(self):
         try:
@@ -80,30 +236,133 @@ class ProxyList():
                     line = line.strip()
                     if line:  # LATER verify if the proxy line has the correct structure
                         proxies_list.append(line)
-                self.proxies_failed = []
-                self.proxies_list = proxies_list
+                self._load(proxies_list)
             logger.debug('Found {count} proxies in file "{file}"'.format(file=filename, count=len(proxies_list)))
         except Exception as e:
             logger.error('Configuration problem: error reading proxyfile "{file}": {e}'.format(file=filename, e=e))
 
+    def _load(self, proxies_list):
+        ''' the proxies still listed keep their score '''
+        now = time.time()
+        scores = {}
+        self.available = []
+        self.cooling = []
+        for proxy in proxies_list:
+            if proxy in scores:
+                continue
+            score = scores[proxy] = self.scores.get(proxy) or ProxyScore(proxy)
+            if score.down_until > now:
+                score.index = -1
+                heapq.heappush(self.cooling, (score.down_until, proxy))
+            else:
+                self._add(score)
+        self.scores = scores
+        self.proxies_list = proxies_list
+
+    def _add(self, score):
+        score.index = len(self.available)
+        self.available.append(score)
+
+    def _remove(self, score):
+        last = self.available.pop()
+        if last is not score:
+            self.available[score.index] = last
+            last.index = score.index
+        score.index = -1
+
+    def _reinstate(self, now):
+        while self.cooling and self.cooling[0][0] <= now:
+            (down_until, proxy) = heapq.heappop(self.cooling)
+            score = self.scores.get(proxy)
+            # the proxy may be back already, and cooling down again
+            if score is None or score.index >= 0 or score.down_until != down_until:
+                continue
+            self._add(score)
+            logger.info("Proxy {0} is back in the proxy list, proxies available: {1}".format(proxy, len(self.available)))
+
     def get_random_proxy(self):
-        proxy = None
         with self.proxies_lock:
-            if self.proxies_list:
-                proxy = random.choice(tuple(self.proxies_list))
-        return proxy
+            self._reinstate(time.time())
+            if not self.available:
+                if not self.cooling:
+                    return None
+                # all the proxies are cooling down, use the first one back
+                return self.cooling[0][1]
+            self.selections = self.selections + 1
+            a = random.choice(self.available)
+            b = random.choice(self.available)
+            if b.cost() < a.cost():
+                return b.proxy
+            return a.proxy
 
-    def failed_proxy(self,proxy):
+    def _succeeded(self, score, latency):
+        score.success = score.success + self.ALPHA * (1 - score.success)
+        if score.latency is None:
+            score.latency = latency
+        else:
+            score.latency = score.latency + self.ALPHA * (latency - score.latency)
+        score.failures = 0
+
+    def _failed(self, score):
+        score.success = score.success * (1 - self.ALPHA)
+        score.failures = score.failures + 1
+
+    def succeeded_proxy(self, proxy, latency):
         with self.proxies_lock:
-            if len(self.proxies_list) == 1:
+            score = self.scores.get(proxy)
+            if score is None:
+                return
+            self._succeeded(score, latency)
+
+    def failed_proxy(self, proxy):
+        with self.proxies_lock:
+            score = self.scores.get(proxy)
+            if score is None:
+                return
+            self._failed(score)
+            if score.failures < self.failures or score.index < 0:
+                return
+            if len(self.available) == 1:
                 logger.info("Failing proxy {} not removed as it's the only proxy left.".format(proxy))
+                return
+            wait = min(self.max_cooldown, self.cooldown * 2 ** (score.failures - self.failures))
+            self._cool(score, wait)
+            logger.info("Proxy {0} cooling down for {1}s because of too many errors, proxies available: {2}".format(
+                proxy, wait, len(self.available)))
+
+    def _cool(self, score, wait):
+        score.down_until = time.time() + wait
+        self._remove(score)
+        heapq.heappush(self.cooling, (score.down_until, score.proxy))
+        self.cooldowns = self.cooldowns + 1
+
+    def get_proxies(self):
+        with self.proxies_lock:
+            return list(self.proxies_list)
+
+    def probed_proxy(self, proxy, up, latency, wait):
+        ''' a proxy down is set aside for 'wait' seconds '''
+        with self.proxies_lock:
+            score = self.scores.get(proxy)
+            if score is None:
+                return
+            if up:
+                self._succeeded(score, latency)
+                if score.index < 0:
+                    score.down_until = 0
+                    self._add(score)
+                    logger.info("Proxy {0} is up, proxies available: {1}".format(proxy, len(self.available)))
             else:
-                self.proxies_failed.append(proxy)
-                if self.proxies_failed.count(proxy) >= 2 and proxy in self.proxies_list:
-                    logger.info("Removing proxy {0} from proxy list because of to many errors errors.".format(proxy))
-                    try:
-                        self.proxies_list.remove(proxy)
-                    except ValueError:
-                        pass
-                    logger.info("Proxies left: {0}".format(len(self.proxies_list)))
+                self._failed(score)
+                if score.index >= 0:
+                    self._cool(score, wait)
+                    logger.info("Proxy {0} is down, proxies available: {1}".format(proxy, len(self.available)))
 
+    def stats_to_text(self):
+        with self.proxies_lock:
+            best = heapq.nsmallest(3, self.available, key=lambda score: score.cost())
+            return "{0}: proxies={1} available={2} cooling={3} selections={4} cooldowns={5} best={6}".format(
+                self, len(self.scores), len(self.available), len(self.scores) - len(self.available),
+                self.selections, self.cooldowns,
+                ' '.join(['{0}({1:.3f}s,{2:.0%})'.format(score.proxy, score.latency or 0, score.success)
+                    for score in best]))
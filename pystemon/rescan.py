@@ -0,0 +1,156 @@
+import logging.handlers
+import gzip
+import json
+import multiprocessing
+import os
+import sys
+from datetime import date
+from pystemon.engine import load_engine
+from pystemon.pastiesearch import PastieSearch, PastieSearchStream, load_patterns
+from pystemon.prefilter import PastiePrefilter
+
+logger = logging.getLogger('pystemon')
+
+# state of the rescan processes, set once by _init_worker
+_patterns = []
+_prefilter = None
+_chunk_size = 64*1024
+_overlap = 4096
+
+def _init_worker(engine, regexes, prefilter, chunk_size, overlap):
+    global _patterns, _prefilter, _chunk_size, _overlap
+    regex_engine = load_engine(engine)
+    _patterns = [PastieSearch(regex_engine, regex) for regex in regexes]
+    load_patterns(regex_engine, _patterns)
+    _prefilter = None
+    if prefilter:
+        _prefilter = PastiePrefilter(_patterns)
+    _chunk_size = chunk_size
+    _overlap = overlap
+
+def _rescan_file(item):
+    (site, day, path) = item
+    stream = PastieSearchStream(_patterns, overlap=_overlap, prefilter=_prefilter)
+    try:
+        if path.endswith('.gz'):
+            f = gzip.open(path, 'rb')
+        else:
+            f = open(path, 'rb')
+        with f:
+            while not stream.done:
+                chunk = f.read(_chunk_size)
+                if not chunk:
+                    break
+                stream.feed(chunk)
+    except Exception as e:
+        return (item, None, str(e))
+    matches = stream.close()
+    if not matches:
+        return None
+    return (item, [_patterns.index(ps) for ps in matches], None)
+
+
+def _parse_int(name):
+    try:
+        return int(name)
+    except ValueError:
+        return None
+
+
+class PastieRescan():
+    '''
+    Matches the pasties archived by FileStorage (in site/YYYY/MM/DD under
+    the 'dir-all' directory) against the search patterns, in a pool of
+    processes, and writes the hits as JSON lines.
+    '''
+
+    def __init__(self, archive_dir, engine, patterns, prefilter=True,
+            sites=None, start=None, end=None, processes=0,
+            chunk_size=64*1024, overlap=4096, output=sys.stdout):
+        self.archive_dir = archive_dir
+        self.engine = engine
+        self.patterns = patterns
+        self.prefilter = prefilter
+        self.sites = sites
+        self.start = start
+        self.end = end
+        self.processes = processes or multiprocessing.cpu_count()
+        self.chunk_size = chunk_size
+        self.overlap = overlap
+        self.output = output
+        self.files = 0
+
+    def _in_range(self, day):
+        if self.start is not None and day < self.start:
+            return False
+        if self.end is not None and day > self.end:
+            return False
+        return True
+
+    def _subdirs(self, path):
+        try:
+            return sorted([e.name for e in os.scandir(path) if e.is_dir()])
+        except OSError as e:
+            logger.error("unable to list '{0}': {1}".format(path, e))
+            return []
+
+    def archive_files(self):
+        ''' yields (site, date, path) for each archived pastie in range '''
+        for site in self._subdirs(self.archive_dir):
+            if self.sites and site not in self.sites:
+                continue
+            site_dir = os.path.join(self.archive_dir, site)
+            for year in self._subdirs(site_dir):
+                y = _parse_int(year)
+                if y is None:
+                    continue
+                if (self.start is not None and y < self.start.year) or (self.end is not None and y > self.end.year):
+                    continue
+                for month in self._subdirs(os.path.join(site_dir, year)):
+                    for day in self._subdirs(os.path.join(site_dir, year, month)):
+                        try:
+                            d = date(y, int(month), int(day))
+                        except ValueError:
+                            continue
+                        if not self._in_range(d):
+                            continue
+                        path = os.path.join(site_dir, year, month, day)
+                        for e in os.scandir(path):
+                            if e.name.endswith('.metadata') or not e.is_file():
+                                continue
+                            yield (site, d.isoformat(), e.path)
+
+    def run(self):
+        regexes = [ps.to_dict() for ps in self.patterns]
+        logger.info("rescanning '{0}' with {1} pattern(s) in {2} process(es) ...".format(
+            self.archive_dir, len(regexes), self.processes))
+        hits = 0
+        pool = multiprocessing.Pool(self.processes, _init_worker,
+                (self.engine, regexes, self.prefilter, self.chunk_size, self.overlap))
+        try:
+            for res in pool.imap_unordered(_rescan_file, self._count(self.archive_files()), chunksize=256):
+                if res is None:
+                    continue
+                ((site, day, path), indexes, error) = res
+                if error is not None:
+                    logger.error("unable to rescan '{0}': {1}".format(path, error))
+                    continue
+                hits = hits + 1
+                pastie_id = os.path.basename(path)
+                if pastie_id.endswith('.gz'):
+                    pastie_id = pastie_id[:-3]
+                self.output.write(json.dumps({'site': site, 'date': day, 'id': pastie_id, 'path': path,
+                    'matches': [self.patterns[i].to_dict() for i in indexes]}) + '\n')
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+        self.output.flush()
+        logger.info("rescanned {0} pastie(s), {1} hit(s)".format(self.files, hits))
+        return hits
+
+    def _count(self, iterable):
+        self.files = 0
+        for item in iterable:
+            self.files = self.files + 1
+            yield item
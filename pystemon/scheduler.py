@@ -0,0 +1,101 @@
+import logging.handlers
+import random
+import threading
+import time
+
+logger = logging.getLogger('pystemon')
+
+class PastieScheduler():
+    '''
+    Chooses the interval between two polls of the archive page of a site,
+    from the rate of new pasties observed on the previous polls.
+
+    The rate is a moving average of the new pasties per second. The next
+    poll is planned when half of the page should be new, immediately (the
+    floor) when the whole page was new as pasties were probably missed,
+    and the interval is doubled while the site is failing. The interval
+    stays between the floor and the ceiling, and never goes below the
+    throttling of the site.
+    '''
+
+    # weight of the last poll in the moving average of the rate
+    ALPHA = 0.3
+    # part of the archive page which should be new at the next poll
+    FILL = 0.5
+    # random variation of the interval, so the polls of the sites spread
+    JITTER = 0.1
+
+    def __init__(self, name, floor, ceiling, throttling=0):
+        self.name = name
+        self.lock = threading.Lock()
+        self.configure(floor, ceiling, throttling)
+        self.rate = None
+        self.page_size = 0
+        # poll often until the rate is known
+        self.interval = self.floor
+        self.reason = 'start'
+        self.last_poll = None
+
+    def __repr__(self):
+        return 'PastieScheduler[{0}]'.format(self.name)
+
+    def configure(self, floor, ceiling, throttling=0):
+        with self.lock:
+            self.floor = max(floor, throttling / 1000.0)
+            self.ceiling = max(ceiling, self.floor)
+
+    def inherit(self, other):
+        ''' keep the estimations of the scheduler of the previous configuration '''
+        with other.lock:
+            (rate, page_size, interval, reason, last_poll) = (other.rate, other.page_size,
+                    other.interval, other.reason, other.last_poll)
+        with self.lock:
+            (self.rate, self.page_size, self.interval, self.reason, self.last_poll) = (rate, page_size,
+                    interval, reason, last_poll)
+
+    def next_interval(self, new, page_size):
+        '''
+        Account for a poll which found 'new' unseen pasties on a page of
+        'page_size' pasties ('new' is None if the poll failed), and returns
+        the number of seconds to wait before the next poll with the reason.
+        '''
+        now = time.time()
+        with self.lock:
+            elapsed = None
+            if self.last_poll is not None:
+                elapsed = now - self.last_poll
+            self.last_poll = now
+            if page_size:
+                self.page_size = page_size
+            if new is None:
+                interval = self.interval * 2
+                reason = 'failing'
+            else:
+                if elapsed:
+                    rate = new / elapsed
+                    if self.rate is None:
+                        self.rate = rate
+                    else:
+                        self.rate = self.ALPHA * rate + (1 - self.ALPHA) * self.rate
+                if self.page_size and new >= self.page_size:
+                    interval = self.floor
+                    reason = 'overflow'
+                elif not self.rate or not self.page_size:
+                    interval = self.interval * 2
+                    reason = 'idle'
+                else:
+                    interval = self.FILL * self.page_size / self.rate
+                    reason = 'rate'
+            if interval < self.floor:
+                interval = self.floor
+                reason = reason + ', floor'
+            elif interval > self.ceiling:
+                interval = self.ceiling
+                reason = reason + ', ceiling'
+            self.interval = interval
+            self.reason = reason
+            jitter = interval * random.uniform(-self.JITTER, self.JITTER)
+            interval = min(max(interval + jitter, self.floor), self.ceiling)
+            logger.debug("{0}: next poll in {1:.1f}s ({2}), {3} new pasties out of {4}, rate={5}/s".format(
+                self, interval, reason, new, page_size, self.rate))
+            return (interval, reason)
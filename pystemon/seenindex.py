@@ -0,0 +1,295 @@
+import logging.handlers
+import hashlib
+import math
+import os
+import struct
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger('pystemon')
+
+def _key(site, pastie_id):
+    ''' 64 bits hash of a pastie, stable across restarts '''
+    digest = hashlib.md5('{0}\t{1}'.format(site, pastie_id).encode('utf-8')).digest()
+    return struct.unpack('<Q', digest[:8])[0]
+
+
+class BloomFilter():
+    '''
+    Bloom filter sized for 'capacity' keys with the given false positive
+    rate, the positions are derived from the 64 bits key by double hashing.
+    '''
+
+    HEADER = struct.Struct('<QdQ')
+
+    def __init__(self, capacity, error=0.001):
+        self.capacity = capacity
+        self.error = error
+        self.size = max(64, int(-capacity * math.log(error) / (math.log(2) ** 2)))
+        self.hashes = max(1, int(round(float(self.size) / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        h1 = key & 0xffffffff
+        h2 = (key >> 32) | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        added = False
+        for pos in self._positions(key):
+            if not self.bits[pos >> 3] & (1 << (pos & 7)):
+                self.bits[pos >> 3] |= 1 << (pos & 7)
+                added = True
+        # the keys already in the filter do not fill it more
+        if added:
+            self.count = self.count + 1
+
+    def __contains__(self, key):
+        for pos in self._positions(key):
+            if not self.bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def save(self, filename):
+        tmp = filename + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(self.HEADER.pack(self.capacity, self.error, self.count))
+            f.write(self.bits)
+        os.rename(tmp, filename)
+
+    def load(self, filename):
+        ''' returns False if the file is missing or of another filter '''
+        if not os.path.exists(filename):
+            return False
+        with open(filename, 'rb') as f:
+            (capacity, error, count) = self.HEADER.unpack(f.read(self.HEADER.size))
+            bits = f.read()
+        if (capacity, error) != (self.capacity, self.error) or len(bits) != len(self.bits):
+            return False
+        self.bits = bytearray(bits)
+        self.count = count
+        return True
+
+
+class SeenGeneration():
+    def __init__(self, now):
+        self.keys = set()
+        self.last = now
+
+
+class PastieSeenIndex():
+    '''
+    Index of the pasties already seen, by site and id.
+
+    The hashes of the most recent pasties are kept in memory in a few
+    generations of sets: the oldest generation is dropped as a whole once
+    the index holds more than 'size' pasties or when its last pastie is
+    older than 'max_age' seconds, and a pastie found in an old generation
+    is moved to the current one. The pasties are appended to a log file
+    once processed, and the log is replayed on startup, so the pasties
+    still queued or failed are downloaded again after a restart. The log
+    is compacted when it holds more than twice the pasties in memory.
+
+    The optional bloom filter holds all the pasties ever logged, so a
+    pastie unknown to the filter was never seen and the storage backends
+    do not need to be asked. Its bits are saved to 'filename'.bloom before
+    the log is compacted, and loaded back before the log is replayed.
+
+    With lazy, load() is left to the caller, e.g. once another index
+    closed the same log.
+    '''
+
+    GENERATIONS = 8
+
+    def __init__(self, size=100000, max_age=0, filename=None, bloom=0, bloom_error=0.001, lazy=False):
+        self.size = size
+        self.max_age = max_age
+        self.filename = filename
+        self.bloom = None
+        if bloom:
+            self.bloom = BloomFilter(bloom, bloom_error)
+        self.lock = threading.Lock()
+        self.generations = deque()
+        self.count = 0
+        self.hits = 0
+        self.misses = 0
+        self.log = None
+        self.lines = 0
+        if not lazy:
+            self.load()
+
+    def __repr__(self):
+        return 'PastieSeenIndex[{0}]'.format(self.size)
+
+    def _expire(self, now):
+        while self.generations:
+            oldest = self.generations[0]
+            if self.count > self.size or (self.max_age and oldest.last < now - self.max_age):
+                self.generations.popleft()
+                self.count = self.count - len(oldest.keys)
+            else:
+                break
+
+    def _insert(self, key, now):
+        if not self.generations:
+            self.generations.append(SeenGeneration(now))
+        current = self.generations[-1]
+        if len(current.keys) >= max(1, self.size // self.GENERATIONS) or (
+                self.max_age and current.last < now - self.max_age // self.GENERATIONS):
+            current = SeenGeneration(now)
+            self.generations.append(current)
+        if key not in current.keys:
+            current.keys.add(key)
+            self.count = self.count + 1
+        current.last = now
+        self._expire(now)
+
+    def lookup(self, site, pastie_id):
+        '''
+        Returns True if the pastie was seen recently, False if it was never
+        seen (according to the bloom filter) and None if unknown.
+        '''
+        key = _key(site, pastie_id)
+        now = time.time()
+        with self.lock:
+            self._expire(now)
+            for generation in reversed(self.generations):
+                if key in generation.keys:
+                    if generation is not self.generations[-1]:
+                        # least recently seen pasties are dropped first
+                        generation.keys.discard(key)
+                        self.count = self.count - 1
+                        self._insert(key, now)
+                    self.hits = self.hits + 1
+                    return True
+            self.misses = self.misses + 1
+            if self.bloom is not None and key not in self.bloom:
+                return False
+            return None
+
+    def remember(self, site, pastie_id):
+        ''' the pastie was seen, until the next restart '''
+        key = _key(site, pastie_id)
+        now = time.time()
+        with self.lock:
+            self._insert(key, now)
+            if self.bloom is not None:
+                self.bloom.add(key)
+
+    def persist(self, site, pastie_id):
+        ''' the pastie was processed, log it to remember it across restarts '''
+        with self.lock:
+            if self.log is None or '\n' in pastie_id:
+                return
+            try:
+                self.log.write('{0:.0f}\t{1}\t{2}\n'.format(time.time(), site, pastie_id))
+                self.lines = self.lines + 1
+            except Exception as e:
+                logger.error("{0}: unable to write to '{1}': {2}".format(self, self.filename, e))
+                return
+            if self._oversized():
+                self.log.close()
+                self.log = None
+                if not self.compact():
+                    # try again once the log grew as much
+                    self.lines = 0
+                self._open()
+
+    def flush(self):
+        with self.lock:
+            if self.log is not None:
+                self.log.flush()
+
+    def close(self):
+        with self.lock:
+            if self.log is not None:
+                self.log.close()
+                self.log = None
+
+    def stats_to_text(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            rate = 0
+            if lookups:
+                rate = 100.0 * self.hits / lookups
+            return "{0}: entries={1} generations={2} hits={3} misses={4} hit rate={5:.1f}%".format(
+                self, self.count, len(self.generations), self.hits, self.misses, rate)
+
+    def load(self):
+        if not self.filename:
+            return
+        lines = 0
+        if self.bloom is not None:
+            try:
+                if self.bloom.load(self.filename + '.bloom'):
+                    logger.debug("{0}: loaded the bloom filter of {1} pastie(s)".format(self, self.bloom.count))
+            except Exception as e:
+                logger.error("{0}: unable to load '{1}.bloom': {2}".format(self, self.filename, e))
+        if os.path.exists(self.filename):
+            try:
+                with open(self.filename) as f:
+                    for line in f:
+                        try:
+                            (ts, site, pastie_id) = line.rstrip('\n').split('\t', 2)
+                            ts = float(ts)
+                        except ValueError:
+                            continue
+                        lines = lines + 1
+                        key = _key(site, pastie_id)
+                        self._insert(key, ts)
+                        if self.bloom is not None:
+                            self.bloom.add(key)
+                self._expire(time.time())
+                logger.debug("{0}: loaded {1} pastie(s) from '{2}'".format(self, self.count, self.filename))
+            except Exception as e:
+                logger.error("{0}: unable to load '{1}': {2}".format(self, self.filename, e))
+        if self.bloom is not None and self.bloom.count > self.bloom.capacity:
+            logger.warning("{0}: the bloom filter holds {1} pasties for a capacity of {2}, raise bloom".format(
+                self, self.bloom.count, self.bloom.capacity))
+        self.lines = lines
+        if self._oversized():
+            self.compact()
+        self._open()
+
+    def _open(self):
+        try:
+            self.log = open(self.filename, 'a')
+        except Exception as e:
+            logger.error("{0}: unable to open '{1}': {2}".format(self, self.filename, e))
+
+    def _oversized(self):
+        return self.lines > 2 * max(self.count, self.size // self.GENERATIONS)
+
+    def compact(self):
+        ''' rewrite the log with the pasties still in memory, returns False on error '''
+        tmp = self.filename + '.tmp'
+        kept = 0
+        if self.bloom is not None:
+            # the pasties dropped from the log are only kept by the filter
+            try:
+                self.bloom.save(self.filename + '.bloom')
+            except Exception as e:
+                logger.error("{0}: unable to save '{1}.bloom', not compacting: {2}".format(self, self.filename, e))
+                return False
+        try:
+            with open(self.filename) as f, open(tmp, 'w') as out:
+                for line in f:
+                    try:
+                        (ts, site, pastie_id) = line.rstrip('\n').split('\t', 2)
+                    except ValueError:
+                        continue
+                    key = _key(site, pastie_id)
+                    for generation in self.generations:
+                        if key in generation.keys:
+                            out.write(line)
+                            kept = kept + 1
+                            break
+            os.rename(tmp, self.filename)
+            self.lines = kept
+            logger.debug("{0}: compacted '{1}' to {2} line(s)".format(self, self.filename, kept))
+            return True
+        except Exception as e:
+            logger.error("{0}: unable to compact '{1}': {2}".format(self, self.filename, e))
+            return False
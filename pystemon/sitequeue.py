@@ -0,0 +1,213 @@
+import logging.handlers
+import sqlite3
+import time
+from collections import deque
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+logger = logging.getLogger('pystemon')
+
+POLICIES = ['block', 'drop-oldest', 'drop-newest']
+
+class PastieSiteQueue(Queue):
+    '''
+    Queue of the pasties of a site waiting to be downloaded.
+
+    When the queue holds 'maxsize' pasties, the policy decides what
+    happens to a new one: 'block' the poller until there is room, drop
+    the oldest pastie of the queue ('drop-oldest') or the new one
+    ('drop-newest'). With newest_first, the most recent pasties are
+    downloaded first so alerts stay timely under backlog.
+    '''
+
+    def __init__(self, maxsize=0, policy='block', newest_first=False, stats=None):
+        Queue.__init__(self, maxsize)
+        self.policy = policy
+        self.newest_first = newest_first
+        self.stats = stats
+        # threading.Event set when a pastie is queued, see PastieWorkerPool
+        self.wakeup = None
+
+    def __repr__(self):
+        return 'PastieSiteQueue[{0}][{1}]'.format(self.maxsize, self.policy)
+
+    def configure(self, maxsize=0, policy='block', newest_first=False):
+        with self.mutex:
+            self.maxsize = maxsize
+            self.policy = policy
+            self.newest_first = newest_first
+            self.not_full.notify_all()
+
+    def _init(self, maxsize):
+        self.queue = deque()
+
+    def _put(self, item):
+        self.queue.append(item)
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    def _get(self):
+        if self.newest_first:
+            return self.queue.pop()
+        return self.queue.popleft()
+
+    def _discard(self, item):
+        pass
+
+    def done(self, item):
+        ''' the download of item is finished '''
+        self.task_done()
+
+    def recover(self, factory):
+        ''' queue again the pasties of a previous run, returns how many '''
+        return 0
+
+    def drain(self):
+        ''' removes and returns the pasties waiting in the queue '''
+        with self.mutex:
+            items = list(self.queue)
+            self.queue.clear()
+            for item in items:
+                self._discard(item)
+            self.unfinished_tasks -= len(items)
+            self.not_full.notify_all()
+        return items
+
+    def refill(self, items):
+        ''' queues the pasties drained from another queue, even above maxsize '''
+        with self.mutex:
+            for item in items:
+                self._put(item)
+                self.unfinished_tasks += 1
+            self.not_empty.notify_all()
+
+    def close(self):
+        pass
+
+    def _drop(self, counter):
+        if self.stats is not None:
+            self.stats.incr(counter)
+
+    def put(self, item, block=True, timeout=None):
+        if self.policy == 'block':
+            return Queue.put(self, item, block, timeout)
+        with self.not_full:
+            if self.maxsize > 0 and self._qsize() >= self.maxsize:
+                if self.policy == 'drop-newest':
+                    logger.debug("{0}: full, dropping the new pastie".format(self))
+                    self._drop('queue_dropped_newest')
+                    return
+                while self._qsize() >= self.maxsize:
+                    logger.debug("{0}: full, dropping the oldest pastie".format(self))
+                    self._discard(self.queue.popleft())
+                    self.unfinished_tasks -= 1
+                    self._drop('queue_dropped_oldest')
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+
+class PastieDiskQueue(PastieSiteQueue):
+    '''
+    PastieSiteQueue journaled in a SQLite database, so the pasties waiting
+    to be downloaded survive a restart or a crash.
+
+    A pastie stays in the journal until its download is done, a pastie
+    being downloaded during a crash is queued again on the next start.
+    The journal is committed every 'commit_batch' operations or every
+    'commit_interval' seconds, so the last operations before a crash may
+    be lost.
+    '''
+
+    def __init__(self, filename, maxsize=0, policy='block', newest_first=False, stats=None,
+            commit_interval=1, commit_batch=1000):
+        PastieSiteQueue.__init__(self, maxsize, policy, newest_first, stats)
+        self.filename = filename
+        self.commit_interval = commit_interval
+        self.commit_batch = commit_batch
+        self.pending = 0
+        self.last_commit = time.time()
+        # the connection is only used with the mutex of the queue held
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute('pragma journal_mode=wal')
+        self.db.execute('pragma synchronous=normal')
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS queue (
+                id TEXT PRIMARY KEY,
+                seq INTEGER
+                )''')
+        self.db.commit()
+        self.seq = self.db.execute('SELECT COALESCE(MAX(seq), 0) FROM queue').fetchone()[0]
+        self.recovered = [row[0] for row in self.db.execute('SELECT id FROM queue ORDER BY seq')]
+        if self.recovered:
+            logger.info("{0}: {1} pasties to recover from '{2}'".format(self, len(self.recovered), filename))
+
+    def __repr__(self):
+        return 'PastieDiskQueue[{0}][{1}]'.format(self.maxsize, self.policy)
+
+    def configure_journal(self, commit_interval=1, commit_batch=1000):
+        with self.mutex:
+            self.commit_interval = commit_interval
+            self.commit_batch = commit_batch
+
+    def _commit(self, force=False):
+        if not self.pending or self.db is None:
+            return
+        if force or self.pending >= self.commit_batch or time.time() - self.last_commit >= self.commit_interval:
+            self.db.commit()
+            self.pending = 0
+            self.last_commit = time.time()
+
+    def _put(self, item):
+        if self.db is not None:
+            self.seq = self.seq + 1
+            self.db.execute('INSERT OR REPLACE INTO queue VALUES (?, ?)', (item.id, self.seq))
+            self.pending = self.pending + 1
+            self._commit()
+        PastieSiteQueue._put(self, item)
+
+    def _discard(self, item):
+        if self.db is not None:
+            self.db.execute('DELETE FROM queue WHERE id=?', (item.id,))
+            self.pending = self.pending + 1
+
+    def get(self, block=True, timeout=None):
+        try:
+            return PastieSiteQueue.get(self, block, timeout)
+        finally:
+            with self.mutex:
+                self._commit()
+
+    def done(self, item):
+        with self.mutex:
+            self._discard(item)
+            self._commit()
+        self.task_done()
+
+    def recover(self, factory):
+        with self.mutex:
+            recovered = self.recovered
+            self.recovered = []
+            for pastie_id in recovered:
+                # already in the journal
+                PastieSiteQueue._put(self, factory(pastie_id))
+                self.unfinished_tasks += 1
+                self.not_empty.notify()
+        return len(recovered)
+
+    def drain(self):
+        items = PastieSiteQueue.drain(self)
+        with self.mutex:
+            self._commit(force=True)
+        return items
+
+    def close(self):
+        ''' the pasties still in the journal are recovered by the next queue opening it '''
+        with self.mutex:
+            self._commit(force=True)
+            if self.db is not None:
+                self.db.close()
+                self.db = None
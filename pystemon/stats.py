@@ -0,0 +1,35 @@
+import logging.handlers
+import threading
+
+logger = logging.getLogger('pystemon')
+
+class PystemonStats():
+    '''
+    Counters and gauges of a site, kept across configuration reloads and
+    logged on SIGUSR1.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.counters = {}
+
+    def __repr__(self):
+        return 'PystemonStats[{0}]'.format(self.name)
+
+    def incr(self, counter, value=1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def set(self, counter, value):
+        with self.lock:
+            self.counters[counter] = value
+
+    def get(self, counter):
+        with self.lock:
+            return self.counters.get(counter, 0)
+
+    def to_text(self):
+        with self.lock:
+            return '{0}: {1}'.format(self, ' '.join(['{0}={1}'.format(k, v)
+                for (k, v) in sorted(self.counters.items())]))
@@ -30,6 +30,9 @@ class StorageScheduler():
     def seen_pastie(self, pastie_id, **kwargs):
         raise NotImplementedError
 
+    def seen_pasties(self, pastie_ids, **kwargs):
+        raise NotImplementedError
+
 
 class StorageSync(StorageScheduler):
     def save_pastie(self, pastie, timeout):
@@ -38,6 +41,9 @@ class StorageSync(StorageScheduler):
     def seen_pastie(self, pastie_id, **kwargs):
         return self.storage.seen_pastie(pastie_id, **kwargs)
 
+    def seen_pasties(self, pastie_ids, **kwargs):
+        return self.storage.seen_pasties(pastie_ids, **kwargs)
+
 
 # LATER: implement an async class
 class StorageThread(threading.Thread, StorageScheduler):
@@ -49,6 +55,8 @@ class StorageThread(threading.Thread, StorageScheduler):
         except Exception:
             size = 0
         self.queue = Queue(size)
+        # pasties bigger than 'spill' bytes wait to be saved in a temporary file
+        self.spill = kwargs.get('spill', 0)
         self.condition = threading.Condition()
         self.kill_received = False
 
@@ -60,43 +68,61 @@ class StorageThread(threading.Thread, StorageScheduler):
 
     def run(self):
         logger.info('{0}: Thread for saving pasties started'.format(self.name))
-        with self.condition:
-            # loop over the queue
-            while not self.kill_received:
-                pastie = None
-                try:
-                    # grabs pastie from queue
-                    pastie = self.queue.get_nowait()
-                    # save the pasties in each storage
-                    self.storage.save_pastie(pastie)
-                except Empty:
-                    pass
-                # catch unknown errors
-                except Exception as e:
-                    logger.error("{0}: Thread for saving pasties crashed unexpectectly, recovering...: {1}".format(self.name, e))
-                    logger.debug(traceback.format_exc())
-                finally:
-                    if pastie is not None:
-                        # to be on the safe side of gf
-                        del(pastie)
-                        # signals to queue job is done
-                        self.queue.task_done()
-                self.condition.wait(1)
+        # loop over the queue, the condition is not held while saving so
+        # the download threads can keep queueing pasties
+        while True:
+            with self.condition:
+                if self.kill_received:
+                    break
+            pastie = None
+            try:
+                # grabs pastie from queue
+                pastie = self.queue.get(True, 1)
+                # save the pasties in each storage
+                self.storage.save_pastie(pastie)
+            except Empty:
+                pass
+            # catch unknown errors
+            except Exception as e:
+                logger.error("{0}: Thread for saving pasties crashed unexpectectly, recovering...: {1}".format(self.name, e))
+                logger.debug(traceback.format_exc())
+            finally:
+                if pastie is not None:
+                    pastie.release()
+                    # to be on the safe side of gf
+                    del(pastie)
+                    # signals to queue job is done
+                    self.queue.task_done()
+        # release the content (and spill files) of the pasties not saved
+        dropped = 0
+        while True:
+            try:
+                self.queue.get_nowait().release()
+                dropped = dropped + 1
+            except Empty:
+                break
+        if dropped:
+            logger.warning('{0}: {1} pasties not saved'.format(self.name, dropped))
         logger.info('{0}: Thread for saving pasties terminated'.format(self.name))
 
     def save_pastie(self, pastie, timeout):
+        pastie.hold()
+        if self.spill:
+            pastie.spill(self.spill)
         try:
             logger.debug('{0}: queueing pastie {1} for saving'.format(self.name, pastie.id))
             self.queue.put(pastie, True, timeout)
-            with self.condition:
-                self.condition.notify_all()
         except Full:
+            pastie.release()
             logger.error('{0}: unable to save pastie[{1}]: queue is full'.format(self.name, pastie.id))
 
     # should work as there is 1 write for n readers (and currently n = 1)
     def seen_pastie(self, pastie_id, **kwargs):
         return self.storage.seen_pastie(pastie_id, **kwargs)
 
+    def seen_pasties(self, pastie_ids, **kwargs):
+        return self.storage.seen_pasties(pastie_ids, **kwargs)
+
 
 class StorageDispatcher():
     def __init__(self):
@@ -118,6 +144,16 @@ class StorageDispatcher():
         logger.debug('Pastie[{0}] unknown'.format(pastie_id))
         return False
 
+    def seen_pasties(self, pastie_ids, **kwargs):
+        ''' returns the pasties unknown to all the storages '''
+        unseen = list(pastie_ids)
+        for t in self.__storage:
+            if not unseen:
+                break
+            unseen = t.seen_pasties(unseen, **kwargs)
+        logger.debug('{0}/{1} pasties unknown'.format(len(unseen), len(pastie_ids)))
+        return unseen
+
 
 class PastieStorage():
 
@@ -154,8 +190,9 @@ class PastieStorage():
             logger.error('{0}: unable to initialize storage backend: {1}'.format(self.name, e))
             raise
 
-    def format_directory(self, directory):
-        d = datetime.now()
+    def format_directory(self, directory, d=None):
+        if d is None:
+            d = datetime.now()
         year = str(d.year)
         month = str(d.month)
         # prefix month and day with "0" if it is only one digit
@@ -186,6 +223,24 @@ class PastieStorage():
     def __seen_pastie__(self, pastie_id, **kwargs):
         raise NotImplementedError
 
+    def __seen_pasties__(self, pastie_ids, **kwargs):
+        # storages without batch lookup are asked for each pastie
+        unseen = []
+        for pastie_id in pastie_ids:
+            if not self.__seen_pastie__(pastie_id, **self.pastie_kwargs(pastie_id, **kwargs)):
+                unseen.append(pastie_id)
+        return unseen
+
+    def pastie_kwargs(self, pastie_id, **kwargs):
+        ''' the arguments of seen_pastie for one of the pasties of seen_pasties '''
+        res = {}
+        for (k, v) in kwargs.items():
+            if k in ['urls', 'filenames']:
+                res[k[:-1]] = v[pastie_id]
+            else:
+                res[k] = v
+        return res
+
     def seen_pastie(self, pastie_id, **kwargs):
         if not self.lookup:
             return False
@@ -200,3 +255,17 @@ class PastieStorage():
             logger.error('{0}: unable to lookup pastie[{1}]: {2}'.format(self.name, pastie_id, e))
             raise
 
+    def seen_pasties(self, pastie_ids, **kwargs):
+        ''' returns the pasties not found in the storage '''
+        if not self.lookup:
+            return list(pastie_ids)
+        try:
+            start = time.time()
+            logger.debug('{0}: looking up {1} pasties'.format(self.name, len(pastie_ids)))
+            res = self.__seen_pasties__(pastie_ids, **kwargs)
+            delta = time.time() - start
+            logger.debug('{0}: {1} pasties looked-up in {2}s'.format(self.name, len(pastie_ids), delta))
+            return res
+        except Exception as e:
+            logger.error('{0}: unable to lookup pasties: {1}'.format(self.name, e))
+            raise
@@ -2,6 +2,7 @@
 import logging.handlers
 import os
 import gzip
+from datetime import datetime, timedelta
 from pystemon.storage import PastieStorage
 
 logger = logging.getLogger('pystemon')
@@ -57,16 +58,29 @@ class FileStorage(PastieStorage):
             logger.debug('Site[{site}]: Wrote pastie[{id}][{disk}] to disk.'.format(site=pastie.site.name, id=pastie.id, disk=full_path))
         return full_path
 
+    def lookup_directories(self, site):
+        '''
+        Returns the existing directories of today and yesterday, a pastie
+        listed shortly after midnight was probably saved the day before.
+        '''
+        now = datetime.now()
+        directories = []
+        for d in [self.save_dir, self.archive_dir]:
+            if d is None:
+                continue
+            for day in [now, now - timedelta(days=1)]:
+                fullpath = PastieStorage.format_directory(self, d + os.sep + site, day)
+                if os.path.isdir(fullpath):
+                    directories.append(fullpath)
+        return directories
+
     def __seen_pastie__(self, pastie_id, **kwargs):
         try:
             # check if the pastie was already saved on the disk
             pastie_filename = kwargs['filename']
             site = kwargs['site']
-            for d in [self.save_dir, self.archive_dir]:
-                if d is None:
-                    continue
-                fullpath = self.format_directory(d + os.sep + site)
-                fullpath = fullpath + os.sep + pastie_filename
+            for d in self.lookup_directories(site):
+                fullpath = d + os.sep + pastie_filename
                 logger.debug('{0}: checking if file {1} exists'.format(self.name, fullpath))
                 if os.path.exists(fullpath):
                     logger.debug('{0}: file {1} exists'.format(self.name, fullpath))
@@ -75,3 +89,15 @@ class FileStorage(PastieStorage):
             pass
         return False
 
+    def __seen_pasties__(self, pastie_ids, **kwargs):
+        # list each directory once instead of checking each file
+        try:
+            filenames = kwargs['filenames']
+            site = kwargs['site']
+        except KeyError:
+            return list(pastie_ids)
+        files = set()
+        for d in self.lookup_directories(site):
+            logger.debug('{0}: listing directory {1}'.format(self.name, d))
+            files.update(os.listdir(d))
+        return [pastie_id for pastie_id in pastie_ids if filenames[pastie_id] not in files]
@@ -84,3 +84,27 @@ class MongoStorage(PastieStorage):
             self.lookup = False
         return False
 
+    def __seen_pasties__(self, pastie_ids, **kwargs):
+        # one query for all the pasties
+        try:
+            if self.save_id and self.save_site:
+                site = kwargs['site']
+                seen = set([doc['pastie_id'] for doc in self.col.find(
+                    {'pastie_id': {'$in': list(pastie_ids)}, 'site': site}, {'pastie_id': 1})])
+                return [pastie_id for pastie_id in pastie_ids if pastie_id not in seen]
+            if self.save_url:
+                urls = kwargs['urls']
+                seen = set([doc['url'] for doc in self.col.find(
+                    {'url': {'$in': [urls[pastie_id] for pastie_id in pastie_ids]}}, {'url': 1})])
+                return [pastie_id for pastie_id in pastie_ids if urls[pastie_id] not in seen]
+            logger.error('{0}: Not enough meta-data saved, disabling lookup'.format(self.name))
+            self.lookup = False
+        except KeyError:
+            pass
+        except TypeError as e:
+            logger.error('{0}: Invalid query parameters: {1}'.format(self.name, e))
+            pass
+        except Exception as e:
+            logger.error('{0}: Invalid query, disabling lookup: {1}'.format(self.name, e))
+            self.lookup = False
+        return list(pastie_ids)
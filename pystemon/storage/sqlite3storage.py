@@ -49,7 +49,7 @@ class Sqlite3Storage(PastieStorage):
             raise Exception('Problem with SQLite database {0}: {1}'.format(self.filename, e))
 
     def __save_pastie__(self, pastie):
-        if self.__seen_pastie__(pastie.id, site_name=pastie.site.name):
+        if self.__seen_pastie__(pastie.id, sitename=pastie.site.name):
             self.__update(pastie)
         else:
             self.__add(pastie)
@@ -68,6 +68,22 @@ class Sqlite3Storage(PastieStorage):
             pass
         return False
 
+    def __seen_pasties__(self, pastie_ids, **kwargs):
+        try:
+            site_name = kwargs['sitename']
+        except KeyError:
+            return list(pastie_ids)
+        cursor = self.__connect__()
+        seen = set()
+        # stay below the maximum number of host parameters of old SQLite versions
+        for i in range(0, len(pastie_ids), 500):
+            chunk = list(pastie_ids[i:i+500])
+            cursor.execute('SELECT id FROM pasties WHERE site=? AND id IN ({0})'.format(
+                ','.join(['?'] * len(chunk))), [site_name] + chunk)
+            seen.update([row[0] for row in cursor.fetchall()])
+        logger.debug('seen {0}/{1} pasties in sqlite'.format(len(seen), len(pastie_ids)))
+        return [pastie_id for pastie_id in pastie_ids if pastie_id not in seen]
+
     def __add(self, pastie):
         try:
             data = {'site': pastie.site.name,
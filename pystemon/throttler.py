@@ -2,91 +2,85 @@ import logging.handlers
 import threading
 import time
 
-try:
-    from queue import Queue
-    from queue import Empty
-except ImportError:
-    from Queue import Queue
-    from Queue import Empty
-
 logger = logging.getLogger('pystemon')
 
-class ThreadThrottler(threading.Thread):
+class TokenBucketThrottler():
+    '''
+    Rate limiter of a site, shared by all its user agents without a thread
+    of its own. The bucket holds up to 'burst' tokens and gains one every
+    'throttling' ms. A download takes a token, or reserves the next one
+    and waits until it is due, so the waiting downloads are served in
+    order. The throttler of a site is kept across configuration reloads.
+    '''
 
-    def __init__(self, site, throttling):
-        threading.Thread.__init__(self)
+    def __init__(self, site, throttling, burst=1, stats=None):
         self.site = site
+        self.stats = stats
+        self.lock = threading.Lock()
+        self.tokens = burst
+        self.last = time.time()
         self._throttling = throttling
-        self.queue = Queue()
-        self.condition = threading.Condition()
-        self.kill_received = False
+        self.interval = throttling / 1000.0
+        self.burst = burst
 
     def __repr__(self):
-        with self.condition:
-            return 'ThreadThrottler[{}][{}]'.format(self.site, self._throttling)
+        with self.lock:
+            return 'TokenBucketThrottler[{0}][{1}][{2}]'.format(self.site, self._throttling, self.burst)
 
     def is_same_as(self, other):
         res = False
         try:
-            res = ( isinstance(other, ThreadThrottler)
+            res = ( isinstance(other, TokenBucketThrottler)
                     and
                     (self.site == other.site)
                     and
-                    (self.throttling == other.throttling) )
+                    (self.throttling == other.throttling)
+                    and
+                    (self.burst == other.burst) )
         except Exception as e:
-            logger.error("Unable to compare ThreadThrottler instances: {}".format(e))
+            logger.error("Unable to compare TokenBucketThrottler instances: {}".format(e))
             pass
         return res
 
     @property
     def throttling(self):
-        with self.condition:
+        with self.lock:
             return self._throttling
 
-    @throttling.setter
-    def throttling(self, throttling):
-        with self.condition:
+    def configure(self, throttling, burst=1):
+        with self.lock:
+            self._refill(time.time())
             self._throttling = throttling
+            self.interval = throttling / 1000.0
+            self.burst = burst
+            self.tokens = min(self.tokens, burst)
 
-    def stop(self):
-        with self.condition:
-            logger.info('ThreadThrottler[{}] exiting'.format(self.site))
-            self.kill_received = True
-            self.condition.notify_all()
-
-    def wait(self):
-        event = threading.Event()
-        event.clear()
-        self.queue.put(event)
-        event.wait()
+    def _refill(self, now):
+        if self.interval > 0:
+            self.tokens = min(self.burst, self.tokens + (now - self.last) / self.interval)
+        else:
+            self.tokens = self.burst
+        self.last = now
 
-    def run(self):
-        site = self.site
-        logger.info('ThreadThrottler[{}] started'.format(site))
-        queue = self.queue
-        try:
-            with self.condition:
-                while not self.kill_received:
-                    logger.debug("ThreadThrottler[{}]: waiting for a download request ...".format(site))
-                    consumer_lock = queue.get()
-                    logger.debug("ThreadThrottler[{}]: releasing download request".format(site))
-                    consumer_lock.set()
-                    queue.task_done()
-                    sleeptime = self._throttling/float(1000)
-                    logger.debug("ThreadThrottler[{}]: now waiting {} second(s) ...".format(site, sleeptime))
-                    self.condition.wait(sleeptime)
-        except Exception as e:
-            logger.error('ThreadThrottler[{}] crashed: {}'.format(self.site, e))
-        logger.debug('ThreadThrottler[{}]: releasing any remaining item from the queue'.format(self.site))
-        # only returns the 'approximate' size
-        while True:
-            try:
-                consumer_lock = queue.get(block=False)
-                consumer_lock.set()
-                queue.task_done()
-            except Empty:
-                break
-            except Exception as e:
-                pass
-        logger.info('ThreadThrottler[{}] exited'.format(site))
+    def delay(self):
+        ''' seconds until a token is available, without taking it '''
+        with self.lock:
+            self._refill(time.time())
+            if self.tokens >= 1:
+                return 0
+            return (1 - self.tokens) * self.interval
 
+    def reserve(self):
+        ''' takes a token, returns the seconds to wait before using it '''
+        with self.lock:
+            self._refill(time.time())
+            self.tokens = self.tokens - 1
+            wait = 0
+            if self.tokens < 0:
+                wait = -self.tokens * self.interval
+        if self.stats is not None:
+            self.stats.incr('throttle_acquired')
+            if wait > 0:
+                self.stats.incr('throttle_waits')
+                self.stats.incr('throttle_wait_seconds', wait)
+        return wait
@@ -27,6 +27,10 @@ def make_bound_socket(source_ip):
         return sock
     return bound_socket
 
+def slow_down_requested(page):
+    ''' whether a 403 page asks to slow down, rather than denying a pastie '''
+    return 'Please slow down' in page or 'has temporarily blocked your computer' in page or 'blocked' in page
+
 # https://requests.readthedocs.io/en/master/user/advanced/#transport-adapters
 class PystemonAdapter(HTTPAdapter):
     def __init__(self, ip_addr='', *args, **kwargs):
@@ -36,17 +40,96 @@ class PystemonAdapter(HTTPAdapter):
     def init_poolmanager(self, connections, maxsize, block=False):
         super(PystemonAdapter, self).init_poolmanager(connections, maxsize, block, source_address=(self._source_address, 0))
 
+class PystemonSessionPool():
+    '''
+    Keep-alive sessions shared by the user agents, one per (proxy, source
+    IP), so the downloads reuse their connections instead of paying a TCP
+    and TLS handshake each. A session keeps up to 'maxsize' connections to
+    each of 'connections' hosts, and is closed once unused for
+    'idle_timeout' seconds. The headers are set per request.
+    '''
+
+    def __init__(self, connections=10, maxsize=10, idle_timeout=60):
+        self.connections = connections
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        # (proxy, ip_addr) -> [session, last use]
+        self.sessions = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __repr__(self):
+        return 'PystemonSessionPool[{0}][{1}]'.format(self.connections, self.maxsize)
+
+    def configure(self, connections=10, maxsize=10, idle_timeout=60):
+        with self.lock:
+            if (connections, maxsize) != (self.connections, self.maxsize):
+                # the new sizes apply to new sessions
+                self._close_all()
+            self.connections = connections
+            self.maxsize = maxsize
+            self.idle_timeout = idle_timeout
+
+    def _close_all(self):
+        for (session, last) in self.sessions.values():
+            session.close()
+        self.sessions = {}
+
+    def _evict(self, now):
+        for (key, (session, last)) in list(self.sessions.items()):
+            if now - last > self.idle_timeout:
+                logger.debug("{0}: closing idle session {1}".format(self, key))
+                del self.sessions[key]
+                session.close()
+                self.evictions = self.evictions + 1
+
+    def get(self, proxy, ip_addr, factory):
+        '''
+        Returns the session of (proxy, ip_addr), factory(connections, maxsize)
+        creating it when needed.
+        '''
+        key = (proxy, ip_addr)
+        now = time.time()
+        with self.lock:
+            self._evict(now)
+            entry = self.sessions.get(key)
+            if entry is None:
+                session = factory(self.connections, self.maxsize)
+                if proxy:
+                    session.proxies = {'http': proxy}
+                entry = self.sessions[key] = [session, now]
+                self.misses = self.misses + 1
+            else:
+                entry[1] = now
+                self.hits = self.hits + 1
+            return entry[0]
+
+    def close(self):
+        with self.lock:
+            self._close_all()
+
+    def stats_to_text(self):
+        with self.lock:
+            return "{0}: sessions={1} hits={2} misses={3} evictions={4}".format(
+                self, len(self.sessions), self.hits, self.misses, self.evictions)
+
+
 class PystemonUA():
 
-    def get_bound_session(self):
+    def get_bound_session(self, pool_connections=10, pool_maxsize=10):
         global urllib_version
         session = requests.Session()
+        if not self.ip_addr or urllib_version < 3:
+            session.mount('http://', HTTPAdapter(pool_connections, pool_maxsize))
+            session.mount('https://', HTTPAdapter(pool_connections, pool_maxsize))
         if self.ip_addr:
             try:
                 if urllib_version > 2:
                     logger.debug("{}: Bounding HTTPAdapter to IP '{}'".format(self.name, self.ip_addr))
-                    session.mount('http://', PystemonAdapter(self.ip_addr))
-                    session.mount('https://', PystemonAdapter(self.ip_addr))
+                    session.mount('http://', PystemonAdapter(self.ip_addr, pool_connections, pool_maxsize))
+                    session.mount('https://', PystemonAdapter(self.ip_addr, pool_connections, pool_maxsize))
                 else:
                     logger.debug("{}: Bounding socket to IP '{}'".format(self.name, self.ip_addr))
                     socket.setdefaulttimeout(10)  # set a default timeout of 10 seconds to download the page (default = unlimited)
@@ -59,7 +142,8 @@ class PystemonUA():
     def __init__(self, name, proxies_list, user_agents_list = [],
             retries_client=5, retries_server=100,
             throttler=None, ip_addr=None,
-            connection_timeout=3.05, read_timeout=10):
+            connection_timeout=3.05, read_timeout=10, stats=None, session_pool=None,
+            breaker=None):
         self.name = "user-agent"+name
         self.user_agents_list = user_agents_list
         self.proxies_list = proxies_list
@@ -69,6 +153,11 @@ class PystemonUA():
         self.ip_addr = ip_addr
         self.connection_timeout = connection_timeout
         self.read_timeout = read_timeout
+        # counts the rate limited responses of the site
+        self.stats = stats
+        self.session_pool = session_pool
+        # shared by all the user agents of the site
+        self.breaker = breaker
         self.condition = threading.Condition()
         self.kill_received = False
         logger.debug("{} initialized".format(self.name))
@@ -83,61 +172,93 @@ class PystemonUA():
             return random.choice(self.user_agents_list)
         return 'Python-urllib/2.7'
 
-    def __parse_http__(self, url, session, random_proxy):
+    def get_session(self, random_proxy):
+        if self.session_pool is not None:
+            return self.session_pool.get(random_proxy, self.ip_addr, self.get_bound_session)
+        session = self.get_bound_session()
+        if random_proxy:
+            session.proxies = {'http': random_proxy}
+        return session
+
+    def __parse_http__(self, url, session, random_proxy, headers):
+        '''
+        Besides the response, the result tells the breaker of the site when
+        the site asked to slow down ('throttled', with the Retry-After if
+        any) or failed ('server_error').
+        '''
         logger.debug("{}: Parsing response for url '{}'".format(self.name, url))
         try:
-            response = session.get(url, stream=True, timeout=(self.connection_timeout, self.read_timeout))
+            response = session.get(url, headers=headers, stream=True,
+                    timeout=(self.connection_timeout, self.read_timeout))
             response.raise_for_status()
             res = {'response': response}
-        except HTTPError as e:
-            self.proxies_list.failed_proxy(random_proxy)
-            logger.warning("{}: !!Proxy error on {}.".format(self.name, url))
-            if 404 == e.code:
-                htmlPage = e.read()
+        except requests.HTTPError as e:
+            code = e.response.status_code
+            if random_proxy:
+                self.proxies_list.failed_proxy(random_proxy)
+                logger.warning("{}: !!Proxy error on {}.".format(self.name, url))
+            if 404 == code:
                 logger.warning("{}: 404 from proxy received for {}".format(self.name, url))
                 res = {'loop_client': True, 'wait': 60}
-            elif 500 == e.code:
-                htmlPage = e.read()
-                logger.warning("{}: 500 from proxy received for {}".format(self.name, url))
-                res = {'loop_server': True, 'wait': 60}
-            elif 504 == e.code:
-                htmlPage = e.read()
-                logger.warning("{}: 504 from proxy received for {}".format(self.name, url))
-                res = {'loop_server': True, 'wait': 60}
-            elif 429 == e.code:
-                retry_after = response.headers.get('Retry-After', 60)
+            elif code in [500, 502, 503, 504]:
+                logger.warning("{}: {} from proxy received for {}".format(self.name, code, url))
+                res = {'loop_server': True, 'wait': 60, 'server_error': True}
+            elif 429 == code:
+                retry_after = str(e.response.headers.get('Retry-After', ''))
                 if retry_after.isdigit():
                     wait = int(retry_after)
                     logger.warning("{}: 429 from proxy received for {} requesting Retry-After {} seconds".format(self.name, url, wait))
+                    res = {'loop_server': True, 'wait': wait, 'throttled': wait}
                 else:
                     logger.warning("{}: 429 from proxy received for {}".format(self.name, url))
-                    wait = 60
-                res = {'loop_server': True, 'wait': wait}
-            elif 502 == e.code:
-                htmlPage = e.read()
-                logger.warning("{}: 502 from proxy received for {}".format(self.name, url))
-                res = {'loop_server': True, 'wait': 60}
-            elif 403 == e.code:
-                htmlPage = e.read()
-                if 'Please slow down' in htmlPage or 'has temporarily blocked your computer' in htmlPage or 'blocked' in htmlPage:
+                    res = {'loop_server': True, 'wait': 60, 'throttled': None}
+            elif 403 == code:
+                if slow_down_requested(e.response.text):
                     logger.warning("{}: Slow down message received for {}".format(self.name, url))
-                    res = {'loop_server': True, 'wait': 60}
+                    res = {'loop_server': True, 'wait': 60, 'throttled': None}
                 else:
                     logger.warning("{}: 403 from proxy received for {}, aborting".format(self.name, url))
                     res = {'abort': True}
             else:
                 logger.warning("{}: ERROR: HTTP Error ##### {} ######################## {}".format(self.name, e, url))
                 res = {'abort': True}
+            # only the 429 and "slow down" 403, not the 403 of a removed pastie
+            if self.stats is not None and 'throttled' in res:
+                self.stats.incr('rate_limited')
         logger.debug("{}: Parsing response done for url '{}'".format(self.name, url))
         return res
 
+    def report(self, res):
+        ''' tells the breaker of the site the outcome of a request '''
+        if res.get('response') is not None:
+            self.breaker.success()
+        elif 'throttled' in res:
+            self.breaker.failure(res['throttled'], 'slow down requested')
+        elif res.get('server_error', False):
+            self.breaker.error()
+        else:
+            self.breaker.release()
+
+    def wait_breaker(self):
+        ''' waits until the breaker of the site allows a request, False if killed '''
+        delay = self.breaker.acquire()
+        while delay > 0:
+            logger.debug("{}: download_url: site paused by its circuit breaker, waiting {}s ...".format(
+                self.name, delay))
+            with self.condition:
+                if self.kill_received:
+                    return False
+                self.condition.wait(delay)
+            delay = self.breaker.acquire()
+        return True
+
 
-    def __download_url__(self, url, session, random_proxy):
+    def __download_url__(self, url, session, random_proxy, headers):
         try:
             with self.condition:
                 if self.kill_received:
                     raise PystemonKillReceived("download request cancelled")
-            res = self.__parse_http__(url, session, random_proxy)
+            res = self.__parse_http__(url, session, random_proxy, headers)
         except URLError as e:
             logger.debug("{}: ERROR: URL Error ##### {} ########################".format(self.name, e))
             if random_proxy:  # remove proxy from the list if needed
@@ -174,39 +295,58 @@ class PystemonUA():
         # do NOT try to download the url again here, as we might end in enless loop
         return res
 
-    def download_url(self, url, data=None, cookie=None, wait=0):
+    def download_url(self, url, data=None, cookie=None, wait=0, validators=None):
+        '''
+        validators is an optional dict, where the ETag and Last-Modified of
+        the response are kept for the next conditional request of the url,
+        which may then return a '304 Not Modified' response.
+        '''
         # let's not recurse where exceptions can raise exceptions can raise exceptions can...
         response = None
         loop_client = 0
         loop_server = 0
         logger.debug("{}: download_url: about to fetch url '{}'".format(self.name, url))
         while (response is None) and (loop_client < self.retries_client) and (loop_server < self.retries_server):
+            if wait > 0:
+                logger.debug("{}: Waiting {}s before retrying {}".format(
+                    self.name, wait, url))
+                with self.condition:
+                    if not self.kill_received:
+                        self.condition.wait(wait)
+            if self.breaker is not None and not self.wait_breaker():
+                return None
             try:
-                if self.throttler is not None and self.throttler.is_alive():
+                if self.throttler is not None:
                     # wait until the throttler allows us to download
-                    logger.debug("{}: download_url: throttling enabled, waiting for permission for download ...".format(self.name))
-                    self.throttler.wait()
-                    logger.debug("{}: download_url: permission to download granted".format(self.name))
-                session = self.get_bound_session()
+                    delay = self.throttler.reserve()
+                    if delay > 0:
+                        logger.debug("{}: download_url: throttling enabled, waiting {}s for permission to download ...".format(
+                            self.name, delay))
+                        with self.condition:
+                            if not self.kill_received:
+                                self.condition.wait(delay)
+                        logger.debug("{}: download_url: permission to download granted".format(self.name))
                 random_proxy = None
                 if self.proxies_list:
                     random_proxy = self.proxies_list.get_random_proxy()
-                    if random_proxy:
-                        session.proxies = {'http': random_proxy}
+                session = self.get_session(random_proxy)
+                # the session may be shared, the headers are set per request
                 user_agent = self.get_random_user_agent()
-                session.headers.update({'User-Agent': user_agent, 'Accept-Charset': 'utf-8'})
+                headers = {'User-Agent': user_agent, 'Accept-Charset': 'utf-8'}
                 if cookie:
-                    session.headers.update({'Cookie': cookie})
+                    headers['Cookie'] = cookie
                 if data:
-                    session.headers.update(data)
+                    headers.update(data)
+                if validators:
+                    if validators.get('etag'):
+                        headers['If-None-Match'] = validators['etag']
+                    if validators.get('last-modified'):
+                        headers['If-Modified-Since'] = validators['last-modified']
             except Exception as e:
                 logger.error("ERROR: unable to initialize session, aborting: {}".format(e))
+                if self.breaker is not None:
+                    self.breaker.release()
                 return None
-            if wait > 0:
-                logger.debug("{}: Waiting {}s before retrying {}".format(
-                    self.name, wait, url))
-                with self.condition:
-                    self.condition.wait(wait)
             logger.debug('{name}: Downloading url: {url} with proxy: {proxy} and user-agent: {ua}'.format(
                 name=self.name, url=url, proxy=random_proxy, ua=user_agent))
             if (loop_client > 0) or (loop_server > 0):
@@ -217,10 +357,14 @@ class PystemonUA():
                     url=url
                 ))
             now = time.time()
-            res = self.__download_url__(url, session, random_proxy)
+            res = self.__download_url__(url, session, random_proxy, headers)
             time_taken = time.time() - now
             logger.debug('{}: Downloading url: {} done in {}s.'.format(self.name, url, time_taken))
+            if self.breaker is not None:
+                self.report(res)
             response = res.get('response', None)
+            if random_proxy and response is not None:
+                self.proxies_list.succeeded_proxy(random_proxy, time_taken)
             if res.get('abort', False):
                 break
             if res.get('loop_client', False):
@@ -228,6 +372,9 @@ class PystemonUA():
             if res.get('loop_server', False):
                 loop_server += 1
             wait = res.get('wait', wait)
+            if self.breaker is not None and 'throttled' in res:
+                # the breaker pauses the whole site instead
+                wait = 0
 
         if response is None:
             # Client errors (40x): if more than 5 recursions, give up on URL (used for 404 case)
@@ -238,6 +385,9 @@ class PystemonUA():
                 logger.error("{}: ERROR: too many server errors, giving up on {}".format(self.name, url))
             else:
                 logger.error("{}: ERROR: too many errors, giving up on {}".format(self.name, url))
+        elif validators is not None and response.status_code == 200:
+            validators['etag'] = response.headers.get('ETag')
+            validators['last-modified'] = response.headers.get('Last-Modified')
 
         return response
 
@@ -0,0 +1,210 @@
+import logging.handlers
+import threading
+import time
+import traceback
+
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+logger = logging.getLogger('pystemon')
+
+class PoolSite():
+    ''' A site served by the PastieWorkerPool '''
+
+    def __init__(self, name, queue, user_agent, weight=1, concurrency=0, throttler=None, breaker=None):
+        self.name = name
+        self.queue = queue
+        self.user_agent = user_agent
+        self.weight = weight
+        self.concurrency = concurrency
+        self.throttler = throttler
+        self.breaker = breaker
+        self.deficit = 0
+        self.active = 0
+        self.next_download = 0
+        self.dispatched = 0
+
+    def __repr__(self):
+        return 'PoolSite[{0}]'.format(self.name)
+
+    def ready(self, now):
+        if self.concurrency and self.active >= self.concurrency:
+            return False
+        if now < self.next_download:
+            return False
+        if self.throttler is not None and self.throttler.delay() > 0:
+            return False
+        if self.breaker is not None and self.breaker.delay() > 0:
+            return False
+        return self.queue.qsize() > 0
+
+    def throttled(self, now):
+        ''' seconds until the site may download again '''
+        wait = self.next_download - now
+        if self.throttler is not None:
+            wait = max(wait, self.throttler.delay())
+        if self.breaker is not None:
+            wait = max(wait, self.breaker.delay())
+        return wait
+
+
+class PastieWorkerPool():
+    '''
+    Hands out the pasties of all the site queues to a single pool of
+    download threads, using deficit round-robin: every time the round
+    reaches a site with pasties waiting, the site earns 'weight' credits,
+    and each pastie handed out costs one credit. A site is skipped while it
+    has 'concurrency' downloads running, while its throttler has no
+    token available, or while its circuit breaker pauses it. The downloads
+    of a site are also spread by throttling / burst ms, as the tokens are
+    only taken by the workers.
+    '''
+
+    def __init__(self):
+        self.sites = []
+        self.current = 0
+        self.lock = threading.Lock()
+        # set when a pastie is queued or a download is done
+        self.wakeup = threading.Event()
+        self.kill_received = False
+
+    def __repr__(self):
+        return 'PastieWorkerPool[{0}]'.format(len(self.sites))
+
+    def add_site(self, name, queue, user_agent, weight=1, concurrency=0, throttler=None, breaker=None):
+        site = PoolSite(name, queue, user_agent, weight, concurrency, throttler, breaker)
+        with self.lock:
+            self.sites.append(site)
+        queue.wakeup = self.wakeup
+        return site
+
+    def remove_site(self, site):
+        ''' the site is not served anymore, its running downloads go on '''
+        with self.lock:
+            if site in self.sites:
+                self.sites.remove(site)
+                self.current = 0
+            site.user_agent.stop()
+        self.wakeup.set()
+
+    def stop(self):
+        with self.lock:
+            self.kill_received = True
+            for site in self.sites:
+                site.user_agent.stop()
+        self.wakeup.set()
+
+    def _next(self, now):
+        '''
+        Returns the next (site, pastie) to download, or the number of seconds
+        until a throttled site may download again (None if no site is).
+        '''
+        retry = None
+        # the credits of a site with a weight below 1 take several rounds
+        # to pay for a pastie, so keep going while a site is ready
+        while True:
+            found = False
+            for _ in range(len(self.sites)):
+                site = self.sites[self.current]
+                if site.ready(now):
+                    found = True
+                    if site.deficit < 1:
+                        site.deficit = site.deficit + site.weight
+                    if site.deficit >= 1:
+                        try:
+                            pastie = site.queue.get(block=False)
+                        except Empty:
+                            site.deficit = 0
+                            continue
+                        site.deficit = site.deficit - 1
+                        if site.deficit < 1:
+                            self.current = (self.current + 1) % len(self.sites)
+                        return (site, pastie)
+                else:
+                    if site.queue.qsize() == 0:
+                        # an idle site does not save credits
+                        site.deficit = 0
+                    else:
+                        wait = site.throttled(now)
+                        if wait > 0 and (retry is None or wait < retry):
+                            retry = wait
+                self.current = (self.current + 1) % len(self.sites)
+            if not found:
+                return retry
+
+    def get(self, timeout=1):
+        ''' returns the next (site, pastie) to download, or None after timeout '''
+        deadline = time.time() + timeout
+        while True:
+            self.wakeup.clear()
+            with self.lock:
+                if self.kill_received or not self.sites:
+                    return None
+                now = time.time()
+                res = self._next(now)
+                if isinstance(res, tuple):
+                    (site, pastie) = res
+                    site.active = site.active + 1
+                    site.dispatched = site.dispatched + 1
+                    if site.throttler is not None:
+                        site.next_download = now + site.throttler.interval / site.throttler.burst
+                    return res
+            wait = deadline - time.time()
+            if wait <= 0:
+                return None
+            if res is not None:
+                wait = min(wait, res)
+            self.wakeup.wait(wait)
+
+    def done(self, site, pastie):
+        with self.lock:
+            site.active = site.active - 1
+        site.queue.done(pastie)
+        self.wakeup.set()
+
+    def stats_to_text(self):
+        with self.lock:
+            return ' '.join(['{0}: active={1} dispatched={2}'.format(site.name, site.active, site.dispatched)
+                for site in self.sites])
+
+
+class ThreadPoolWorker(threading.Thread):
+    '''
+    Download thread of the PastieWorkerPool, it downloads the pasties of
+    any site.
+    '''
+
+    def __init__(self, pool, number):
+        threading.Thread.__init__(self)
+        self.pool = pool
+        self.name = 'ThreadPoolWorker[{0}]'.format(number)
+        self.condition = threading.Condition()
+        self.kill_received = False
+
+    def stop(self):
+        with self.condition:
+            logger.info('{0}: exiting'.format(self.name))
+            self.kill_received = True
+            self.pool.stop()
+            self.condition.notify_all()
+
+    def run(self):
+        logger.info('{0}: started'.format(self.name))
+        while True:
+            with self.condition:
+                if self.kill_received:
+                    break
+            res = self.pool.get(timeout=1)
+            if res is None:
+                continue
+            (site, pastie) = res
+            try:
+                pastie.fetch_and_process_pastie(site.user_agent)
+            except Exception as e:
+                logger.error("{0} crashed unexpectedly, recovering...: {1}".format(self.name, e))
+                logger.debug(traceback.format_exc())
+            finally:
+                self.pool.done(site, pastie)
+        logger.info('{0}: exited'.format(self.name))